@@ -0,0 +1,215 @@
+import numpy as np
+import tensorflow as tf
+
+def flatten_as(structure, outputs):
+    """
+    Flattens the outputs following the nested tuples of structure, 
+    so that array-like leaves (e.g. lists of counts) are kept whole.
+    """
+    if isinstance(structure, (tuple, list)):
+        return [z for x, y in zip(
+            structure, outputs) for z in flatten_as(x, y)]
+    return [outputs]
+
+def py_map_fn(py_fn, output_signature):
+    """
+    Wraps a Python function into a tf.data map function whose
+    outputs follow the (nested) tuple of tf.TensorSpec.
+    """
+    flat_specs = tf.nest.flatten(output_signature)
+    flat_types = [x.dtype for x in flat_specs]
+    
+    def _py_outputs(*args):
+        tmp_outputs = py_fn(*args)
+        return [np.asarray(x, dtype=y.as_numpy_dtype) for x, y in zip(
+            flatten_as(output_signature, tmp_outputs), flat_types)]
+    
+    def _map_fn(*args):
+        tmp_outputs = tf.py_function(
+            _py_outputs, list(args), flat_types)
+        for tmp_output, tmp_spec in zip(tmp_outputs, flat_specs):
+            tmp_output.set_shape(tmp_spec.shape)
+        return tf.nest.pack_sequence_as(output_signature, tmp_outputs)
+    return _map_fn
+
+def build_pipeline(
+    n_data, sample_fn, output_signature, batch_size=None, 
+    shuffle=True, repeat=True, n_parallel=tf.data.AUTOTUNE):
+    """
+    Builds a tf.data pipeline which prepares the training samples
+    in parallel map stages and prefetches them, so that the next
+    step is prepared while the current step is training.
+    Arguments:
+      n_data: The number of training samples.
+      sample_fn: A function which takes the index of a sample and
+        returns its prepared arrays, e.g. the decoded, augmented and
+        padded image with its encoded targets.
+      output_signature: A (nested) tuple of tf.TensorSpec of the
+        outputs of `sample_fn`.
+      batch_size: If not None, the samples are batched. The outputs
+        of `sample_fn` must then have the same shape for all samples.
+      shuffle: If True, the samples are reshuffled at every epoch.
+      repeat: If True, the pipeline repeats indefinitely.
+      n_parallel: The number of samples prepared in parallel.
+    Returns:
+      The tf.data.Dataset of the prepared samples.
+    """
+    def _load_sample(tmp_idx):
+        return sample_fn(int(tmp_idx.numpy()))
+    
+    tmp_dataset = tf.data.Dataset.range(n_data)
+    if shuffle:
+        tmp_dataset = tmp_dataset.shuffle(
+            n_data, reshuffle_each_iteration=True)
+    if repeat:
+        tmp_dataset = tmp_dataset.repeat()
+    
+    tmp_dataset = tmp_dataset.map(
+        py_map_fn(_load_sample, output_signature), 
+        num_parallel_calls=n_parallel, deterministic=False)
+    if batch_size is not None:
+        tmp_dataset = tmp_dataset.batch(batch_size, drop_remainder=True)
+    
+    tmp_options = tf.data.Options()
+    tmp_options.autotune.enabled = True
+    tmp_dataset = tmp_dataset.with_options(tmp_options)
+    return tmp_dataset.prefetch(tf.data.AUTOTUNE)
+
+def build_graph_pipeline(
+    n_data, load_fn, load_signature, encode_fn, batch_size=None, 
+    shuffle=True, repeat=True, n_parallel=tf.data.AUTOTUNE):
+    """
+    Builds a tf.data pipeline which reads the records of the samples
+    in Python and then decodes and encodes them in a map stage made
+    only of TF ops. As that stage is not a py_function, it does not
+    hold the GIL and runs across cores.
+    Arguments:
+      n_data: The number of training samples.
+      load_fn: A function which takes the index of a sample and
+        returns its raw record, e.g. the image file name with its
+        boxes and class ids, whose number may vary per sample.
+      load_signature: The tuple of tf.TensorSpec of `load_fn`.
+      encode_fn: A function of the outputs of `load_fn` which returns
+        the prepared tensors using only TF ops, e.g. one built on
+        `format_data_tf`.
+      batch_size: If not None, the samples are batched. The outputs
+        of `encode_fn` must then have the same shape for all samples.
+    Returns:
+      The tf.data.Dataset of the prepared samples.
+    """
+    def _load_sample(tmp_idx):
+        return load_fn(int(tmp_idx.numpy()))
+    
+    tmp_dataset = tf.data.Dataset.range(n_data)
+    if shuffle:
+        tmp_dataset = tmp_dataset.shuffle(
+            n_data, reshuffle_each_iteration=True)
+    if repeat:
+        tmp_dataset = tmp_dataset.repeat()
+    
+    tmp_dataset = tmp_dataset.map(
+        py_map_fn(_load_sample, load_signature), 
+        num_parallel_calls=n_parallel, deterministic=False)
+    tmp_dataset = tmp_dataset.map(
+        encode_fn, num_parallel_calls=n_parallel, deterministic=False)
+    if batch_size is not None:
+        tmp_dataset = tmp_dataset.batch(batch_size, drop_remainder=True)
+    
+    tmp_options = tf.data.Options()
+    tmp_options.autotune.enabled = True
+    tmp_dataset = tmp_dataset.with_options(tmp_options)
+    return tmp_dataset.prefetch(tf.data.AUTOTUNE)
+
+def build_augment_pipeline(
+    n_data, load_fn, load_signature, augment_fn, 
+    encode_fn, output_signature, aug_batch=16, 
+    shuffle=True, repeat=True, n_parallel=tf.data.AUTOTUNE):
+    """
+    Builds a tf.data pipeline which loads the samples in parallel, 
+    augments them a batch at a time in compiled graph code and then
+    encodes the targets of each augmented sample.
+    Arguments:
+      n_data: The number of training samples.
+      load_fn: A function which takes the index of a sample and
+        returns its (image, bbox, class_id, ...), where the images of
+        all samples have the same shape.
+      load_signature: The tuple of tf.TensorSpec of `load_fn`.
+      augment_fn: A function of the batched images and the ragged
+        boxes and class ids, e.g. `random_flip_horizontal_batch`, 
+        which returns them augmented using only tensor ops.
+      encode_fn: A function which takes the outputs of `augment_fn`
+        for a single sample and returns its prepared arrays.
+      output_signature: The (nested) tuple of tf.TensorSpec of the
+        outputs of `encode_fn`.
+      aug_batch: The number of samples augmented together.
+    Returns:
+      The tf.data.Dataset of the prepared samples.
+    """
+    def _load_sample(tmp_idx):
+        return load_fn(int(tmp_idx.numpy()))
+    
+    tmp_dataset = tf.data.Dataset.range(n_data)
+    if shuffle:
+        tmp_dataset = tmp_dataset.shuffle(
+            n_data, reshuffle_each_iteration=True)
+    if repeat:
+        tmp_dataset = tmp_dataset.repeat()
+    
+    tmp_dataset = tmp_dataset.map(
+        py_map_fn(_load_sample, load_signature), 
+        num_parallel_calls=n_parallel, deterministic=False)
+    tmp_dataset = tmp_dataset.ragged_batch(
+        aug_batch, drop_remainder=True)
+    tmp_dataset = tmp_dataset.map(
+        augment_fn, num_parallel_calls=n_parallel)
+    tmp_dataset = tmp_dataset.unbatch()
+    tmp_dataset = tmp_dataset.map(
+        py_map_fn(encode_fn, output_signature), 
+        num_parallel_calls=n_parallel, deterministic=False)
+    
+    tmp_options = tf.data.Options()
+    tmp_options.autotune.enabled = True
+    tmp_dataset = tmp_dataset.with_options(tmp_options)
+    return tmp_dataset.prefetch(tf.data.AUTOTUNE)
+
+def build_service_pipeline(
+    records, encode_fn, service=None, batch_size=None, 
+    shuffle=True, repeat=True, n_parallel=tf.data.AUTOTUNE):
+    """
+    Builds a tf.data pipeline made only of TF ops, which slices the
+    raw records of the samples from tensors instead of reading them
+    in Python, and then decodes and encodes them. As it has no
+    py_function, it can run on the workers of a tf.data service.
+    Arguments:
+      records: A tuple of the (ragged) tensors of the raw records of
+        all the samples, e.g. the image file names with their boxes
+        and class ids, which are sliced along the first dimension.
+      encode_fn: A function of the record of a sample which returns
+        the prepared tensors using only TF ops, e.g. one built on
+        `format_data_tf`.
+      service: If not None, a LocalDataService whose workers run the
+        pipeline, so that the trainer only reads its elements.
+      batch_size: If not None, the samples are batched. The outputs
+        of `encode_fn` must then have the same shape for all samples.
+    Returns:
+      The tf.data.Dataset of the prepared samples.
+    """
+    n_data = int(records[0].shape[0])
+    tmp_dataset = tf.data.Dataset.from_tensor_slices(records)
+    if shuffle:
+        tmp_dataset = tmp_dataset.shuffle(
+            n_data, reshuffle_each_iteration=True)
+    if repeat:
+        tmp_dataset = tmp_dataset.repeat()
+    
+    tmp_dataset = tmp_dataset.map(
+        encode_fn, num_parallel_calls=n_parallel, deterministic=False)
+    if batch_size is not None:
+        tmp_dataset = tmp_dataset.batch(batch_size, drop_remainder=True)
+    
+    tmp_options = tf.data.Options()
+    tmp_options.autotune.enabled = True
+    tmp_dataset = tmp_dataset.with_options(tmp_options)
+    if service is not None:
+        tmp_dataset = service.distribute(tmp_dataset)
+    return tmp_dataset.prefetch(tf.data.AUTOTUNE)
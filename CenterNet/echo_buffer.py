@@ -0,0 +1,112 @@
+import queue
+import threading
+import numpy as np
+
+# Marks the end of the source iterator. #
+_END = object()
+
+class EchoBuffer(object):
+    """
+    Iterator which echoes the prepared samples (or batches) of a
+    slower source, e.g. a decoding and encoding pipeline, so that
+    the training loop does not wait for the source. A background
+    thread reads the source ahead. A fresh element is returned
+    whenever one is ready and kept in a bounded replay buffer.
+    Otherwise a random element of the buffer that has been used
+    fewer than `echo_factor` times is returned again, after the
+    cheap `augment_fn`. The loop only waits for the source once
+    every buffered element has been used `echo_factor` times.
+    Arguments:
+      source: The iterable of the prepared elements.
+      echo_factor: The maximum number of times an element is used.
+      buffer_size: The maximum number of elements in the buffer.
+      augment_fn: If not None, a function applied to the echoed
+        elements, e.g. a flip or a jitter of the image which keeps
+        its encoded targets valid.
+      n_prefetch: The number of elements read ahead of the loop.
+      seed: The seed of the draws from the buffer.
+    """
+    def __init__(
+        self, source, echo_factor=2, buffer_size=256, 
+        augment_fn=None, n_prefetch=64, seed=None):
+        if echo_factor < 1:
+            raise ValueError("echo_factor has to be at least 1.")
+        
+        self.echo_factor = echo_factor
+        self.buffer_size = buffer_size
+        self.augment_fn  = augment_fn
+        self.rng = np.random.default_rng(seed)
+        
+        self.n_fresh = 0
+        self.n_echo  = 0
+        self.replay  = []
+        self.n_uses  = []
+        self.error = None
+        
+        self.source = iter(source)
+        self.fresh  = queue.Queue(maxsize=n_prefetch)
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+    
+    def _fill(self):
+        try:
+            for tmp_element in self.source:
+                self.fresh.put(tmp_element)
+        except Exception as tmp_error:
+            self.error = tmp_error
+        self.fresh.put(_END)
+        return None
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        try:
+            tmp_element = self.fresh.get_nowait()
+        except queue.Empty:
+            tmp_element = None
+        
+        if tmp_element is None:
+            # Echo a buffered element instead of waiting. #
+            tmp_index = [x for x in range(
+                len(self.replay)) if self.n_uses[x] < self.echo_factor]
+            if len(tmp_index) > 0:
+                n_index = tmp_index[self.rng.integers(len(tmp_index))]
+                self.n_uses[n_index] += 1
+                self.n_echo += 1
+                
+                tmp_element = self.replay[n_index]
+                if self.augment_fn is not None:
+                    tmp_element = self.augment_fn(tmp_element)
+                return tmp_element
+            tmp_element = self.fresh.get()
+        
+        if tmp_element is _END:
+            # Keep the end marker for any further calls. #
+            self.fresh.put(_END)
+            if self.error is not None:
+                raise self.error
+            raise StopIteration
+        
+        # Replace the most used element once the buffer is full. #
+        self.n_fresh += 1
+        if len(self.replay) < self.buffer_size:
+            self.replay.append(tmp_element)
+            self.n_uses.append(1)
+        else:
+            n_index = int(np.argmax(self.n_uses))
+            self.replay[n_index] = tmp_element
+            self.n_uses[n_index] = 1
+        return tmp_element
+    
+    def echo_ratio(self):
+        """
+        Returns the effective echo factor, the number of elements
+        returned per fresh element of the source.
+        """
+        return (self.n_fresh + self.n_echo) / max(self.n_fresh, 1)
+    
+    def report(self):
+        print("Echo Factor:", str(round(self.echo_ratio(), 2)), 
+              "(" + str(self.n_fresh), "fresh,", 
+              str(self.n_echo), "echoed).")
@@ -2,6 +2,7 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
+from utils import last_unique_index, uint8_image_input
 
 def center_dist_1d(grid_x, mu_x=0.0, spread=2.0):
     gauss_x = np.divide(
@@ -40,9 +41,11 @@ def center_dist_2d(
 #    return dist_unnorm / Z_normalise
 
 def build_model(
-    num_classes, backbone_model="resnet50"):
+    num_classes, backbone_model="resnet50", uint8_input=False):
     """
     Builds Backbone Model with pre-trained imagenet weights.
+    If uint8_input is True, the model takes uint8 images and
+    normalizes them in its graph, the same as the loaders.
     """
     # Define the focal loss bias. #
     b_focal = tf.constant_initializer(
@@ -62,16 +65,24 @@ def build_model(
             activation=None, use_bias=False, 
             name="reg_layer_" + str(n_layer+1)))
     
+    # Normalize the uint8 images in the graph. #
+    if uint8_input:
+        _, x_image = uint8_image_input()
+    else:
+        x_image = None
+    
     # Backbone Network. #
     if backbone_model.lower() == "resnet50":
         backbone = tf.keras.applications.ResNet50(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", "conv4_block6_out", "conv5_block3_out"]
     else:
         backbone = tf.keras.applications.MobileNetV2(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "block_6_expand", "block_13_expand", "Conv_1"]
@@ -341,6 +352,133 @@ def format_data(
                 tmp_y_cen, tmp_x_cen, idx_class] = 1
     return tmp_output
 
+def format_data_tf(
+    gt_labels, img_dim, num_classes, 
+    img_pad=None, stride=8, sigma=0.25):
+    """
+    Graph version of format_data using only TF ops, so that it can
+    run inside tf.function and parallel tf.data map stages. All the
+    grid cells of all the boxes are expanded at once, and the
+    center-distance weights of center_dist_2d are normalised over
+    the cells of each box.
+    Arguments:
+      gt_labels: The (N, 5) tensor of the normalised boxes (y, x, h, w)
+        and classes of one sample, e.g. a row of a ragged batch. Rows
+        with a non-positive height or width are treated as padding.
+      img_dim: The image dimensions as Python numbers.
+      img_pad: The padded image dimensions as Python numbers.
+    Returns:
+      The float32 target map.
+    """
+    if img_pad is None:
+        img_pad = img_dim
+    
+    h_out = int(img_pad[0] / stride)
+    w_out = int(img_pad[1] / stride)
+    h_lim = int(img_dim[0] / stride)
+    w_lim = int(img_dim[1] / stride)
+    h_ratio = img_dim[0] / stride
+    w_ratio = img_dim[1] / stride
+    tmp_std = 8.0
+    
+    tmp_labels = tf.cast(gt_labels, tf.float64)
+    tmp_labels = tf.boolean_mask(tmp_labels, tf.logical_and(
+        tmp_labels[:, 2] > 0.0, tmp_labels[:, 3] > 0.0))
+    
+    # Sort the labels by area in the same order as format_data, #
+    # so that the last box of a grid cell takes its targets.    #
+    tmp_box_areas = tf.multiply(
+        tmp_labels[:, 2]*img_dim[0], tmp_labels[:, 3]*img_dim[1])
+    tmp_sorted = tf.gather(
+        tmp_labels, tf.argsort(tmp_box_areas, stable=True))
+    n_labels = tf.shape(tmp_sorted)[0]
+    
+    y_low = (tmp_sorted[:, 0] - 0.5*tmp_sorted[:, 2])*img_dim[0]
+    x_low = (tmp_sorted[:, 1] - 0.5*tmp_sorted[:, 3])*img_dim[1]
+    y_upp = (tmp_sorted[:, 0] + 0.5*tmp_sorted[:, 2])*img_dim[0]
+    x_upp = (tmp_sorted[:, 1] + 0.5*tmp_sorted[:, 3])*img_dim[1]
+    idx_class = tf.cast(tmp_sorted[:, 4], tf.int32)
+    
+    # Casting truncates towards zero like int(). #
+    tmp_y_cen = tf.clip_by_value(tf.cast(
+        tmp_sorted[:, 0] * h_ratio, tf.int32), 0, h_out-1)
+    tmp_x_cen = tf.clip_by_value(tf.cast(
+        tmp_sorted[:, 1] * w_ratio, tf.int32), 0, w_out-1)
+    
+    tmp_y_low = tf.maximum(0, 1 + tf.cast(
+        (tmp_sorted[:, 0]-sigma*tmp_sorted[:, 2]/2) * h_ratio, tf.int32))
+    tmp_x_low = tf.maximum(0, 1 + tf.cast(
+        (tmp_sorted[:, 1]-sigma*tmp_sorted[:, 3]/2) * w_ratio, tf.int32))
+    tmp_y_upp = tf.minimum(h_lim, 1 + tf.cast(
+        (tmp_sorted[:, 0]+sigma*tmp_sorted[:, 2]/2) * h_ratio, tf.int32))
+    tmp_x_upp = tf.minimum(w_lim, 1 + tf.cast(
+        (tmp_sorted[:, 1]+sigma*tmp_sorted[:, 3]/2) * w_ratio, tf.int32))
+    
+    # A box covers the rows of its (low, upp) range if it is not #
+    # empty, otherwise only the row of its center, and likewise  #
+    # for the columns. This covers all four cases of the loop.   #
+    y_span = tmp_y_upp > tmp_y_low
+    x_span = tmp_x_upp > tmp_x_low
+    row_st = tf.where(y_span, tmp_y_low, tmp_y_cen)
+    col_st = tf.where(x_span, tmp_x_low, tmp_x_cen)
+    n_rows = tf.where(y_span, tmp_y_upp - tmp_y_low, 1)
+    n_cols = tf.where(x_span, tmp_x_upp - tmp_x_low, 1)
+    new_y_cen = tf.where(y_span, (tmp_y_low + tmp_y_upp) // 2, tmp_y_cen)
+    new_x_cen = tf.where(x_span, (tmp_x_low + tmp_x_upp) // 2, tmp_x_cen)
+    
+    # Expand every box into its grid cells. #
+    n_cells  = n_rows * n_cols
+    box_idx  = tf.repeat(tf.range(n_labels), n_cells)
+    cell_off = tf.range(tf.reduce_sum(n_cells)) - tf.repeat(
+        tf.cumsum(n_cells, exclusive=True), n_cells)
+    
+    box_cols = tf.gather(n_cols, box_idx)
+    grid_row = tf.gather(row_st, box_idx) + cell_off // box_cols
+    grid_col = tf.gather(col_st, box_idx) + cell_off % box_cols
+    grid_y = tf.cast(grid_row, tf.float64) + 0.5
+    grid_x = tf.cast(grid_col, tf.float64) + 0.5
+    
+    reg_targets = tf.maximum(tf.stack([
+        grid_y - tf.gather(y_low, box_idx)/stride, 
+        tf.gather(y_upp, box_idx)/stride - grid_y, 
+        grid_x - tf.gather(x_low, box_idx)/stride, 
+        tf.gather(x_upp, box_idx)/stride - grid_x], axis=1), 0.0)
+    
+    # Center-distance weights along the spanned axes, normalised #
+    # by their maximum over the cells of each box. The center    #
+    # cell of the box is then set to 1.                          #
+    cell_y_cen = tf.gather(new_y_cen, box_idx)
+    cell_x_cen = tf.gather(new_x_cen, box_idx)
+    cen_weight = tf.multiply(
+        tf.where(tf.gather(y_span, box_idx), 1.0 / tf.pow(
+            grid_y - tf.cast(cell_y_cen, tf.float64), tmp_std), 1.0), 
+        tf.where(tf.gather(x_span, box_idx), 1.0 / tf.pow(
+            grid_x - tf.cast(cell_x_cen, tf.float64), tmp_std), 1.0))
+    cen_weight = cen_weight / tf.gather(
+        tf.math.unsorted_segment_max(
+            cen_weight, box_idx, n_labels), box_idx)
+    cen_weight = tf.where(tf.logical_and(
+        tf.equal(grid_row, cell_y_cen), 
+        tf.equal(grid_col, cell_x_cen)), 
+        tf.ones_like(cen_weight), cen_weight)
+    
+    # The regression and centerness targets of a cell come from #
+    # its last box, while the class channels of all its boxes   #
+    # are set.                                                  #
+    cell_idx = tf.stack([grid_row, grid_col], axis=1)
+    last_idx = last_unique_index(grid_row*w_out + grid_col)
+    reg_output = tf.scatter_nd(
+        tf.gather(cell_idx, last_idx), tf.cast(tf.gather(tf.concat([
+            reg_targets, tf.expand_dims(cen_weight, 1)], axis=1), 
+            last_idx), tf.float32), [h_out, w_out, 5])
+    
+    cell_class = tf.gather(idx_class, box_idx)
+    cls_output = tf.minimum(tf.scatter_nd(
+        tf.concat([cell_idx, tf.expand_dims(cell_class, 1)], axis=1), 
+        tf.ones_like(cell_class, dtype=tf.float32), 
+        [h_out, w_out, num_classes]), 1.0)
+    return tf.concat([reg_output, cls_output], axis=2)
+
 def smooth_l1_loss(xy_true, xy_pred, mask=1.0, delta=1.0):
     mask = tf.expand_dims(mask, axis=-1)
     raw_diff = xy_true - xy_pred
@@ -1,6 +1,8 @@
 import numpy as np
 import tensorflow as tf
 from tf_bias_layer import BiasLayer
+from utils import last_unique_index, decode_jpeg_scaled
+from utils import uint8_image_input, model_input
 from tensorflow.keras import layers
 
 from PIL import Image
@@ -9,10 +11,8 @@ import matplotlib.pyplot as plt
 def _parse_image(
     filename, img_rows=448, img_cols=448):
     image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    image_decoded = \
-        tf.image.convert_image_dtype(image_decoded, tf.float32)
+    image_decoded = decode_jpeg_scaled(
+        image_string, min_side=max(img_rows, img_cols))
     image_resized = tf.image.resize(
         image_decoded, [img_rows, img_cols])
     image_resized = tf.ensure_shape(
@@ -163,14 +163,21 @@ def downsample_block(x_cnn_input, name="max_pool"):
 def build_model(
     n_classes, tmp_pi=0.99, n_filters=128, 
     n_stacks=1, n_repeats=2, seperable=True, 
-    batch_norm=True, norm_order="norm_first"):
+    batch_norm=True, norm_order="norm_first", uint8_input=False):
     tmp_b = tf.math.log((1.0-tmp_pi)/tmp_pi)
     
     b_focal = BiasLayer(
         bias_init=tmp_b, 
         trainable=True, name="b_focal")
-    x_input = tf.keras.Input(
-        shape=(None, None, 3), name="x_input")
+    
+    # Normalize the uint8 images in the graph. #
+    if uint8_input:
+        x_input, x_image = uint8_image_input(
+            scale=1.0/255.0, offset=0.0)
+    else:
+        x_input = tf.keras.Input(
+            shape=(None, None, 3), name="x_input")
+        x_image = x_input
     
     # Block 0. #
     kernel_sz_0 = (7,7)
@@ -178,12 +185,12 @@ def build_model(
         x_blk0_out = layers.SeparableConv2D(
             n_filters, kernel_sz_0, 
             strides=(2,2), padding="same", 
-            activation=None, name="cnn_block_0")(x_input)
+            activation=None, name="cnn_block_0")(x_image)
     else:
         x_blk0_out = layers.Conv2D(
             n_filters, kernel_sz_0, 
             strides=(2,2), padding="same", 
-            activation=None, name="cnn_block_0")(x_input)
+            activation=None, name="cnn_block_0")(x_image)
     
     # Process one more time. #
     x_cnn1_out = cnn_block(
@@ -455,6 +462,78 @@ def format_data(
         num_targets = len(tmp_labels)
     return tmp_output, num_targets
 
+def format_data_tf(
+    gt_labels, img_dim, 
+    num_classes, img_pad=None, stride=8):
+    """
+    Graph version of format_data using only TF ops, so that it can
+    run inside tf.function and parallel tf.data map stages.
+    Arguments:
+      gt_labels: The (N, 5) tensor of the normalised boxes (y, x, h, w)
+        and classes of one sample, e.g. a row of a ragged batch. Rows
+        with a non-positive height or width are treated as padding.
+      img_dim: The image dimensions as Python numbers.
+      img_pad: The padded image dimensions as Python numbers.
+    Returns:
+      The float32 target map and the number of targets.
+    """
+    if img_pad is None:
+        img_pad = img_dim
+    
+    # Format the ground truth map. #
+    h_max = int(img_pad[1] / stride)
+    w_max = int(img_pad[0] / stride)
+    pad_y = float(int((img_pad[1] - img_dim[1]) / 2.0))
+    pad_x = float(int((img_pad[0] - img_dim[0]) / 2.0))
+    
+    tmp_labels = tf.cast(gt_labels, tf.float64)
+    tmp_labels = tf.boolean_mask(tmp_labels, tf.logical_and(
+        tmp_labels[:, 2] > 0.0, tmp_labels[:, 3] > 0.0))
+    
+    # Sort the labels by area in the same order as format_data, #
+    # so that the last box of a grid cell takes its offsets.    #
+    tmp_box_areas = tf.multiply(
+        tmp_labels[:, 2]*img_dim[0], tmp_labels[:, 3]*img_dim[1])
+    tmp_sorted = tf.gather(
+        tmp_labels, tf.argsort(tmp_box_areas, stable=True))
+    
+    y_low = (tmp_sorted[:, 0] - 0.5*tmp_sorted[:, 2])*img_dim[0]
+    x_low = (tmp_sorted[:, 1] - 0.5*tmp_sorted[:, 3])*img_dim[1]
+    y_upp = (tmp_sorted[:, 0] + 0.5*tmp_sorted[:, 2])*img_dim[0]
+    x_upp = (tmp_sorted[:, 1] + 0.5*tmp_sorted[:, 3])*img_dim[1]
+    
+    # Casting truncates towards zero like int(). #
+    tmp_y_cen = tf.clip_by_value(tf.cast(
+        (pad_y + (y_low + y_upp) / 2.0) / stride, tf.int32), 0, h_max-1)
+    tmp_x_cen = tf.clip_by_value(tf.cast(
+        (pad_x + (x_low + x_upp) / 2.0) / stride, tf.int32), 0, w_max-1)
+    idx_class = tf.cast(tmp_sorted[:, 4], tf.int32)
+    
+    # Set bounding box coordinates. #
+    cen_y = tf.cast(tmp_y_cen, tf.float64)
+    cen_x = tf.cast(tmp_x_cen, tf.float64)
+    box_offsets = tf.stack([
+        cen_y + 0.5 - (pad_y + y_low)/stride, 
+        (pad_y + y_upp)/stride - cen_y - 0.5, 
+        cen_x + 0.5 - (pad_x + x_low)/stride, 
+        (pad_x + x_upp)/stride - cen_x - 0.5], axis=1)
+    
+    # The offsets of a cell come from its last box, while the #
+    # class channels of all its boxes are set.                 #
+    cell_idx = tf.stack([tmp_y_cen, tmp_x_cen], axis=1)
+    last_idx = last_unique_index(tmp_y_cen*w_max + tmp_x_cen)
+    reg_output = tf.scatter_nd(
+        tf.gather(cell_idx, last_idx), tf.cast(tf.gather(
+            box_offsets, last_idx), tf.float32), [h_max, w_max, 4])
+    cls_output = tf.minimum(tf.scatter_nd(
+        tf.concat([cell_idx, tf.expand_dims(idx_class, 1)], axis=1), 
+        tf.ones_like(idx_class, dtype=tf.float32), 
+        [h_max, w_max, num_classes]), 1.0)
+    
+    tmp_output  = tf.concat([reg_output, cls_output], axis=2)
+    num_targets = tf.shape(tmp_labels)[0]
+    return tmp_output, num_targets
+
 def smooth_l1_loss(xy_true, xy_pred, mask=1.0, delta=1.0):
     mask = tf.expand_dims(mask, axis=-1)
     raw_diff = xy_true - xy_pred
@@ -570,8 +649,9 @@ def obj_detect_results(
     img_title=None, img_rows=448, img_cols=448, 
     save_img_file="object_detection_result.jpg"):
     # Read the image. #
-    image_resized = _parse_image(
-        img_in_file, img_rows=img_rows, img_cols=img_cols)
+    image_resized = model_input(_parse_image(
+        img_in_file, img_rows=img_rows, img_cols=img_cols), 
+        voc_model, scale=1.0/255.0, offset=0.0)
     
     tmp_output = voc_model.predict(
         tf.expand_dims(image_resized, axis=0))
@@ -2,6 +2,8 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
+from utils import last_unique_index, decode_jpeg_scaled
+from utils import uint8_image_input, model_input
 
 from PIL import Image
 import matplotlib.pyplot as plt
@@ -9,10 +11,8 @@ import matplotlib.pyplot as plt
 def _parse_image(
     filename, img_rows=448, img_cols=448):
     image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    image_decoded = tf.cast(image_decoded, tf.float32)
-    image_decoded = image_decoded / 255.0
+    image_decoded = decode_jpeg_scaled(
+        image_string, min_side=max(img_rows, img_cols))
     image_resized = tf.image.resize(
         image_decoded, [img_rows, img_cols])
     image_resized = tf.ensure_shape(
@@ -85,9 +85,12 @@ def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
     return best_bboxes
 
 def build_model(
-    num_classes, n_scales=5, backbone_model="resnet50"):
+    num_classes, n_scales=5, 
+    backbone_model="resnet50", uint8_input=False):
     """
     Builds Backbone Model with pre-trained imagenet weights.
+    If uint8_input is True, the model takes uint8 images and
+    normalizes them in its graph, the same as the loaders.
     """
     # Define the focal loss bias. #
     b_focal = tf.constant_initializer(
@@ -107,24 +110,33 @@ def build_model(
             activation=None, use_bias=False, 
             name="reg_layer_" + str(n_layer+1)))
     
+    # Normalize the uint8 images in the graph. #
+    if uint8_input:
+        _, x_image = uint8_image_input(scale=1.0/255.0, offset=0.0)
+    else:
+        x_image = None
+    
     # Backbone Network. #
     if backbone_model.lower() == "resnet50":
         backbone = tf.keras.applications.ResNet50(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", 
             "conv4_block6_out", "conv5_block3_out"]
     if backbone_model.lower() == "resnet101":
         backbone = tf.keras.applications.ResNet101(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", 
             "conv4_block23_out", "conv5_block3_out"]
     else:
         backbone = tf.keras.applications.MobileNetV2(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "block_6_expand", "block_13_expand", "Conv_1"]
@@ -329,6 +341,94 @@ def format_data(
         num_targets = len(tmp_labels)
     return tmp_output, num_targets
 
+def format_data_tf(
+    gt_labels, box_scales, img_dim, 
+    num_classes, img_pad=None, stride=8):
+    """
+    Graph version of format_data using only TF ops, so that it can
+    run inside tf.function and parallel tf.data map stages. Boxes
+    which are not smaller than the largest scale take that scale.
+    Arguments:
+      gt_labels: The (N, 5) tensor of the normalised boxes (y, x, h, w)
+        and classes of one sample, e.g. a row of a ragged batch. Rows
+        with a non-positive height or width are treated as padding.
+      box_scales: The box scales in ascending order.
+      img_dim: The image dimensions as Python numbers.
+      img_pad: The padded image dimensions as Python numbers.
+    Returns:
+      The float32 target map and the number of targets.
+    """
+    if img_pad is None:
+        img_pad = img_dim
+    
+    # Format the ground truth map. #
+    h_max = int(img_pad[1] / stride)
+    w_max = int(img_pad[0] / stride)
+    pad_y = float(int((img_pad[1] - img_dim[1]) / 2.0))
+    pad_x = float(int((img_pad[0] - img_dim[0]) / 2.0))
+    num_scales = len(box_scales)
+    
+    tmp_labels = tf.cast(gt_labels, tf.float64)
+    tmp_labels = tf.boolean_mask(tmp_labels, tf.logical_and(
+        tmp_labels[:, 2] > 0.0, tmp_labels[:, 3] > 0.0))
+    
+    # Sort the labels by area in the same order as format_data, #
+    # so that the last box of a grid cell takes its offsets.    #
+    tmp_box_areas = tf.multiply(
+        tmp_labels[:, 2]*img_dim[0], tmp_labels[:, 3]*img_dim[1])
+    tmp_sorted = tf.gather(
+        tmp_labels, tf.argsort(tmp_box_areas, stable=True))
+    
+    y_low = (tmp_sorted[:, 0] - 0.5*tmp_sorted[:, 2])*img_dim[0]
+    x_low = (tmp_sorted[:, 1] - 0.5*tmp_sorted[:, 3])*img_dim[1]
+    y_upp = (tmp_sorted[:, 0] + 0.5*tmp_sorted[:, 2])*img_dim[0]
+    x_upp = (tmp_sorted[:, 1] + 0.5*tmp_sorted[:, 3])*img_dim[1]
+    
+    # The scale of a box is the smallest one above its largest #
+    # side, i.e. the number of scales which are not above it.  #
+    box_h = y_upp - y_low
+    box_w = x_upp - x_low
+    tmp_scales = tf.constant(box_scales, dtype=tf.float64)
+    id_sc = tf.searchsorted(
+        tmp_scales, tf.maximum(box_h, box_w), 
+        side="right", out_type=tf.int32)
+    id_sc = tf.minimum(id_sc, num_scales-1)
+    tmp_scale = tf.gather(tmp_scales, id_sc)
+    
+    # Casting truncates towards zero like int(). #
+    raw_y_cen = (y_low + y_upp) / 2.0
+    raw_x_cen = (x_low + x_upp) / 2.0
+    tmp_y_cen = tf.clip_by_value(tf.cast(
+        (pad_y + raw_y_cen) / stride, tf.int32), 0, h_max-1)
+    tmp_x_cen = tf.clip_by_value(tf.cast(
+        (pad_x + raw_x_cen) / stride, tf.int32), 0, w_max-1)
+    idx_class = tf.cast(tmp_sorted[:, 4], tf.int32)
+    
+    # Compute the bounding box offsets. #
+    tmp_y_off = pad_y + raw_y_cen - tf.cast(tmp_y_cen*stride, tf.float64)
+    tmp_x_off = pad_x + raw_x_cen - tf.cast(tmp_x_cen*stride, tf.float64)
+    box_offsets = tf.stack([
+        tmp_y_off / stride, tmp_x_off / stride, 
+        box_h / tmp_scale, box_w / tmp_scale], axis=1)
+    
+    # The offsets of a cell and scale come from its last box, #
+    # while the class channels of all its boxes are set.      #
+    cell_idx = tf.stack([tmp_y_cen, tmp_x_cen, id_sc], axis=1)
+    last_idx = last_unique_index(
+        (tmp_y_cen*w_max + tmp_x_cen)*num_scales + id_sc)
+    reg_output = tf.scatter_nd(
+        tf.gather(cell_idx, last_idx), tf.cast(tf.gather(
+            box_offsets, last_idx), tf.float32), 
+        [h_max, w_max, num_scales, 4])
+    cls_output = tf.minimum(tf.scatter_nd(
+        tf.concat([cell_idx, tf.expand_dims(idx_class, 1)], axis=1), 
+        tf.ones_like(idx_class, dtype=tf.float32), 
+        [h_max, w_max, num_scales, num_classes]), 1.0)
+    
+    tmp_output  = tf.concat([reg_output, cls_output], axis=3)
+    num_targets = tf.shape(tmp_labels)[0]
+    return tmp_output, num_targets
+
 def smooth_l1_loss(
     xy_true, xy_pred, mask=1.0, delta=1.0):
     mask = tf.expand_dims(mask, axis=-1)
@@ -450,8 +550,9 @@ def obj_detect_results(
     img_title=None, img_rows=448, img_cols=448, 
     save_img_file="object_detection_result.jpg"):
     # Read the image. #
-    image_resized = _parse_image(
-        img_in_file, img_rows=img_rows, img_cols=img_cols)
+    image_resized = model_input(_parse_image(
+        img_in_file, img_rows=img_rows, img_cols=img_cols), 
+        model, scale=1.0/255.0, offset=0.0)
     
     tmp_output = model.predict(
         tf.expand_dims(image_resized, axis=0))
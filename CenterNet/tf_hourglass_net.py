@@ -2,6 +2,7 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
 from tf_bias_layer import BiasLayer
+from utils import decode_jpeg_scaled, uint8_image_input, model_input
 
 from PIL import Image
 import matplotlib.pyplot as plt
@@ -9,10 +10,8 @@ import matplotlib.pyplot as plt
 def _parse_image(
     filename, img_rows=448, img_cols=448):
     image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    image_decoded = tf.cast(image_decoded, tf.float32)
-    image_decoded = image_decoded / 127.5 - 1.0
+    image_decoded = decode_jpeg_scaled(
+        image_string, min_side=max(img_rows, img_cols))
     image_resized = tf.image.resize(
         image_decoded, [img_rows, img_cols])
     image_resized = tf.ensure_shape(
@@ -115,14 +114,21 @@ def downsample_block(
 def build_model(
     n_filters, n_classes, tmp_pi=0.99, 
     n_repeats=2, n_features=256, seperable=True, 
-    batch_norm=True, norm_order="norm_first"):
+    batch_norm=True, norm_order="norm_first", uint8_input=False):
     tmp_b = tf.math.log((1.0-tmp_pi)/tmp_pi)
     
     b_focal = BiasLayer(
         bias_init=tmp_b, 
         trainable=True, name="b_focal")
-    x_input = tf.keras.Input(
-        shape=(None, None, 3), name="x_input")
+    
+    # Normalize the uint8 images in the graph. #
+    if uint8_input:
+        x_input, x_image = uint8_image_input(
+            scale=1.0/255.0, offset=0.0)
+    else:
+        x_input = tf.keras.Input(
+            shape=(None, None, 3), name="x_input")
+        x_image = x_input
     x_shape = tf.shape(x_input)
     
     batch_size = x_shape[0]
@@ -134,12 +140,12 @@ def build_model(
         x_blk0_out = layers.SeparableConv2D(
             n_filters, (3,3), strides=(1,1), 
             padding="same", activation=None, 
-            name="cnn_block_0")(x_input)
+            name="cnn_block_0")(x_image)
     else:
         x_blk0_out = layers.Conv2D(
             n_filters, (3,3), strides=(1,1), 
             padding="same", activation=None, 
-            name="cnn_block_0")(x_input)
+            name="cnn_block_0")(x_image)
     
     # Encoder Block. #
     # Block 1. #
@@ -465,8 +471,9 @@ def obj_detect_results(
             raise ValueError("img_scale must be size 4.")
     
     # Read the image. #
-    image_resized = tf.expand_dims(_parse_image(
-        img_in_file, img_rows=img_rows, img_cols=img_cols), axis=0)
+    image_resized = tf.expand_dims(model_input(_parse_image(
+        img_in_file, img_rows=img_rows, img_cols=img_cols), 
+        voc_model, scale=1.0/127.5, offset=-1.0), axis=0)
     
     tmp_output = \
         voc_model.predict(image_resized)
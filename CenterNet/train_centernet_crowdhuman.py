@@ -5,23 +5,141 @@ import pickle as pkl
 
 import tensorflow as tf
 import tf_centernet_resnet_s8 as tf_obj_detector
-from data_preprocess import random_flip_horizontal
+from data_preprocess import random_flip_horizontal, random_jitter_image
 from data_preprocess import swap_xy, convert_to_xywh
+from utils import decode_jpeg_scaled, quantize_image
+from data_pipeline import build_pipeline, build_graph_pipeline
+from data_pipeline import build_service_pipeline
+from data_service import LocalDataService
+from target_cache import TargetCache
+from epoch_sampler import EpochSampler
+from echo_buffer import EchoBuffer
 
 # Custom function to parse the data. #
 def _parse_image(
-    filename, img_rows=448, img_cols=448):
+    filename, img_rows=448, img_cols=448, normalize=True):
     image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    image_decoded = tf.cast(image_decoded, tf.float32)
-    image_decoded = image_decoded / 255.0
+    image_decoded = decode_jpeg_scaled(
+        image_string, min_side=max(img_rows, img_cols))
     image_resized = tf.image.resize(
         image_decoded, [img_rows, img_cols])
+    if normalize:
+        image_resized = image_resized / 255.0
+    else:
+        image_resized = quantize_image(image_resized)
     image_resized = tf.ensure_shape(
         image_resized ,shape=(img_rows, img_cols, 3))
     return image_resized
 
+def prepare_sample(
+    sample, n_classes, box_scales, raw_dims, img_dims, 
+    target_cache=None, normalize=True):
+    """
+    Returns the resized, flipped and padded image of the sample
+    with its CenterNet targets. If a TargetCache is given, the
+    flip is drawn here so that it keys the cached targets. If
+    normalize is False, the image is uint8.
+    """
+    pad_dims = int((img_dims - raw_dims) / 2.0)
+    sc_dims  = [raw_dims, raw_dims]
+    img_pad  = [img_dims, img_dims]
+    
+    tmp_image = _parse_image(
+        sample["image"], img_rows=raw_dims, 
+        img_cols=raw_dims, normalize=normalize)
+    tmp_bbox  = np.array(sample["objects"]["bbox"])
+    tmp_class = np.array(sample["objects"]["label"])
+    tmp_class = np.expand_dims(tmp_class, axis=1)
+    
+    flip_flag = None
+    if target_cache is not None:
+        flip_flag = np.random.uniform() <= 0.5
+    
+    tmp_tuple = random_flip_horizontal(
+        tmp_image, tmp_bbox, flip_flag=flip_flag)
+    tmp_image = tmp_tuple[0]
+    
+    tmp_bbox = tmp_tuple[1]
+    tmp_bbox = swap_xy(tmp_bbox)
+    tmp_bbox = convert_to_xywh(tmp_bbox)
+    
+    tmp_image = tf.image.pad_to_bounding_box(
+        tmp_image, pad_dims, pad_dims, img_dims, img_dims)
+    gt_labels = np.concatenate(tuple([
+        tmp_bbox, tmp_class]), axis=1)
+    gt_labels = tf.constant(gt_labels)
+    del tmp_tuple
+    
+    def _encode():
+        tmp_tuple = tf_obj_detector.format_data(
+            gt_labels, box_scales, sc_dims, 
+            n_classes, img_pad=img_pad, stride=8)
+        return tmp_tuple[0]
+    
+    if target_cache is None:
+        tmp_boxes = _encode()
+    else:
+        tmp_key = target_cache.make_key(
+            sample, sc_dims, img_pad, flip_flag)
+        tmp_boxes = target_cache.encode(tmp_key, _encode)
+    return tmp_image, tmp_boxes
+
+def prepare_sample_tf(
+    filename, tmp_bbox, tmp_class, n_classes, 
+    box_scales, raw_dims, img_dims, normalize=True):
+    """
+    Graph version of prepare_sample, which decodes, flips and pads
+    the image and encodes its targets using only TF ops.
+    """
+    pad_dims = int((img_dims - raw_dims) / 2.0)
+    sc_dims  = [raw_dims, raw_dims]
+    img_pad  = [img_dims, img_dims]
+    
+    tmp_image = _parse_image(
+        filename, img_rows=raw_dims, 
+        img_cols=raw_dims, normalize=normalize)
+    tmp_image, tmp_bbox = random_flip_horizontal(tmp_image, tmp_bbox)
+    tmp_bbox  = convert_to_xywh(swap_xy(tmp_bbox))
+    tmp_image = tf.image.pad_to_bounding_box(
+        tmp_image, pad_dims, pad_dims, img_dims, img_dims)
+    
+    tmp_class = tf.cast(tf.expand_dims(tmp_class, axis=1), tf.float32)
+    gt_labels = tf.concat([tmp_bbox, tmp_class], axis=1)
+    tmp_tuple = tf_obj_detector.format_data_tf(
+        gt_labels, box_scales, sc_dims, 
+        n_classes, img_pad=img_pad, stride=8)
+    return tmp_image, tmp_tuple[0]
+
+def echo_batch(tmp_batch):
+    """
+    Returns a prepared batch with a fresh jitter of each image. The
+    targets are transposed to the image, so they are not flipped.
+    """
+    img_batch, img_boxes, batch_sample = tmp_batch
+    img_batch = random_jitter_image(
+        img_batch, max_delta=0.05, value_range=[0.0, 1.0])
+    return img_batch, img_boxes, batch_sample
+
+def format_display(sample, n_classes, box_scales, img_dims):
+    """
+    Returns the targets of the unflipped sample for display.
+    """
+    img_pad   = [img_dims, img_dims]
+    tmp_bbox  = np.array(sample["objects"]["bbox"])
+    tmp_class = np.array(sample["objects"]["label"])
+    tmp_class = np.expand_dims(tmp_class, axis=1)
+    
+    disp_bbox = swap_xy(tmp_bbox)
+    disp_bbox = convert_to_xywh(disp_bbox)
+    disp_label = np.concatenate(tuple([
+        disp_bbox, tmp_class]), axis=1)
+    disp_label = tf.constant(disp_label)
+    
+    disp_tuple = tf_obj_detector.format_data(
+        disp_label, box_scales, img_pad, 
+        n_classes, img_pad=img_pad, stride=8)
+    return disp_tuple
+
 def train(
     model, n_classes, img_dims, 
     sub_batch_sz, batch_size, box_scales, 
@@ -29,8 +147,12 @@ def train(
     ckpt, ck_manager, label_dict, init_lr=1.0e-3, min_lr=1e-6, 
     downsample=32, use_scale=False, min_scale=0.7, decay=0.75, 
     display_step=100, step_cool=50, base_rows=320, base_cols=320, 
-    thresh=0.50, save_flag=False, train_loss_log="train_losses.csv"):
+    thresh=0.50, save_flag=False, 
+    train_loss_log="train_losses.csv", 
+    data_iter=None, target_cache=None, sampler=None):
     n_data = len(train_data)
+    if sampler is None:
+        sampler = EpochSampler(n_data, batch_size)
     base_dims = min(base_rows, base_cols)
     max_scale = img_dims / base_dims
     
@@ -46,80 +168,47 @@ def train(
             lrate = init_lr / 100.0
         lrate = max(lrate, min_lr)
         
-        batch_sample = np.random.choice(
-            n_data, size=batch_size, replace=False)
-        
-        # Use only one image resolution to train. #
-        if use_scale:
-            rnd_scale = np.random.uniform(
-                low=min_scale, high=max_scale)
+        if data_iter is not None:
+            # The pipeline yields the prepared batch. #
+            img_batch, img_boxes, batch_sample = next(data_iter)
+            batch_sample = batch_sample.numpy()
         else:
-            rnd_scale = max_scale
-        
-        raw_dims = int(rnd_scale * base_dims)
-        pad_dims = int((img_dims - raw_dims) / 2.0)
-        sc_dims  = [raw_dims, raw_dims]
-        img_pad  = [img_dims, img_dims]
-        
-        img_boxes = []
-        img_batch = []
-        for tmp_idx in batch_sample:
-            tmp_image = _parse_image(
-                train_data[tmp_idx]["image"], 
-                img_rows=raw_dims, img_cols=raw_dims)
-            tmp_bbox  = np.array(train_data[
-                tmp_idx]["objects"]["bbox"])
-            tmp_class = np.array(train_data[
-                tmp_idx]["objects"]["label"])
-            tmp_class = np.expand_dims(tmp_class, axis=1)
-            
-            disp_bbox = swap_xy(tmp_bbox)
-            disp_bbox = convert_to_xywh(disp_bbox)
-            disp_label = np.concatenate(tuple([
-                disp_bbox, tmp_class]), axis=1)
-            disp_label = tf.constant(disp_label)
-            del disp_bbox
-            
-            disp_tuple = tf_obj_detector.format_data(
-                disp_label, box_scales, img_pad, 
-                n_classes, img_pad=img_pad, stride=8)
+            batch_sample = sampler.next_batch()
             
-            tmp_tuple = \
-                random_flip_horizontal(tmp_image, tmp_bbox)
-            tmp_image = tmp_tuple[0]
+            # Use only one image resolution to train. #
+            if use_scale:
+                rnd_scale = np.random.uniform(
+                    low=min_scale, high=max_scale)
+            else:
+                rnd_scale = max_scale
+            raw_dims = int(rnd_scale * base_dims)
             
-            tmp_bbox = tmp_tuple[1]
-            tmp_bbox = swap_xy(tmp_bbox)
-            tmp_bbox = convert_to_xywh(tmp_bbox)
-            
-            tmp_image = tf.image.pad_to_bounding_box(
-                tmp_image, pad_dims, pad_dims, img_dims, img_dims)
-            gt_labels = np.concatenate(tuple([
-                tmp_bbox, tmp_class]), axis=1)
-            gt_labels = tf.constant(gt_labels)
-            del tmp_tuple
-            
-            tmp_tuple = tf_obj_detector.format_data(
-                gt_labels, box_scales, sc_dims, 
-                n_classes, img_pad=img_pad, stride=8)
+            img_boxes = []
+            img_batch = []
+            for tmp_idx in batch_sample:
+                tmp_image, tmp_boxes = prepare_sample(
+                    train_data[tmp_idx], n_classes, 
+                    box_scales, raw_dims, img_dims, 
+                    target_cache=target_cache, 
+                    normalize=not uint8_input)
+                
+                img_batch.append(
+                    tf.expand_dims(tmp_image, axis=0))
+                img_boxes.append(
+                    tf.expand_dims(tmp_boxes, axis=0))
+                del tmp_image, tmp_boxes
             
-            img_batch.append(
-                tf.expand_dims(tmp_image, axis=0))
-            img_boxes.append(
-                tf.expand_dims(tmp_tuple[0], axis=0))
-            del tmp_tuple, gt_labels, tmp_image, tmp_bbox
+            # Note that TF parses the image transposed, so the  #
+            # bounding boxes coordinates are already transposed #
+            # during the formatting of the data.                #
+            img_batch = tf.concat(img_batch, axis=0)
+            img_boxes = tf.cast(tf.concat(
+                img_boxes, axis=0), tf.float32)
         
         # Get the image file names. #
         img_files = [
             train_data[x]["image"] for x in batch_sample]
         
-        # Note that TF parses the image transposed, so the  #
-        # bounding boxes coordinates are already transposed #
-        # during the formatting of the data.                #
-        img_batch = tf.concat(img_batch, axis=0)
-        img_boxes = tf.cast(tf.concat(
-            img_boxes, axis=0), tf.float32)
-        
         tmp_losses = tf_obj_detector.train_step(
             model, sub_batch_sz, img_batch, 
             img_boxes, optimizer, learning_rate=lrate)
@@ -140,6 +229,10 @@ def train(
             print("Learning Rate:", str(optimizer.lr.numpy()))
             print("Average Epoch Cls. Loss:", str(avg_cls_loss) + ".")
             print("Average Epoch Reg. Loss:", str(avg_reg_loss) + ".")
+            if target_cache is not None:
+                target_cache.report()
+            if isinstance(data_iter, EchoBuffer):
+                data_iter.report()
             
             elapsed_time = (time.time() - start_time) / 60.0
             print("Elapsed time:", str(elapsed_time), "mins.")
@@ -152,6 +245,9 @@ def train(
                 
                 tmp_img  = img_batch[-1]
                 tmp_bbox = img_boxes[-1]
+                disp_tuple = format_display(
+                    train_data[batch_sample[-1]], 
+                    n_classes, box_scales, img_dims)
                 tf_obj_detector.show_object_boxes(
                     tmp_img, tmp_bbox, img_dims, 
                     box_scales, downsample=downsample)
@@ -183,6 +279,9 @@ def train(
             
             tmp_img  = img_batch[-1]
             tmp_bbox = img_boxes[-1]
+            disp_tuple = format_display(
+                train_data[batch_sample[-1]], 
+                n_classes, box_scales, img_dims)
             tf_obj_detector.show_object_boxes(
                 tmp_img, tmp_bbox, img_dims, 
                 box_scales, downsample=downsample)
@@ -229,6 +328,110 @@ display_step = 25
 if subsample:
     train_data = train_data[:2500]
 
+# Feed uint8 images, which the model normalizes in the graph. #
+# This changes the layers, so it needs a fresh checkpoint.     #
+uint8_input = False
+img_dtype = tf.uint8 if uint8_input else tf.float32
+
+# Encode the targets with TF ops in the pipeline, so that the #
+# encoding runs across cores alongside the image decoding.    #
+use_graph_encode = True
+
+# Run the graph pipeline on a local tf.data service, whose #
+# worker processes scale past the thread pool of the       #
+# trainer. It needs the graph encoder.                     #
+use_data_service = False
+data_service = None
+
+# Cache the encoded targets of the fixed-size inputs, so #
+# that repeated epochs skip the target encoding. This is #
+# only used by the Python encoder.                       #
+use_target_cache = not use_graph_encode
+if use_target_cache:
+    target_cache = TargetCache(
+        ("centernet_s8", tuple(box_scales), n_classes, downsample), 
+        max_mb=4096, cache_dir=tmp_path + "crowd_human_target_cache/")
+else:
+    target_cache = None
+
+# Prepare the batches in a parallel tf.data pipeline. #
+use_pipeline = True
+if use_pipeline:
+    base_dims = min(base_rows, base_cols)
+    raw_dims  = int((img_dims / base_dims) * base_dims)
+    h_max = int(img_dims / downsample)
+    w_max = int(img_dims / downsample)
+    pipe_signature = (
+        tf.TensorSpec([img_dims, img_dims, 3], img_dtype), 
+        tf.TensorSpec([h_max, w_max, n_scales, n_classes+4], tf.float32), 
+        tf.TensorSpec([], tf.int64))
+    
+    def pipe_sample(tmp_idx):
+        tmp_image, tmp_boxes = prepare_sample(
+            train_data[tmp_idx], n_classes, box_scales, 
+            raw_dims, img_dims, target_cache=target_cache, 
+            normalize=not uint8_input)
+        return tmp_image, tmp_boxes, tmp_idx
+    
+    load_signature = (
+        tf.TensorSpec([], tf.string), 
+        tf.TensorSpec([None, 4], tf.float32), 
+        tf.TensorSpec([None], tf.int32), 
+        tf.TensorSpec([], tf.int64))
+    
+    def load_record(tmp_idx):
+        tmp_sample = train_data[tmp_idx]
+        return (tmp_sample["image"], 
+                tmp_sample["objects"]["bbox"], 
+                tmp_sample["objects"]["label"], tmp_idx)
+    
+    def encode_record(filename, tmp_bbox, tmp_class, tmp_idx):
+        tmp_image, tmp_boxes = prepare_sample_tf(
+            filename, tmp_bbox, tmp_class, n_classes, 
+            box_scales, raw_dims, img_dims, 
+            normalize=not uint8_input)
+        return tmp_image, tmp_boxes, tmp_idx
+    
+    if use_graph_encode and use_data_service:
+        data_service = LocalDataService(n_workers=8)
+        svc_bbox = [np.reshape(np.array(
+            x["objects"]["bbox"], dtype=np.float32), [-1, 4]) \
+                for x in train_data]
+        svc_label = [np.array(
+            x["objects"]["label"], dtype=np.int32) for x in train_data]
+        svc_records = (
+            tf.constant([x["image"] for x in train_data]), 
+            tf.RaggedTensor.from_row_lengths(
+                np.concatenate(svc_bbox), [len(x) for x in svc_bbox]), 
+            tf.RaggedTensor.from_row_lengths(
+                np.concatenate(svc_label), [len(x) for x in svc_label]), 
+            tf.range(len(train_data), dtype=tf.int64))
+        del svc_bbox, svc_label
+        
+        data_iter = iter(build_service_pipeline(
+            svc_records, encode_record, 
+            service=data_service, batch_size=batch_size))
+    elif use_graph_encode:
+        data_iter = iter(build_graph_pipeline(
+            len(train_data), load_record, load_signature, 
+            encode_record, batch_size=batch_size))
+    else:
+        data_iter = iter(build_pipeline(
+            len(train_data), pipe_sample, 
+            pipe_signature, batch_size=batch_size))
+else:
+    data_iter = None
+
+# Reuse each prepared batch up to echo_factor times with a #
+# fresh jitter, so that the training loop does not wait    #
+# for the decoding and encoding of the pipeline.           #
+use_echo = use_pipeline
+echo_factor = 2
+if use_echo:
+    data_iter = EchoBuffer(
+        data_iter, echo_factor=echo_factor, 
+        buffer_size=8, augment_fn=echo_batch)
+
 # Define the checkpoint callback function. #
 model_path = \
     "C:/Users/admin/Desktop/TF_Models/crowd_human_model/"
@@ -238,11 +441,17 @@ ckpt_model = model_path + "crowd_human_centernet_resnet101"
 
 # Build the model. #
 centernet_model = tf_obj_detector.build_model(
-    n_classes, n_scales=n_scales, backbone_model="resnet101")
+    n_classes, n_scales=n_scales, 
+    backbone_model="resnet101", uint8_input=uint8_input)
 model_optimizer = tf.keras.optimizers.SGD(momentum=0.9)
 
+# Draw the batches epoch by epoch, and save the position of #
+# the sampler with the checkpoint to resume mid-epoch.      #
+sampler = EpochSampler(len(train_data), batch_size)
+
 checkpoint = tf.train.Checkpoint(
     step=tf.Variable(0), 
+    sampler=sampler, 
     centernet_model=centernet_model, 
     model_optimizer=model_optimizer)
 ck_manager = tf.train.CheckpointManager(
@@ -278,5 +487,10 @@ train(centernet_model, n_classes, img_dims,
       base_rows=base_rows, base_cols=base_cols, 
       display_step=display_step, step_cool=step_cool, 
       init_lr=init_lr, min_lr=min_lr, downsample=downsample, 
-      thresh=0.50, save_flag=True, train_loss_log=train_loss)
+      thresh=0.50, save_flag=True, 
+      train_loss_log=train_loss, data_iter=data_iter, 
+      target_cache=target_cache, sampler=sampler)
 print("Model fitted.")
+
+if data_service is not None:
+    data_service.close()
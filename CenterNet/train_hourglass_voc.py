@@ -1,22 +1,28 @@
+import os
 import time
 import numpy as np
 import pandas as pd
-import pickle as pkl
-from utils import convert_to_xywh
+from utils import convert_to_xywh, last_unique_index
+from utils import decode_jpeg_scaled
+from annotation_store import load_annotations
+from image_cache import ImageCache
 
 import tensorflow as tf
 import tf_hourglass_net as tf_obj_detector
+from epoch_sampler import EpochSampler
 
 # Custom function to parse the data. #
 def _parse_image(
-    filename, img_rows, img_cols):
-    image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    image_decoded = \
-        tf.image.convert_image_dtype(image_decoded, tf.float32)
+    filename, img_rows, img_cols, img_cache=None):
+    if img_cache is not None and filename in img_cache:
+        image_decoded = tf.constant(img_cache.get_image(filename))
+    else:
+        image_string  = tf.io.read_file(filename)
+        image_decoded = decode_jpeg_scaled(
+            image_string, min_side=max(img_rows, img_cols))
     image_resized = tf.image.resize(
         image_decoded, [img_rows, img_cols])
+    image_resized = image_resized / 255.0
     image_resized = tf.ensure_shape(
         image_resized, shape=(img_rows, img_cols, 3))
     return image_resized
@@ -66,14 +72,98 @@ def image_augment(img_in, img_bbox, p=0.5):
     else:
         return (img_in, img_bbox)
 
+def format_targets(
+    gt_bbox, gt_class, n_classes, box_scales, 
+    raw_dims, pad_dims, out_dims, stride=8):
+    """
+    Encodes the CenterNet targets of a sample using only TF ops, so
+    that it runs as compiled graph code. The boxes are filled in by
+    ascending area, so the last box of a grid cell and scale takes
+    its targets while the class channels of all its boxes are set.
+    Arguments:
+      gt_bbox: The (N, 4) normalised boxes (x, y, w, h) of the sample.
+      gt_class: The (N,) class ids of the boxes.
+      n_classes: The number of classes.
+      box_scales: The box scales in ascending order.
+      raw_dims: The (rows, cols) that the image was resized to.
+      pad_dims: The padding added before the image on each axis.
+      out_dims: The (rows, cols) of the padded image as Python ints.
+    Returns:
+      The (rows/stride, cols/stride, n_scales, n_classes+5) targets.
+    """
+    h_max = int(out_dims[0] / stride)
+    w_max = int(out_dims[1] / stride)
+    n_scales = len(box_scales)
+    
+    tmp_bbox = tf.cast(gt_bbox, tf.float64)
+    raw_dims = tf.cast(raw_dims, tf.float64)
+    pad_dims = tf.cast(pad_dims, tf.float64)
+    box_scales = tf.constant(box_scales, dtype=tf.float64)
+    
+    # Sort by area in ascending order and skip negative boxes. #
+    tmp_valid = tf.logical_and(
+        tmp_bbox[:, 2] >= 0.0, tmp_bbox[:, 3] >= 0.0)
+    tmp_class = tf.boolean_mask(
+        tf.cast(gt_class, tf.int32), tmp_valid)
+    tmp_bbox  = tf.boolean_mask(tmp_bbox, tmp_valid)
+    tmp_order = tf.argsort(
+        tmp_bbox[:, 2] * tmp_bbox[:, 3] * 100, stable=True)
+    tmp_bbox  = tf.gather(tmp_bbox, tmp_order)
+    tmp_class = tf.gather(tmp_class, tmp_order)
+    
+    tmp_x_cen  = pad_dims + tmp_bbox[:, 0] * raw_dims[0]
+    tmp_y_cen  = pad_dims + tmp_bbox[:, 1] * raw_dims[1]
+    tmp_width  = tmp_bbox[:, 2] * raw_dims[0]
+    tmp_height = tmp_bbox[:, 3] * raw_dims[1]
+    
+    # The scale of a box is the first one above both its sides, #
+    # or the last scale if there is none.                       #
+    id_sc = tf.searchsorted(
+        box_scales, tf.maximum(tmp_width, tmp_height), 
+        side="right", out_type=tf.int32)
+    id_sc = tf.minimum(id_sc, n_scales-1)
+    box_scale = tf.gather(box_scales, id_sc)
+    
+    # Casting truncates towards zero like int(). #
+    tmp_h_cen = tf.clip_by_value(tf.cast(
+        tmp_y_cen / stride, tf.int32), 0, h_max-1)
+    tmp_w_cen = tf.clip_by_value(tf.cast(
+        tmp_x_cen / stride, tf.int32), 0, w_max-1)
+    tmp_h_off = tmp_y_cen - tf.cast(tmp_h_cen*stride, tf.float64)
+    tmp_w_off = tmp_x_cen - tf.cast(tmp_w_cen*stride, tf.float64)
+    
+    box_targets = tf.stack([
+        tmp_h_off / stride, tmp_w_off / stride, 
+        tmp_height / box_scale, tmp_width / box_scale, 
+        tf.ones_like(tmp_h_off)], axis=1)
+    
+    cell_idx = tf.stack([tmp_h_cen, tmp_w_cen, id_sc], axis=1)
+    last_idx = last_unique_index(
+        (tmp_h_cen*w_max + tmp_w_cen)*n_scales + id_sc)
+    reg_output = tf.scatter_nd(
+        tf.gather(cell_idx, last_idx), tf.cast(tf.gather(
+            box_targets, last_idx), tf.float32), 
+        [h_max, w_max, n_scales, 5])
+    cls_output = tf.minimum(tf.scatter_nd(
+        tf.concat([cell_idx, tf.expand_dims(tmp_class, 1)], axis=1), 
+        tf.ones_like(tmp_class, dtype=tf.float32), 
+        [h_max, w_max, n_scales, n_classes]), 1.0)
+    return tf.concat([reg_output, cls_output], axis=3)
+
+# Trace the encoder once per output shape and box scales. #
+encode_targets = tf.function(format_targets, reduce_retracing=True)
+
 def train(
     voc_model, n_classes, sub_batch_sz, batch_size, 
     train_data, training_loss, st_step, max_steps, 
     optimizer, ckpt, ck_manager, label_dict, init_lr=1.0e-3, 
     min_lr=1.0e-6, decay=0.75, display_step=100, step_cool=50, 
     base_rows=320, base_cols=320, disp_rows=320, disp_cols=320, 
-    save_flag=False, save_train_loss_file="train_losses.csv"):
+    save_flag=False, save_train_loss_file="train_losses.csv", 
+    img_cache=None, sampler=None):
     n_data = len(train_data)
+    if sampler is None:
+        sampler = EpochSampler(n_data, batch_size)
     min_scale  = min(disp_rows, disp_cols)
     disp_scale = [min_scale / (2**x) for x in range(4)]
     disp_scale = disp_scale[::-1]
@@ -82,8 +172,7 @@ def train(
     tot_reg_loss  = 0.0
     tot_cls_loss  = 0.0
     for step in range(st_step, max_steps):
-        batch_sample  = np.random.choice(
-            n_data, size=batch_size, replace=False)
+        batch_sample  = sampler.next_batch()
         
         rnd_scale = np.random.uniform(low=0.6, high=1.3)
         raw_dims = int(rnd_scale * 320)
@@ -97,112 +186,29 @@ def train(
         img_scale = [(img_dims / (2**x)) for x in range(4)]
         img_scale = img_scale[::-1]
         for tmp_idx in batch_sample:
-            img_bbox  = np.zeros([
-                int(img_dims/8), 
-                int(img_dims/8), 4, n_classes+5])
-            tmp_bbox  = np.array(train_data[
-                tmp_idx]["objects"]["bbox"])
-            tmp_bbox  = convert_to_xywh(tmp_bbox).numpy()
-            tmp_class = np.array(train_data[
-                tmp_idx]["objects"]["label"])
-            
-            # Sort by area in descending order. #
-            tmp_box_areas = \
-                tmp_bbox[:, 2] * tmp_bbox[:, 3] * 100
-            
-            obj_class  = \
-                tmp_class[np.argsort(tmp_box_areas)]
-            tmp_sorted = \
-                tmp_bbox[np.argsort(tmp_box_areas)]
-            for n_box in range(len(tmp_sorted)):
-                tmp_object = tmp_sorted[n_box]
-                
-                tmp_x_cen  = pad_dims + tmp_object[0] * raw_dims
-                tmp_y_cen  = pad_dims + tmp_object[1] * raw_dims
-                tmp_width  = tmp_object[2] * raw_dims
-                tmp_height = tmp_object[3] * raw_dims
-                
-                if tmp_width < 0 or tmp_height < 0:
-                    continue
-                elif tmp_width < img_scale[0] \
-                    and tmp_height < img_scale[0]:
-                    id_sc = 0
-                    box_scale = img_scale[0]
-                elif tmp_width < img_scale[1] \
-                    and tmp_height < img_scale[1]:
-                    id_sc = 1
-                    box_scale = img_scale[1]
-                elif tmp_width < img_scale[2] \
-                    and tmp_height < img_scale[2]:
-                    id_sc = 2
-                    box_scale = img_scale[2]
-                else:
-                    id_sc = 3
-                    box_scale = img_scale[3]
-                
-                tmp_w_reg = tmp_width / box_scale
-                tmp_h_reg = tmp_height / box_scale
-                tmp_w_cen = int(tmp_x_cen / 8)
-                tmp_h_cen = int(tmp_y_cen / 8)
-                tmp_w_off = (tmp_x_cen - tmp_w_cen*8) / 8
-                tmp_h_off = (tmp_y_cen - tmp_h_cen*8) / 8
-                cls_label = obj_class[n_box] + 5
-                
-                img_bbox[tmp_h_cen, tmp_w_cen, id_sc, :5] = [
-                    tmp_h_off, tmp_w_off, tmp_h_reg, tmp_w_reg, 1.0]
-                img_bbox[tmp_h_cen, tmp_w_cen, id_sc, cls_label] = 1.0
+            tmp_bbox  = convert_to_xywh(np.array(
+                train_data[tmp_idx]["objects"]["bbox"]))
+            tmp_class = np.array(
+                train_data[tmp_idx]["objects"]["label"])
             
-            img_boxes.append(img_bbox)
+            img_bbox = encode_targets(
+                tmp_bbox, tmp_class, n_classes, tuple(img_scale), 
+                tf.constant([raw_dims, raw_dims]), 
+                tf.constant(pad_dims), (img_dims, img_dims))
+            img_boxes.append(np.array(img_bbox))
             del img_bbox
             
             if tmp_idx == batch_sample[-1]:
-                disp_box = np.zeros([
-                    int(disp_rows/8), 
-                    int(disp_cols/8), 4, n_classes+5])
-                
-                for n_box in range(len(tmp_sorted)):
-                    tmp_object = tmp_sorted[n_box]
-                    
-                    tmp_x_cen  = tmp_object[0] * disp_rows
-                    tmp_y_cen  = tmp_object[1] * disp_cols
-                    tmp_width  = tmp_object[2] * disp_rows
-                    tmp_height = tmp_object[3] * disp_cols
-                    
-                    if tmp_width < 0 or tmp_height < 0:
-                        continue
-                    elif tmp_width < disp_scale[0] \
-                        and tmp_height < disp_scale[0]:
-                        id_sc = 0
-                        box_scale = disp_scale[0]
-                    elif tmp_width < disp_scale[1] \
-                        and tmp_height < disp_scale[1]:
-                        id_sc = 1
-                        box_scale = disp_scale[1]
-                    elif tmp_width < disp_scale[2] \
-                        and tmp_height < disp_scale[2]:
-                        id_sc = 2
-                        box_scale = disp_scale[2]
-                    else:
-                        id_sc = 3
-                        box_scale = disp_scale[3]
-                    
-                    tmp_w_reg = tmp_width / box_scale
-                    tmp_h_reg = tmp_height / box_scale
-                    tmp_w_cen = int(tmp_x_cen / 8)
-                    tmp_h_cen = int(tmp_y_cen / 8)
-                    tmp_w_off = (tmp_x_cen - tmp_w_cen*8) / 8
-                    tmp_h_off = (tmp_y_cen - tmp_h_cen*8) / 8
-                    cls_label = obj_class[n_box] + 5
-                    
-                    disp_box[tmp_h_cen, tmp_w_cen, id_sc, :5] = [
-                        tmp_h_off, tmp_w_off, tmp_h_reg, tmp_w_reg, 1.0]
-                    disp_box[tmp_h_cen, tmp_w_cen, id_sc, cls_label] = 1.0
+                disp_box = encode_targets(
+                    tmp_bbox, tmp_class, n_classes, tuple(disp_scale), 
+                    tf.constant([disp_rows, disp_cols]), 
+                    tf.constant(0), (disp_rows, disp_cols))
         
         img_files = [
             train_data[x]["image"] for x in batch_sample]
         img_array = [_parse_image(
-            x, img_rows=raw_dims, 
-            img_cols=raw_dims) for x in img_files]
+            x, img_rows=raw_dims, img_cols=raw_dims, 
+            img_cache=img_cache) for x in img_files]
         img_batch = [tf.image.pad_to_bounding_box(
             x, pad_dims, pad_dims, img_dims, img_dims) for x in img_array]
         
@@ -296,10 +302,15 @@ def train(
 
 # Load the VOC 2012 dataset. #
 tmp_path = "C:/Users/admin/Desktop/Data/VOCdevkit/VOC2012/"
-load_pkl_file = tmp_path + "voc_data.pkl"
-with open(load_pkl_file, "rb") as tmp_load:
-    id_2_label  = pkl.load(tmp_load)
-    voc_dataset = pkl.load(tmp_load)
+store_dir = tmp_path + "voc_data_store/"
+id_2_label, voc_dataset = load_annotations(store_dir)
+
+# Use the pre-decoded images if the cache has been built. #
+cache_dir = tmp_path + "voc_image_cache/"
+if os.path.isdir(cache_dir):
+    img_cache = ImageCache(cache_dir)
+else:
+    img_cache = None
 
 # Define the Neural Network. #
 restore_flag = False
@@ -318,6 +329,11 @@ sub_batch  = 2
 n_classes  = len(id_2_label)
 display_step = 25
 
+# Subsample the data. #
+train_data = voc_dataset
+if subsample:
+    train_data = voc_dataset[:100]
+
 # Define the checkpoint callback function. #
 voc_path = "C:/Users/admin/Desktop/TF_Models/centernet_model/"
 train_loss = voc_path + "voc_losses_centernet.csv"
@@ -329,8 +345,13 @@ voc_model = tf_obj_detector.build_model(
     n_repeats=2, seperable=True, batch_norm=True)
 optimizer = tf.keras.optimizers.Adam()
 
+# Draw the batches epoch by epoch, and save the position of #
+# the sampler with the checkpoint to resume mid-epoch.      #
+sampler = EpochSampler(len(train_data), batch_size)
+
 checkpoint = tf.train.Checkpoint(
     step=tf.Variable(0), 
+    sampler=sampler, 
     voc_model=voc_model, 
     optimizer=optimizer)
 ck_manager = tf.train.CheckpointManager(
@@ -355,10 +376,6 @@ st_step = checkpoint.step.numpy().astype(np.int32)
 print(voc_model.summary())
 print("-" * 50)
 
-# Subsample the data. #
-if subsample:
-    train_data = voc_dataset[:100]
-
 print("Fit model on training data (" +\
       str(len(train_data)) + " training samples).")
 
@@ -369,5 +386,6 @@ train(voc_model, n_classes, sub_batch, batch_size,
       display_step=display_step, step_cool=step_cool, 
       base_rows=base_rows, base_cols=base_cols, 
       disp_rows=base_rows, disp_cols=base_rows, 
-      save_flag=False, save_train_loss_file=train_loss)
+      save_flag=False, save_train_loss_file=train_loss, 
+      img_cache=img_cache, sampler=sampler)
 print("Model fitted.")
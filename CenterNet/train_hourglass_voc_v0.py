@@ -2,21 +2,21 @@ import time
 import numpy as np
 import pandas as pd
 import pickle as pkl
-from utils import convert_to_xywh
+from utils import convert_to_xywh, decode_jpeg_scaled
 
 import tensorflow as tf
 import tf_hourglass_net as tf_obj_detector
+from epoch_sampler import EpochSampler
 
 # Custom function to parse the data. #
 def _parse_image(
     filename, img_rows, img_cols):
     image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    image_decoded = \
-        tf.image.convert_image_dtype(image_decoded, tf.float32)
+    image_decoded = decode_jpeg_scaled(
+        image_string, min_side=max(img_rows, img_cols))
     image_resized = tf.image.resize(
         image_decoded, [img_rows, img_cols])
+    image_resized = image_resized / 255.0
     image_resized = tf.ensure_shape(
         image_resized, shape=(img_rows, img_cols, 3))
     return image_resized
@@ -54,8 +54,11 @@ def train(
     optimizer, ckpt, ck_manager, label_dict, init_lr=1.0e-3, 
     min_lr=1.0e-6, decay=0.75, display_step=100, step_cool=50, 
     base_dims=None, disp_rows=320, disp_cols=320, thresh=0.50, 
-    save_flag=False, train_loss_log="log_training_losses.csv"):
+    save_flag=False, train_loss_log="log_training_losses.csv", 
+    sampler=None):
     n_data = len(train_data)
+    if sampler is None:
+        sampler = EpochSampler(n_data, batch_size)
     min_scale  = min(disp_rows, disp_cols)
     disp_scale = [min_scale / (2**x) for x in range(4)]
     disp_scale = disp_scale[::-1]
@@ -67,8 +70,7 @@ def train(
     tot_reg_loss = 0.0
     tot_cls_loss = 0.0
     for step in range(st_step, max_steps):
-        batch_sample  = np.random.choice(
-            n_data, size=batch_size, replace=False)
+        batch_sample  = sampler.next_batch()
         
         img_dims = np.random.choice(base_dims)
         img_boxes = []
@@ -298,6 +300,11 @@ sub_batch  = 2
 n_classes  = len(id_2_label)
 display_step = 25
 
+# Subsample the data. #
+train_data = voc_dataset
+if subsample:
+    train_data = voc_dataset[:100]
+
 # Define the checkpoint callback function. #
 voc_path = "C:/Users/admin/Desktop/TF_Models/centernet_model/"
 train_loss = voc_path + "voc_losses_centernet.csv"
@@ -309,8 +316,13 @@ voc_model = tf_obj_detector.build_model(
     n_repeats=2, seperable=True, batch_norm=True)
 optimizer = tf.keras.optimizers.Adam()
 
+# Draw the batches epoch by epoch, and save the position of #
+# the sampler with the checkpoint to resume mid-epoch.      #
+sampler = EpochSampler(len(train_data), batch_size)
+
 checkpoint = tf.train.Checkpoint(
     step=tf.Variable(0), 
+    sampler=sampler, 
     voc_model=voc_model, 
     optimizer=optimizer)
 ck_manager = tf.train.CheckpointManager(
@@ -335,10 +347,6 @@ st_step = checkpoint.step.numpy().astype(np.int32)
 print(voc_model.summary())
 print("-" * 50)
 
-# Subsample the data. #
-if subsample:
-    train_data = voc_dataset[:100]
-
 print("Fit model on training data (" +\
       str(len(train_data)) + " training samples).")
 
@@ -348,5 +356,6 @@ train(voc_model, n_classes, sub_batch, batch_size,
       disp_rows=disp_rows, disp_cols=disp_cols, 
       display_step=display_step, step_cool=step_cool, 
       init_lr=init_lr, min_lr=min_lr, decay=decay_rate, 
-      thresh=1.10, save_flag=True, train_loss_log=train_loss)
+      thresh=1.10, save_flag=True, train_loss_log=train_loss, 
+      sampler=sampler)
 print("Model fitted.")
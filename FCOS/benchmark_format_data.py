@@ -0,0 +1,78 @@
+
+import time
+import numpy as np
+import tensorflow as tf
+from fcos import format_data, format_data_v0
+
+# Generate random crowded images of normalised boxes (y, x, h, w, class). #
+def random_sample(n_boxes, num_classes, img_dims):
+    box_h = np.exp(np.random.uniform(
+        np.log(4.0), np.log(img_dims[0]), size=n_boxes)) / img_dims[0]
+    box_w = np.exp(np.random.uniform(
+        np.log(4.0), np.log(img_dims[1]), size=n_boxes)) / img_dims[1]
+    box_y = np.random.uniform(0.5*box_h, 1.0 - 0.5*box_h)
+    box_x = np.random.uniform(0.5*box_w, 1.0 - 0.5*box_w)
+    box_c = np.random.randint(0, num_classes, size=n_boxes)
+    
+    gt_labels = np.stack(
+        [box_y, box_x, box_h, box_w, box_c], axis=1)
+    return tf.constant(gt_labels, dtype=tf.float32)
+
+def outputs_equal(x_output, y_output):
+    # The target counts are Python ints, so compare arrays. #
+    x_flat = [np.asarray(x) for x in tf.nest.flatten(x_output)]
+    y_flat = [np.asarray(y) for y in tf.nest.flatten(y_output)]
+    if len(x_flat) != len(y_flat):
+        return False
+    return all([x.dtype == y.dtype and np.array_equal(
+        x, y) for x, y in zip(x_flat, y_flat)])
+
+def time_encoder(encode_fn, samples, n_repeat=3):
+    start_time = time.time()
+    for _ in range(n_repeat):
+        for tmp_sample in samples:
+            encode_fn(*tmp_sample)
+    return (time.time() - start_time) / (n_repeat * len(samples))
+
+# Benchmark Parameters. #
+np.random.seed(0)
+n_images = 50
+num_classes = 80
+box_counts  = [5, 25, 100, 300]
+
+print("Benchmarking FCOS format_data against format_data_v0.")
+for n_boxes in box_counts:
+    samples = []
+    for n_image in range(n_images):
+        img_dim = np.random.randint(640, 1024, size=2)
+        img_pad = [int(np.ceil(x / 128.0) * 128) for x in img_dim]
+        img_dim = tf.constant(img_dim, dtype=tf.float32)
+        
+        gt_labels = random_sample(
+            n_boxes, num_classes, img_dim.numpy())
+        samples.append((gt_labels, img_dim, img_pad))
+    
+    # Check that both encoders give the same outputs. #
+    n_match = 0
+    for gt_labels, img_dim, img_pad in samples:
+        for sparse in [False, True]:
+            v0_output = format_data_v0(
+                gt_labels, img_dim, num_classes, 
+                img_pad=img_pad, sparse=sparse)
+            v1_output = format_data(
+                gt_labels, img_dim, num_classes, 
+                img_pad=img_pad, sparse=sparse)
+            n_match += int(outputs_equal(v0_output, v1_output))
+    
+    v0_time = time_encoder(lambda x, y, z: format_data_v0(
+        x, y, num_classes, img_pad=z), samples)
+    v1_time = time_encoder(lambda x, y, z: format_data(
+        x, y, num_classes, img_pad=z), samples)
+    
+    print("-" * 50)
+    print("Boxes per image:", str(n_boxes))
+    print("Identical outputs:", 
+          str(n_match), "/", str(2*len(samples)))
+    print("format_data_v0:", str(round(1000.0*v0_time, 3)), "ms.")
+    print("format_data:", str(round(1000.0*v1_time, 3)), "ms.")
+    print("Speedup:", str(round(v0_time / v1_time, 2)) + "x.")
@@ -0,0 +1,194 @@
+import numpy as np
+import tensorflow as tf
+
+class BucketSampler(tf.Module):
+    """
+    Draws the training batches from buckets of images with similar
+    aspect ratios, so that each image is padded to the shape of its
+    bucket instead of a square and the model only sees one input
+    shape per bucket. The buckets are formed once from the (height, 
+    width) stored in the annotations, without decoding the images.
+    The padded shape of a bucket is the largest resized shape of its
+    images, rounded up to the stride, so that the scale jitter is
+    kept. Buckets with the same padded shape are merged, and buckets
+    with fewer than `batch_size` images are merged into the smallest
+    bucket which holds them. Each epoch shuffles the images within
+    each bucket and then the order of the batches. As with the
+    EpochSampler, only the seed, epoch and position are variables, 
+    so adding it to the tf.train.Checkpoint resumes it mid-epoch.
+    Arguments:
+      img_sizes: The (height, width) of each training image, e.g.
+        from `AnnotationStore.image_sizes`.
+      batch_size: The number of samples per batch.
+      min_side: The largest size of the shorter side after resizing, 
+        i.e. the upper jitter, or an array of one per image.
+      max_side: The largest size of the longer side after resizing, 
+        or an array of one per image.
+      stride: The stride that the padded shapes are a multiple of.
+      aspect_edges: The edges of the height to width ratios of the
+        buckets.
+      seed: The seed of the permutations. If None, it is drawn.
+    """
+    def __init__(
+        self, img_sizes, batch_size, min_side, max_side, 
+        stride=128, aspect_edges=[0.6, 0.85, 1.15, 1.6], 
+        seed=None, name="bucket_sampler"):
+        super(BucketSampler, self).__init__(name=name)
+        img_sizes = np.asarray(img_sizes, dtype=np.float64)
+        if np.any(img_sizes <= 0):
+            raise ValueError(
+                "The image sizes are missing. Convert the " + \
+                "annotations again with the width and height.")
+        if len(img_sizes) < batch_size:
+            raise ValueError(
+                "BucketSampler needs at least batch_size samples.")
+        
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        self.n_data = len(img_sizes)
+        self.stride = stride
+        self.batch_size = batch_size
+        
+        # Largest resized shape of each image over the jitter. #
+        ratio = np.minimum(
+            min_side / np.min(img_sizes, axis=1), 
+            max_side / np.max(img_sizes, axis=1))
+        self.img_shapes = ratio[:, None] * img_sizes
+        
+        aspect_ids = np.digitize(
+            img_sizes[:, 0] / img_sizes[:, 1], aspect_edges)
+        self.bucket_ids, self.bucket_dims = \
+            self._build_buckets(aspect_ids)
+        
+        self.seed  = tf.Variable(
+            seed, dtype=tf.int64, trainable=False)
+        self.epoch = tf.Variable(
+            0, dtype=tf.int64, trainable=False)
+        self.position = tf.Variable(
+            0, dtype=tf.int64, trainable=False)
+        
+        self._order = None
+        self._order_key = None
+    
+    def _padded_dims(self, img_idx):
+        max_shape = np.max(self.img_shapes[img_idx], axis=0)
+        return tuple(int(x) for x in np.ceil(
+            max_shape / self.stride) * self.stride)
+    
+    def _build_buckets(self, aspect_ids):
+        # Group the aspect ratio buckets by their padded shape. #
+        tmp_buckets = dict()
+        for aspect_id in np.unique(aspect_ids):
+            img_idx = np.where(aspect_ids == aspect_id)[0]
+            tmp_dims = self._padded_dims(img_idx)
+            tmp_buckets[tmp_dims] = np.concatenate([
+                tmp_buckets.get(tmp_dims, []), img_idx]).astype(np.int64)
+        
+        # Merge the buckets too small for a batch. #
+        while len(tmp_buckets) > 1:
+            tmp_small = [x for x in tmp_buckets \
+                if len(tmp_buckets[x]) < self.batch_size]
+            if len(tmp_small) == 0:
+                break
+            
+            tmp_dims = min(tmp_small, key=lambda x: len(tmp_buckets[x]))
+            img_idx  = tmp_buckets.pop(tmp_dims)
+            tmp_fits = [x for x in tmp_buckets \
+                if x[0] >= tmp_dims[0] and x[1] >= tmp_dims[1]]
+            if len(tmp_fits) > 0:
+                new_dims = min(tmp_fits, key=lambda x: x[0]*x[1])
+            else:
+                new_dims = max(tmp_buckets, key=lambda x: x[0]*x[1])
+            
+            img_idx = np.concatenate([tmp_buckets.pop(new_dims), img_idx])
+            tmp_buckets[self._padded_dims(img_idx)] = img_idx
+        
+        bucket_dims = sorted(tmp_buckets.keys())
+        bucket_ids  = np.zeros([self.n_data], dtype=np.int64)
+        for n_bucket in range(len(bucket_dims)):
+            bucket_ids[tmp_buckets[bucket_dims[n_bucket]]] = n_bucket
+        return bucket_ids, np.array(bucket_dims, dtype=np.int64)
+    
+    def _epoch_order(self, epoch):
+        # Full batches of each bucket, in a random order. #
+        tmp_rng = np.random.default_rng(
+            [int(self.seed.numpy()), epoch])
+        tmp_batches = []
+        for n_bucket in range(len(self.bucket_dims)):
+            img_idx = tmp_rng.permutation(
+                np.where(self.bucket_ids == n_bucket)[0])
+            n_batch = len(img_idx) // self.batch_size
+            tmp_batches.append(np.reshape(
+                img_idx[:(n_batch*self.batch_size)], 
+                [n_batch, self.batch_size]))
+        
+        tmp_batches = np.concatenate(tmp_batches, axis=0)
+        return tmp_batches[tmp_rng.permutation(len(tmp_batches))]
+    
+    def order(self):
+        """
+        Returns the batches of the current epoch as an array of
+        shape `(n_batches, batch_size)`.
+        """
+        # Rebuild the order if a restore changed the seed or epoch. #
+        tmp_key = (int(self.seed.numpy()), int(self.epoch.numpy()))
+        if self._order_key != tmp_key:
+            self._order = self._epoch_order(tmp_key[1])
+            self._order_key = tmp_key
+        return self._order
+    
+    def next_batch(self):
+        """
+        Returns the indices of the next batch, whose images are all
+        in the same bucket.
+        """
+        tmp_order = self.order()
+        n_batch = int(self.position.numpy()) // self.batch_size
+        if n_batch >= len(tmp_order):
+            self.epoch.assign_add(1)
+            tmp_order = self.order()
+            n_batch = 0
+        
+        self.position.assign((n_batch + 1) * self.batch_size)
+        return tmp_order[n_batch]
+    
+    def pad_dims(self, idx):
+        """
+        Returns the padded (height, width) of the bucket of a sample.
+        """
+        return [int(x) for x in self.bucket_dims[self.bucket_ids[idx]]]
+    
+    def bucket_records(self, data, batch):
+        """
+        Returns the records of the batch from `data`, each with the
+        padded shape of its bucket as `pad_dims`, which is read by
+        `preprocess_data`.
+        """
+        tmp_records = []
+        for tmp_idx in batch:
+            tmp_record = dict(data[tmp_idx])
+            tmp_record["pad_dims"] = self.pad_dims(tmp_idx)
+            tmp_records.append(tmp_record)
+        return tmp_records
+    
+    def padding_ratio(self):
+        """
+        Returns the fraction of padded pixels at the largest scale
+        with the bucket shapes, and with the padding to a square.
+        """
+        img_area = np.prod(self.img_shapes, axis=1)
+        pad_area = np.prod(
+            self.bucket_dims[self.bucket_ids], axis=1)
+        sq_dims  = np.ceil(np.max(
+            self.img_shapes, axis=1) / self.stride) * self.stride
+        
+        bucket_pad = 1.0 - np.sum(img_area) / np.sum(pad_area)
+        square_pad = 1.0 - np.sum(img_area) / np.sum(sq_dims**2)
+        return bucket_pad, square_pad
+    
+    def report(self):
+        bucket_pad, square_pad = self.padding_ratio()
+        print("Buckets:", str(len(self.bucket_dims)), "shapes", 
+              str(self.bucket_dims.tolist()) + ".")
+        print("Padded Pixels:", str(round(100.0*bucket_pad, 1)) + "%", 
+              "(" + str(round(100.0*square_pad, 1)) + "% as squares).")
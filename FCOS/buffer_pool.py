@@ -0,0 +1,114 @@
+import threading
+import numpy as np
+
+class TargetBufferPool(object):
+    """
+    Pool of pre-allocated float32 target arrays, keyed by their shape
+    (e.g. the feature map shape of a level and its channels), which
+    are reused across the training steps instead of allocating new
+    arrays for every level and image. The encoders mark the regions
+    that they write with `touch`, so that only those regions are
+    zeroed when the buffer is handed out again.
+    Arguments:
+      max_free: The maximum number of free buffers kept per shape.
+      max_touch: The number of touched regions of a buffer above
+        which the whole buffer is zeroed instead.
+    """
+    def __init__(self, max_free=64, max_touch=256):
+        self.max_free  = max_free
+        self.max_touch = max_touch
+        
+        self.n_alloc = 0
+        self.n_reuse = 0
+        self.free_buffers = dict()
+        self.used_buffers = dict()
+        self.touched = dict()
+        self.lock = threading.Lock()
+    
+    def acquire(self, shape):
+        """
+        Returns a zeroed float32 array of the given shape.
+        """
+        shape = tuple([int(x) for x in shape])
+        with self.lock:
+            tmp_free = self.free_buffers.get(shape)
+            if tmp_free:
+                buffer, tmp_touched = tmp_free.pop()
+                self.n_reuse += 1
+            else:
+                buffer, tmp_touched = None, None
+                self.n_alloc += 1
+        
+        if buffer is None:
+            buffer = np.zeros(shape, dtype=np.float32)
+        elif tmp_touched is None:
+            buffer.fill(0.0)
+        else:
+            for tmp_index in tmp_touched:
+                buffer[tmp_index] = 0.0
+        
+        with self.lock:
+            self.used_buffers[id(buffer)] = buffer
+            self.touched[id(buffer)] = []
+        return buffer
+    
+    def touch(self, buffer, index):
+        """
+        Records that `buffer[index]` was written. The index is any
+        numpy index of the buffer, e.g. a tuple of the row and column
+        arrays of the written grid positions.
+        """
+        with self.lock:
+            tmp_touched = self.touched.get(id(buffer))
+            if tmp_touched is None:
+                return None
+            if len(tmp_touched) >= self.max_touch:
+                # Too many regions, so zero the whole buffer. #
+                self.touched[id(buffer)] = None
+            else:
+                tmp_touched.append(index)
+        return None
+    
+    def _base(self, array):
+        # Views of a buffer, e.g. per-anchor slices, map to it. #
+        while id(array) not in self.used_buffers \
+            and isinstance(array, np.ndarray) and array.base is not None:
+            array = array.base
+        return array
+    
+    def release(self, arrays):
+        """
+        Returns the buffers of the (nested) arrays to the pool once
+        they are no longer used. Arrays which are not from the pool
+        are ignored.
+        """
+        if isinstance(arrays, (tuple, list)):
+            for tmp_array in arrays:
+                self.release(tmp_array)
+            return None
+        
+        with self.lock:
+            buffer = self.used_buffers.pop(
+                id(self._base(arrays)), None)
+            if buffer is None:
+                return None
+            
+            tmp_touched = self.touched.pop(id(buffer))
+            tmp_free = self.free_buffers.setdefault(buffer.shape, [])
+            if len(tmp_free) < self.max_free:
+                tmp_free.append((buffer, tmp_touched))
+        return None
+    
+    def release_all(self):
+        """
+        Returns all the buffers which were handed out to the pool, 
+        e.g. at the end of a training step.
+        """
+        with self.lock:
+            tmp_buffers = list(self.used_buffers.values())
+        self.release(tmp_buffers)
+        return None
+    
+    def report(self):
+        print("Target Buffers:", str(self.n_alloc), "allocated,", 
+              str(self.n_reuse), "reused.")
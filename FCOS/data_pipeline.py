@@ -0,0 +1,137 @@
+import numpy as np
+import tensorflow as tf
+
+def flatten_as(structure, outputs):
+    """
+    Flattens the outputs following the nested tuples of structure, 
+    so that array-like leaves (e.g. lists of counts) are kept whole.
+    """
+    if isinstance(structure, (tuple, list)):
+        return [z for x, y in zip(
+            structure, outputs) for z in flatten_as(x, y)]
+    return [outputs]
+
+def py_map_fn(py_fn, output_signature):
+    """
+    Wraps a Python function into a tf.data map function whose
+    outputs follow the (nested) tuple of tf.TensorSpec.
+    """
+    flat_specs = tf.nest.flatten(output_signature)
+    flat_types = [x.dtype for x in flat_specs]
+    
+    def _py_outputs(*args):
+        tmp_outputs = py_fn(*args)
+        return [np.asarray(x, dtype=y.as_numpy_dtype) for x, y in zip(
+            flatten_as(output_signature, tmp_outputs), flat_types)]
+    
+    def _map_fn(*args):
+        tmp_outputs = tf.py_function(
+            _py_outputs, list(args), flat_types)
+        for tmp_output, tmp_spec in zip(tmp_outputs, flat_specs):
+            tmp_output.set_shape(tmp_spec.shape)
+        return tf.nest.pack_sequence_as(output_signature, tmp_outputs)
+    return _map_fn
+
+def build_pipeline(
+    n_data, sample_fn, output_signature, batch_size=None, 
+    shuffle=True, repeat=True, n_parallel=tf.data.AUTOTUNE, 
+    index_fn=None):
+    """
+    Builds a tf.data pipeline which prepares the training samples
+    in parallel map stages and prefetches them, so that the next
+    step is prepared while the current step is training.
+    Arguments:
+      n_data: The number of training samples.
+      sample_fn: A function which takes the index of a sample and
+        returns its prepared arrays, e.g. the decoded, augmented and
+        padded image with its encoded targets.
+      output_signature: A (nested) tuple of tf.TensorSpec of the
+        outputs of `sample_fn`.
+      batch_size: If not None, the samples are batched. The outputs
+        of `sample_fn` must then have the same shape for all samples.
+      shuffle: If True, the samples are reshuffled at every epoch.
+      repeat: If True, the pipeline repeats indefinitely.
+      n_parallel: The number of samples prepared in parallel.
+      index_fn: An optional generator function of the sample indices, 
+        e.g. drawn from a checkpointed sampler. The samples are then
+        prepared in its order, and `shuffle` and `repeat` are unused.
+    Returns:
+      The tf.data.Dataset of the prepared samples.
+    """
+    def _load_sample(tmp_idx):
+        return sample_fn(int(tmp_idx.numpy()))
+    
+    if index_fn is None:
+        tmp_dataset = tf.data.Dataset.range(n_data)
+        if shuffle:
+            tmp_dataset = tmp_dataset.shuffle(
+                n_data, reshuffle_each_iteration=True)
+        if repeat:
+            tmp_dataset = tmp_dataset.repeat()
+    else:
+        tmp_dataset = tf.data.Dataset.from_generator(
+            index_fn, output_signature=tf.TensorSpec([], tf.int64))
+    
+    tmp_dataset = tmp_dataset.map(
+        py_map_fn(_load_sample, output_signature), 
+        num_parallel_calls=n_parallel, 
+        deterministic=index_fn is not None)
+    if batch_size is not None:
+        tmp_dataset = tmp_dataset.batch(batch_size, drop_remainder=True)
+    
+    tmp_options = tf.data.Options()
+    tmp_options.autotune.enabled = True
+    tmp_dataset = tmp_dataset.with_options(tmp_options)
+    return tmp_dataset.prefetch(tf.data.AUTOTUNE)
+
+def build_augment_pipeline(
+    n_data, load_fn, load_signature, augment_fn, 
+    encode_fn, output_signature, aug_batch=16, 
+    shuffle=True, repeat=True, n_parallel=tf.data.AUTOTUNE):
+    """
+    Builds a tf.data pipeline which loads the samples in parallel, 
+    augments them a batch at a time in compiled graph code and then
+    encodes the targets of each augmented sample.
+    Arguments:
+      n_data: The number of training samples.
+      load_fn: A function which takes the index of a sample and
+        returns its (image, bbox, class_id, ...), where the images of
+        all samples have the same shape.
+      load_signature: The tuple of tf.TensorSpec of `load_fn`.
+      augment_fn: A function of the batched images and the ragged
+        boxes and class ids, e.g. `random_flip_horizontal_batch`, 
+        which returns them augmented using only tensor ops.
+      encode_fn: A function which takes the outputs of `augment_fn`
+        for a single sample and returns its prepared arrays.
+      output_signature: The (nested) tuple of tf.TensorSpec of the
+        outputs of `encode_fn`.
+      aug_batch: The number of samples augmented together.
+    Returns:
+      The tf.data.Dataset of the prepared samples.
+    """
+    def _load_sample(tmp_idx):
+        return load_fn(int(tmp_idx.numpy()))
+    
+    tmp_dataset = tf.data.Dataset.range(n_data)
+    if shuffle:
+        tmp_dataset = tmp_dataset.shuffle(
+            n_data, reshuffle_each_iteration=True)
+    if repeat:
+        tmp_dataset = tmp_dataset.repeat()
+    
+    tmp_dataset = tmp_dataset.map(
+        py_map_fn(_load_sample, load_signature), 
+        num_parallel_calls=n_parallel, deterministic=False)
+    tmp_dataset = tmp_dataset.ragged_batch(
+        aug_batch, drop_remainder=True)
+    tmp_dataset = tmp_dataset.map(
+        augment_fn, num_parallel_calls=n_parallel)
+    tmp_dataset = tmp_dataset.unbatch()
+    tmp_dataset = tmp_dataset.map(
+        py_map_fn(encode_fn, output_signature), 
+        num_parallel_calls=n_parallel, deterministic=False)
+    
+    tmp_options = tf.data.Options()
+    tmp_options.autotune.enabled = True
+    tmp_dataset = tmp_dataset.with_options(tmp_options)
+    return tmp_dataset.prefetch(tf.data.AUTOTUNE)
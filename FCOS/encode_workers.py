@@ -0,0 +1,27 @@
+import numpy as np
+import tensorflow as tf
+from data_preprocess import preprocess_data
+from fcos import format_data
+
+# Sample encoders for the workers of SharedEncodePool. They are #
+# kept out of the training scripts so that the spawned workers  #
+# can import them.                                              #
+def prepare_sparse_sample(sample, num_classes, normalize=True):
+    """
+    Returns the augmented and padded image of the sample with its
+    sparse FCOS targets and the number of targets at each scale, 
+    as in the `prepare_sample` of the training script.
+    """
+    image, bbox, class_id, img_dim = preprocess_data(
+        sample, normalize=normalize)
+    class_id = tf.cast(class_id, tf.float32)
+    
+    label = tf.concat([
+        bbox, tf.expand_dims(class_id, 1)], axis=1)
+    img_pad = [int(image.shape[0]), 
+               int(image.shape[1])]
+    
+    tmp_labels, n_labels = format_data(
+        label, img_dim, num_classes, 
+        img_pad=img_pad, sparse=True)
+    return image.numpy(), tmp_labels, np.array(n_labels)
@@ -0,0 +1,92 @@
+import numpy as np
+import tensorflow as tf
+
+class EpochSampler(tf.Module):
+    """
+    Draws the training batches as contiguous slices of a permutation
+    of the samples, which is shuffled once per epoch, so that every
+    epoch covers the samples uniformly and each batch costs O(batch)
+    instead of a full permutation per step. The permutation of an
+    epoch is regenerated from the seed, so that only the epoch and
+    position are kept as variables. Since it is a tf.Module, adding
+    it to the tf.train.Checkpoint saves its position and a restored
+    run continues mid-epoch without re-sampling.
+    Arguments:
+      n_data: The number of training samples.
+      batch_size: The default number of samples per batch.
+      seed: The seed of the permutations. If None, it is drawn.
+      shard_index: The index of this worker's shard.
+      n_shards: The number of workers. Each worker takes its own
+        contiguous part of the epoch's permutation.
+    """
+    def __init__(
+        self, n_data, batch_size, seed=None, 
+        shard_index=0, n_shards=1, name="epoch_sampler"):
+        super(EpochSampler, self).__init__(name=name)
+        if shard_index < 0 or shard_index >= n_shards:
+            raise ValueError(
+                "shard_index has to be between 0 and " + \
+                str(n_shards-1) + ".")
+        if n_data // n_shards < batch_size:
+            raise ValueError(
+                "Each shard needs at least batch_size samples.")
+        
+        if seed is None:
+            seed = np.random.randint(0, 2**31 - 1)
+        self.n_data = n_data
+        self.n_shards = n_shards
+        self.batch_size  = batch_size
+        self.shard_index = shard_index
+        
+        self.seed  = tf.Variable(
+            seed, dtype=tf.int64, trainable=False)
+        self.epoch = tf.Variable(
+            0, dtype=tf.int64, trainable=False)
+        self.position = tf.Variable(
+            0, dtype=tf.int64, trainable=False)
+        
+        self._order = None
+        self._order_key = None
+    
+    def _shard_order(self, epoch):
+        # All the shards draw the same permutation of an epoch. #
+        tmp_rng = np.random.default_rng(
+            [int(self.seed.numpy()), epoch])
+        tmp_perm = tmp_rng.permutation(self.n_data)
+        
+        n_shard = self.n_data // self.n_shards
+        shard_st = self.shard_index * n_shard
+        return tmp_perm[shard_st:(shard_st + n_shard)]
+    
+    def order(self):
+        """
+        Returns the sample order of this shard in the current epoch.
+        """
+        # Rebuild the order if a restore changed the seed or epoch. #
+        tmp_key = (int(self.seed.numpy()), int(self.epoch.numpy()))
+        if self._order_key != tmp_key:
+            self._order = self._shard_order(tmp_key[1])
+            self._order_key = tmp_key
+        return self._order
+    
+    def next_batch(self, n_samples=None):
+        """
+        Returns the indices of the next `n_samples` samples (default
+        batch_size). The remainder of an epoch which is too short for
+        a batch is skipped and the next epoch is started.
+        """
+        if n_samples is None:
+            n_samples = self.batch_size
+        
+        tmp_order = self.order()
+        tmp_pos = int(self.position.numpy())
+        if tmp_pos + n_samples > len(tmp_order):
+            if n_samples > len(tmp_order):
+                raise ValueError(
+                    "n_samples is larger than the shard.")
+            self.epoch.assign_add(1)
+            tmp_order = self.order()
+            tmp_pos = 0
+        
+        self.position.assign(tmp_pos + n_samples)
+        return tmp_order[tmp_pos:(tmp_pos + n_samples)]
@@ -2,11 +2,14 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
+from utils import uint8_image_input
 
 def build_model(
-    num_classes, backbone_model="resnet50"):
+    num_classes, backbone_model="resnet50", uint8_input=False):
     """
     Builds Backbone Model with pre-trained imagenet weights.
+    If uint8_input is True, the model takes uint8 images and
+    normalizes them in its graph, the same as the loaders.
     """
     # Define the focal loss bias. #
     b_focal = tf.constant_initializer(
@@ -26,16 +29,24 @@ def build_model(
             activation=None, use_bias=False, 
             name="reg_layer_" + str(n_layer+1)))
     
+    # Normalize the uint8 images in the graph. #
+    if uint8_input:
+        _, x_image = uint8_image_input()
+    else:
+        x_image = None
+    
     # Backbone Network. #
     if backbone_model.lower() == "resnet50":
         backbone = tf.keras.applications.ResNet50(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", "conv4_block6_out", "conv5_block3_out"]
     else:
         backbone = tf.keras.applications.MobileNetV2(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "block_6_expand", "block_13_expand", "Conv_1"]
@@ -133,11 +144,77 @@ def prediction_to_corners(xy_pred, stride):
     bbox_coord[:, :, 3] = pred_x_upp
     return stride*bbox_coord
 
-def format_data(gt_labels, img_dim, num_classes, 
-                img_pad=None, areas=None, strides=None):
+def sparse_targets(tmp_output):
+    """
+    Converts the dense targets of a feature map into a tuple of
+    (reg_idx, reg_val, cls_idx, cen_map). reg_idx holds the (y, x)
+    positions of the positive locations and reg_val their (t, b, l, r)
+    regression values, cls_idx holds the (y, x, class) indices of the
+    positive class labels and cen_map is the dense centerness map.
+    """
+    cls_output = tmp_output[..., 5:]
+    reg_idx = np.argwhere(np.max(cls_output, axis=-1) >= 1)
+    cls_idx = np.argwhere(cls_output >= 1)
+    
+    reg_val = tmp_output[reg_idx[:, 0], reg_idx[:, 1], :4]
+    cen_map = tmp_output[..., 4]
+    return (reg_idx.astype(np.int32), 
+            reg_val.astype(np.float32), 
+            cls_idx.astype(np.int32), 
+            cen_map.astype(np.float32))
+
+def expand_targets(y_sparse, num_classes):
+    """
+    Expands the sparse targets of a feature map from `sparse_targets`
+    into its dense [H, W, num_classes+5] targets inside the graph.
+    """
+    reg_idx, reg_val, cls_idx, cen_map = y_sparse
+    feat_dims = tf.shape(cen_map)
+    
+    reg_map = tf.scatter_nd(
+        tf.cast(reg_idx, tf.int32), 
+        tf.cast(reg_val, tf.float32), 
+        [feat_dims[0], feat_dims[1], 4])
+    cls_map = tf.scatter_nd(
+        tf.cast(cls_idx, tf.int32), 
+        tf.ones([tf.shape(cls_idx)[0]], dtype=tf.float32), 
+        [feat_dims[0], feat_dims[1], num_classes])
+    
+    cen_map = tf.expand_dims(tf.cast(cen_map, tf.float32), axis=2)
+    return tf.concat([reg_map, cen_map, cls_map], axis=2)
+
+def flip_sparse_targets(tmp_labels):
+    """
+    Flips the sparse targets of every feature map from `format_data`
+    horizontally, to match the padded image flipped left to right.
+    The grid positions are mirrored and the (l, r) regression values
+    are swapped, while the centerness is symmetric.
     """
+    flip_labels = []
+    for reg_idx, reg_val, cls_idx, cen_map in tmp_labels:
+        w_max = tf.shape(cen_map)[1]
+        reg_idx = tf.stack([
+            reg_idx[:, 0], w_max-1 - reg_idx[:, 1]], axis=1)
+        cls_idx = tf.stack([
+            cls_idx[:, 0], w_max-1 - cls_idx[:, 1], 
+            cls_idx[:, 2]], axis=1)
+        reg_val = tf.gather(reg_val, [0, 1, 3, 2], axis=1)
+        
+        cen_map = tf.reverse(cen_map, axis=[1])
+        flip_labels.append((reg_idx, reg_val, cls_idx, cen_map))
+    return tuple(flip_labels)
+
+def format_data_v0(gt_labels, img_dim, num_classes, img_pad=None, 
+                   areas=None, strides=None, sparse=False):
+    """
+    Reference loop implementation of `format_data`, which fills the
+    grid positions of one box at a time. It is kept to benchmark and
+    check the outputs of `format_data`.
     gt_labels: Normalised Gound Truth Bounding Boxes (y, x, h, w).
     num_targets is for debugging purposes.
+    If sparse is True, the targets of each feature map are returned
+    as the (reg_idx, reg_val, cls_idx, cen_map) of `sparse_targets`
+    in float32 instead of the dense float64 array.
     """
     if strides is None:
         strides = [8, 16, 32, 64, 128]
@@ -149,6 +226,11 @@ def format_data(gt_labels, img_dim, num_classes,
     if img_pad is None:
         img_pad = img_dim
     
+    if sparse:
+        out_dtype = np.float32
+    else:
+        out_dtype = np.float64
+    
     gt_height = gt_labels[:, 2]*img_dim[0]
     gt_width  = gt_labels[:, 3]*img_dim[1]
     gt_height = gt_height.numpy()
@@ -163,7 +245,7 @@ def format_data(gt_labels, img_dim, num_classes,
         w_ratio = img_dim[1] / stride
         tmp_output = np.zeros([
             int(img_pad[0] / stride), 
-            int(img_pad[1] / stride), num_classes+5])
+            int(img_pad[1] / stride), num_classes+5], dtype=out_dtype)
         
         if na == 0:
             tmp_idx = [
@@ -375,6 +457,227 @@ def format_data(gt_labels, img_dim, num_classes,
                 
             num_targets.append(len(tmp_labels))
             tmp_outputs.append(tmp_output)
+    
+    if sparse:
+        tmp_outputs = [sparse_targets(x) for x in tmp_outputs]
+    return tmp_outputs, num_targets
+
+def format_data(gt_labels, img_dim, num_classes, img_pad=None, 
+                areas=None, strides=None, sparse=False, 
+                buffer_pool=None):
+    """
+    gt_labels: Normalised Gound Truth Bounding Boxes (y, x, h, w).
+    num_targets is for debugging purposes.
+    If sparse is True, the targets of each feature map are returned
+    as the (reg_idx, reg_val, cls_idx, cen_map) of `sparse_targets`
+    in float32 instead of the dense float64 array.
+    The boxes are assigned to the levels with array ops, and the
+    targets of all grid positions of a level are computed at once.
+    The outputs are the same as those of `format_data_v0` for the
+    tensor `img_dim` of `preprocess_data`, whose (t, b, l, r) are
+    computed in float32 also for the dense float64 array.
+    If a TargetBufferPool is given, the dense arrays are float32
+    buffers of the pool, which have to be released after use.
+    """
+    if strides is None:
+        strides = [8, 16, 32, 64, 128]
+    
+    if areas is None:
+        b_dim = [32, 64, 128, 256]
+    else:
+        b_dim = [np.sqrt(x) for x in areas]
+    
+    if img_pad is None:
+        img_pad = img_dim
+    
+    if sparse or buffer_pool is not None:
+        out_dtype = np.float32
+    else:
+        out_dtype = np.float64
+    
+    def new_array(shape):
+        if buffer_pool is None:
+            return np.zeros(shape, dtype=out_dtype)
+        return buffer_pool.acquire(shape)
+    
+    gt_boxes = np.array(gt_labels, dtype=np.float32).reshape(-1, 5)
+    img_dim  = np.array(img_dim, dtype=np.float32)
+    
+    # Assign each box to a level by its longer side. #
+    gt_height = gt_boxes[:, 2]*img_dim[0]
+    gt_width  = gt_boxes[:, 3]*img_dim[1]
+    gt_level  = np.searchsorted(
+        b_dim, np.maximum(gt_width, gt_height), side="right")
+    
+    num_targets = []
+    tmp_outputs = []
+    for na in range(len(strides)):
+        stride = strides[na]
+        h_max  = int(img_pad[0] / stride)
+        w_max  = int(img_pad[1] / stride)
+        
+        tmp_labels = gt_boxes[gt_level == na]
+        n_labels = len(tmp_labels)
+        num_targets.append(n_labels)
+        
+        if n_labels == 0:
+            if sparse:
+                tmp_outputs.append((
+                    np.zeros([0, 2], dtype=np.int32), 
+                    np.zeros([0, 4], dtype=np.float32), 
+                    np.zeros([0, 3], dtype=np.int32), 
+                    new_array([h_max, w_max])))
+            else:
+                tmp_outputs.append(
+                    new_array([h_max, w_max, num_classes+5]))
+            continue
+        
+        # Sort the labels by area in the same order as the loop, #
+        # so that overlapping grid positions are resolved to the #
+        # box which is filled last.                              #
+        if n_labels > 1:
+            tmp_box_areas = np.multiply(
+                tmp_labels[:, 2]*img_dim[0], 
+                tmp_labels[:, 3]*img_dim[1])
+            tmp_labels = tmp_labels[np.argsort(tmp_box_areas)]
+        
+        # Box boundaries in the image and in the feature map. #
+        h_ratio = img_dim[0] / np.float32(stride)
+        w_ratio = img_dim[1] / np.float32(stride)
+        
+        box_y_low = tmp_labels[:, 0] - tmp_labels[:, 2]/2
+        box_x_low = tmp_labels[:, 1] - tmp_labels[:, 3]/2
+        box_y_upp = tmp_labels[:, 0] + tmp_labels[:, 2]/2
+        box_x_upp = tmp_labels[:, 1] + tmp_labels[:, 3]/2
+        
+        y_low_sc = box_y_low*img_dim[0] / np.float32(stride)
+        x_low_sc = box_x_low*img_dim[1] / np.float32(stride)
+        y_upp_sc = box_y_upp*img_dim[0] / np.float32(stride)
+        x_upp_sc = box_x_upp*img_dim[1] / np.float32(stride)
+        
+        tmp_y_low = np.trunc(box_y_low*h_ratio).astype(np.int64)
+        tmp_x_low = np.trunc(box_x_low*w_ratio).astype(np.int64)
+        tmp_y_upp = np.trunc(box_y_upp*h_ratio).astype(np.int64)
+        tmp_x_upp = np.trunc(box_x_upp*w_ratio).astype(np.int64)
+        
+        tmp_y_low = np.maximum(0, tmp_y_low+1)
+        tmp_x_low = np.maximum(0, tmp_x_low+1)
+        tmp_y_upp = np.minimum(tmp_y_upp+1, h_max)
+        tmp_x_upp = np.minimum(tmp_x_upp+1, w_max)
+        
+        tmp_y_cen = np.trunc(
+            0.5*(tmp_y_low + tmp_y_upp)).astype(np.int64)
+        tmp_x_cen = np.trunc(
+            0.5*(tmp_x_low + tmp_x_upp)).astype(np.int64)
+        tmp_y_cen = np.minimum(tmp_y_cen, h_max-1)
+        tmp_x_cen = np.minimum(tmp_x_cen, w_max-1)
+        idx_class = tmp_labels[:, 4].astype(np.int64)
+        
+        # A box spans its grid positions along an axis if it has   #
+        # any, otherwise only the center row or column. A negative #
+        # center indexes from the end, as in the loop.             #
+        y_valid = tmp_y_upp > tmp_y_low
+        x_valid = tmp_x_upp > tmp_x_low
+        y_cen_idx = np.where(tmp_y_cen < 0, tmp_y_cen+h_max, tmp_y_cen)
+        x_cen_idx = np.where(tmp_x_cen < 0, tmp_x_cen+w_max, tmp_x_cen)
+        
+        row_st = np.where(y_valid, tmp_y_low, y_cen_idx)
+        row_en = np.where(y_valid, tmp_y_upp, y_cen_idx+1)
+        col_st = np.where(x_valid, tmp_x_low, x_cen_idx)
+        col_en = np.where(x_valid, tmp_x_upp, x_cen_idx+1)
+        
+        # Expand every box into the grid positions it fills. #
+        n_cols  = col_en - col_st
+        n_cells = (row_en - row_st) * n_cols
+        box_idx = np.repeat(np.arange(n_labels), n_cells)
+        pos_idx = np.arange(len(box_idx)) - np.repeat(
+            np.cumsum(n_cells) - n_cells, n_cells)
+        pos_y = row_st[box_idx] + pos_idx // n_cols[box_idx]
+        pos_x = col_st[box_idx] + pos_idx % n_cols[box_idx]
+        
+        # Compute the (t, b, l, r) targets of all grid positions. #
+        box_y_valid = y_valid[box_idx]
+        box_x_valid = x_valid[box_idx]
+        box_y_cen = tmp_y_cen[box_idx]
+        box_x_cen = tmp_x_cen[box_idx]
+        
+        y_low_sc = y_low_sc[box_idx]
+        x_low_sc = x_low_sc[box_idx]
+        y_upp_sc = y_upp_sc[box_idx]
+        x_upp_sc = x_upp_sc[box_idx]
+        
+        # The loop subtracts in float32 as its box coordinates are #
+        # tensors, so the differences are rounded the same way.    #
+        grid_y = np.where(
+            box_y_valid, pos_y + 0.5, box_y_cen + 0.5).astype(np.float32)
+        grid_x = np.where(
+            box_x_valid, pos_x + 0.5, box_x_cen + 0.5).astype(np.float32)
+        
+        reg_t = np.maximum(0, grid_y - y_low_sc)
+        reg_l = np.maximum(0, grid_x - x_low_sc)
+        reg_b = np.maximum(0, np.where(
+            box_y_valid, y_upp_sc - grid_y, y_upp_sc - \
+                box_y_cen.astype(np.float32) - np.float32(0.5)))
+        reg_r = np.maximum(0, np.where(
+            box_x_valid, x_upp_sc - grid_x, x_upp_sc - \
+                box_x_cen.astype(np.float32) - np.float32(0.5)))
+        
+        reg_values = np.stack(
+            [reg_t, reg_b, reg_l, reg_r], axis=1).astype(out_dtype)
+        tmp_lr_ratio = np.divide(
+            np.minimum(reg_values[:, 0], 
+                       reg_values[:, 1]) + 1.0e-8, 
+            np.maximum(reg_values[:, 0], 
+                       reg_values[:, 1]) + 1.0e-8)
+        tmp_tb_ratio = np.divide(
+            np.minimum(reg_values[:, 2], 
+                       reg_values[:, 3]) + 1.0e-8, 
+            np.maximum(reg_values[:, 2], 
+                       reg_values[:, 3]) + 1.0e-8)
+        
+        tmp_lr_ratio = np.where(
+            box_y_valid, tmp_lr_ratio, 1.0).astype(out_dtype)
+        tmp_tb_ratio = np.where(
+            box_x_valid, tmp_tb_ratio, 1.0).astype(out_dtype)
+        tmp_center = np.sqrt(
+            np.multiply(tmp_lr_ratio, tmp_tb_ratio))
+        
+        is_center = np.logical_and(
+            pos_y == y_cen_idx[box_idx], pos_x == x_cen_idx[box_idx])
+        tmp_center = np.where(
+            is_center, 1.0, tmp_center).astype(out_dtype)
+        
+        # Keep the targets of the box filled last at each position. #
+        pos_key = pos_y*w_max + pos_x
+        _, last_idx = np.unique(pos_key[::-1], return_index=True)
+        last_idx = len(pos_key) - 1 - last_idx
+        last_y = pos_y[last_idx]
+        last_x = pos_x[last_idx]
+        pos_cls = idx_class[box_idx]
+        
+        if sparse:
+            cls_key = np.unique(pos_key*num_classes + pos_cls)
+            cls_pos = cls_key // num_classes
+            cls_idx = np.stack([
+                cls_pos // w_max, cls_pos % w_max, 
+                cls_key % num_classes], axis=1)
+            
+            cen_map = new_array([h_max, w_max])
+            cen_map[last_y, last_x] = tmp_center[last_idx]
+            if buffer_pool is not None:
+                buffer_pool.touch(cen_map, (last_y, last_x))
+            tmp_outputs.append((
+                np.stack([last_y, last_x], axis=1).astype(np.int32), 
+                reg_values[last_idx].astype(np.float32), 
+                cls_idx.astype(np.int32), cen_map))
+        else:
+            tmp_output = new_array([h_max, w_max, num_classes+5])
+            tmp_output[last_y, last_x, :4] = reg_values[last_idx]
+            tmp_output[last_y, last_x, 4]  = tmp_center[last_idx]
+            tmp_output[pos_y, pos_x, 5+pos_cls] = 1
+            if buffer_pool is not None:
+                buffer_pool.touch(tmp_output, (pos_y, pos_x))
+            tmp_outputs.append(tmp_output)
     return tmp_outputs, num_targets
 
 def smooth_l1_loss(xy_true, xy_pred, mask=1.0, delta=1.0):
@@ -467,10 +770,18 @@ def model_loss(
     cls_lambda=2.5, reg_lambda=1.0):
     """
     y_true: Normalised Gound Truth Bounding Boxes (x, y, w, h).
+    Sparse targets from format_data(..., sparse=True) are expanded
+    into the dense targets inside the graph.
     """
     cen_loss = 0.0
     cls_loss = 0.0
     reg_loss = 0.0
+    
+    num_classes = int(y_pred[0].shape[-1]) - 5
+    if isinstance(y_true[0], (tuple, list)):
+        y_true = [expand_targets(
+            x, num_classes) for x in y_true]
+    
     for n_scale in range(len(y_pred)):
         tmp_obj  = tf.reduce_max(
             y_true[n_scale][..., 5:], axis=-1)
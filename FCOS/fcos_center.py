@@ -2,11 +2,14 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
+from utils import uint8_image_input
 
 def build_model(
-    num_classes, backbone_model="resnet50"):
+    num_classes, backbone_model="resnet50", uint8_input=False):
     """
     Builds Backbone Model with pre-trained imagenet weights.
+    If uint8_input is True, the model takes uint8 images and
+    normalizes them in its graph, the same as the loaders.
     """
     # Define the focal loss bias. #
     b_focal = tf.constant_initializer(
@@ -26,24 +29,33 @@ def build_model(
             activation=None, use_bias=False, 
             name="reg_layer_" + str(n_layer+1)))
     
+    # Normalize the uint8 images in the graph. #
+    if uint8_input:
+        _, x_image = uint8_image_input()
+    else:
+        x_image = None
+    
     # Backbone Network. #
     if backbone_model.lower() == "resnet50":
         backbone = tf.keras.applications.ResNet50(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", 
             "conv4_block6_out", "conv5_block3_out"]
     elif backbone_model.lower() == "resnet101":
         backbone = tf.keras.applications.ResNet101(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", 
             "conv4_block23_out", "conv5_block3_out"]
     else:
         backbone = tf.keras.applications.MobileNetV2(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "block_6_expand", "block_13_expand", "Conv_1"]
@@ -148,10 +160,12 @@ def prediction_to_corners(xy_pred, stride):
 
 def format_data(
     gt_labels, img_dim, num_classes, img_pad=None, 
-    b_dim=None, strides=None, center_only=False):
+    b_dim=None, strides=None, center_only=False, buffer_pool=None):
     """
     gt_labels: Normalised Gound Truth Bounding Boxes (y, x, h, w).
     num_targets is for debugging purposes.
+    If a TargetBufferPool is given, the outputs are float32 buffers
+    of the pool, which have to be released after use.
     """
     if strides is None:
         strides = [8, 16, 32, 64, 128]
@@ -176,8 +190,12 @@ def format_data(
         
         h_max = int(img_pad[0] / stride)
         w_max = int(img_pad[1] / stride)
-        tmp_output = np.zeros([
-            h_max, w_max, num_classes+5])
+        if buffer_pool is None:
+            tmp_output = np.zeros([
+                h_max, w_max, num_classes+5])
+        else:
+            tmp_output = buffer_pool.acquire(
+                [h_max, w_max, num_classes+5])
         
         if na == 0:
             tmp_idx = [
@@ -245,6 +263,11 @@ def format_data(
                     (tmp_x_cen-x_off) for x_off in \
                     pos_offsets if (tmp_x_cen-x_off) >= 0]
                 
+                if buffer_pool is not None:
+                    buffer_pool.touch(tmp_output, (
+                        slice(max(tmp_y_cen-1, 0), tmp_y_cen+2), 
+                        slice(max(tmp_x_cen-1, 0), tmp_x_cen+2)))
+                
                 for tmp_x in tmp_x_coord:
                     for tmp_y in tmp_y_coord:
                         if tmp_y >= h_max or tmp_x >= w_max:
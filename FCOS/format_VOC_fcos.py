@@ -3,6 +3,7 @@ import time
 import numpy as np
 import pandas as pd
 import pickle as pkl
+from annotation_store import update_store
 
 # Parameters. #
 min_side = 384
@@ -21,8 +22,6 @@ raw_voc_df  = pd.read_csv(tmp_pd_file)
 tmp_df_cols = ["filename", "width", "height", 
                "xmin", "xmax", "ymin", "ymax", "label"]
 raw_voc_df  = pd.DataFrame(raw_voc_df, columns=tmp_df_cols)
-image_files = sorted(list(pd.unique(raw_voc_df["filename"])))
-image_files = pd.DataFrame(image_files, columns=["filename"])
 
 # The VOC data class names. #
 class_names = list(
@@ -33,49 +32,39 @@ id_2_label  = dict(
     [(x, class_names[x]) for x in range(len(class_names))])
 
 elapsed_tm = (time.time() - start_tm) / 60.0
-print("Total of", str(len(image_files)), "images in VOC dataset.")
 print("Elapsed time:", str(elapsed_tm), "mins.")
 
 # Format the data. #
 print("Formatting VOC data.")
 start_tm = time.time()
 
+# Sort once and split the objects by image. #
+raw_voc_df = raw_voc_df.sort_values(
+    "filename", kind="stable").reset_index(drop=True)
+img_names, img_start = np.unique(
+    raw_voc_df["filename"].values, return_index=True)
+img_end = np.append(img_start[1:], len(raw_voc_df))
+print("Total of", str(len(img_names)), "images in VOC dataset.")
+
+# Normalise all the bounding boxes at once. #
+img_width  = raw_voc_df["width"].values
+img_height = raw_voc_df["height"].values
+all_bboxes = np.stack([
+    raw_voc_df["xmin"].values / img_width, 
+    raw_voc_df["ymin"].values / img_height, 
+    raw_voc_df["xmax"].values / img_width, 
+    raw_voc_df["ymax"].values / img_height], axis=1)
+all_labels = np.array([
+    label_2_id[x] for x in raw_voc_df["label"].values])
+
 voc_objects = []
-for n_img in range(len(image_files)):
-    img_file = image_files.iloc[n_img]["filename"]
-    
-    tmp_filter = raw_voc_df[
-        raw_voc_df["filename"] == img_file]
-    tmp_filter = tmp_filter[[
-        "width", "height", "label", 
-        "xmin", "xmax", "ymin", "ymax"]]
-    n_objects  = len(tmp_filter)
+for n_img in range(len(img_names)):
+    img_file = img_names[n_img]
+    id_st = img_start[n_img]
+    id_en = img_end[n_img]
     
-    tmp_bboxes = []
-    tmp_labels = []
-    for n_obj in range(n_objects):
-        tmp_object = tmp_filter.iloc[n_obj]
-        img_width  = tmp_object["width"]
-        img_height = tmp_object["height"]
-        box_x_min  = tmp_object["xmin"] / img_width
-        box_x_max  = tmp_object["xmax"] / img_width
-        box_y_min  = tmp_object["ymin"] / img_height
-        box_y_max  = tmp_object["ymax"] / img_height
-        
-        tmp_bbox = np.array([
-            box_x_min, box_y_min, 
-            box_x_max, box_y_max])
-        tmp_label = np.array([
-            label_2_id[tmp_object["label"]]])
-        
-        tmp_labels.append(np.expand_dims(tmp_label, axis=0))
-        tmp_bboxes.append(np.expand_dims(tmp_bbox, axis=0))
-    
-    tmp_labels = np.concatenate(tmp_labels, axis=0)
-    tmp_labels = tmp_labels.reshape((n_objects,))
-    tmp_bboxes = np.concatenate(tmp_bboxes, axis=0)
-    tmp_objects = {"bbox": tmp_bboxes, 
-                   "label": tmp_labels}
+    tmp_objects = {"bbox": all_bboxes[id_st:id_en], 
+                   "label": all_labels[id_st:id_en]}
     
     voc_objects.append({
         "image": img_file, 
@@ -83,6 +72,8 @@ for n_img in range(len(image_files)):
         "max_side": max_side, 
         "l_jitter": l_jitter, 
         "u_jitter": u_jitter, 
+        "width": int(img_width[id_st]), 
+        "height": int(img_height[id_st]), 
         "objects": tmp_objects})
     
     if (n_img+1) % 1000 == 0:
@@ -99,4 +90,10 @@ save_pkl_file = tmp_path + "voc_data.pkl"
 with open(save_pkl_file, "wb") as tmp_save:
     pkl.dump(id_2_label, tmp_save)
     pkl.dump(voc_objects, tmp_save)
+
+# Patch only the changed images in the annotation store. #
+n_update = update_store(
+    tmp_path + "voc_data_store/", 
+    id_2_label, voc_objects, prune=True)
+print(str(n_update), "images updated in the annotation store.")
 print("VOC data processed.")
@@ -4,24 +4,23 @@ import pickle as pkl
 import tensorflow as tf
 from matplotlib import pyplot as plt
 from utils import swap_xy, visualize_detections
+from utils import decode_jpeg_scaled, model_input
 from fcos import build_model, prediction_to_corners
 
 # Custom function to load image. #
 # Custom function to parse the data. #
-def _parse_image(filename):
-    image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    return tf.cast(image_decoded, tf.float32)
+def _parse_image(filename, min_side=None):
+    image_string = tf.io.read_file(filename)
+    return decode_jpeg_scaled(image_string, min_side=min_side)
 
-def prepare_image(image, img_w=384, img_h=384):
+def prepare_image(image, model, img_w=384, img_h=384):
     img_dims = [int(image.shape[0]), 
                 int(image.shape[1])]
     w_ratio  = img_dims[0] / img_w
     h_ratio  = img_dims[1] / img_h
     
     img_resized = tf.image.resize(image, [img_w, img_h])
-    img_resized = img_resized / 127.5 - 1.0
+    img_resized = model_input(img_resized, model)
     return tf.expand_dims(img_resized, axis=0), w_ratio, h_ratio
 
 def image_detections(
@@ -70,7 +69,7 @@ def detect_heatmap(
     img_resized = tf.image.resize(
         image, [img_rows, img_cols])
     img_resized = tf.expand_dims(img_resized, axis=0)
-    img_resized = img_resized / 127.5 - 1.0
+    img_resized = model_input(img_resized, model)
     tmp_predict = model(img_resized, training=False)
     
     tmp_heatmap = []
@@ -126,8 +125,11 @@ with open(load_pkl_file, "rb") as tmp_load:
 backbone_name = "mobilenetv2"
 num_classes = len(id_2_label)
 
+# Match the input type of the trained model. #
+uint8_input = False
 fcos_model = build_model(
-    num_classes, backbone_model="mobilenetv2")
+    num_classes, backbone_model="mobilenetv2", 
+    uint8_input=uint8_input)
 model_optimizer = tf.optimizers.Adam()
 
 # Loading weights. #
@@ -156,9 +158,9 @@ iou_thresh = 0.50
 
 #image_file = "test_image.jpg"
 image_file = voc_dataset[25]["image"]
-raw_image  = _parse_image(image_file)
+raw_image  = _parse_image(image_file, min_side=384)
 input_image, w_ratio, h_ratio = \
-    prepare_image(raw_image, img_w=384, img_h=384)
+    prepare_image(raw_image, fcos_model, img_w=384, img_h=384)
 
 tmp_detect = image_detections(
     input_image, fcos_model, num_classes, 
@@ -1,31 +1,99 @@
-
 import os
+import time
 import pandas as pd
-from bs4 import BeautifulSoup
+from multiprocessing import Pool, cpu_count
+from xml.etree.ElementTree import iterparse
+from annotation_store import check_source, load_manifest, save_manifest
 
 tmp_path = "C:/Users/admin/Desktop/Data/VOCdevkit/VOC2012/Annotations/"
 img_path = "C:/Users/admin/Desktop/Data/VOCdevkit/VOC2012/JPEGImages/"
-tmp_xmls = os.listdir(tmp_path)
-
-tmp_count = 0
-tmp_objects = []
-for tmp_xml in tmp_xmls:
-    with open(tmp_path+tmp_xml) as xml_file:
-        tmp_soup = BeautifulSoup(xml_file.read())
-        
-        tmp_image  = img_path+tmp_soup.find("filename").text
-        tmp_object = tmp_soup.find("object").find("name").text
-        tmp_objects.append((tmp_image, tmp_object))
-    
-    tmp_count += 1
-    if tmp_count % 1000 == 0:
-        print(str(tmp_count/len(tmp_xmls)*100) +\
-              "% of annotations processed.")
+man_file = "C:/Users/admin/Desktop/Data/VOCdevkit/VOC2012/voc_2012_manifest.pkl"
 
-tmp_pd_file = \
-    "C:/Users/admin/Desktop/Data/VOCdevkit/VOC2012/voc_2012_annotations.csv"
-tmp_objects_df = pd.DataFrame(
-    tmp_objects, columns=["image_file", "object_class"])
-tmp_objects_df.to_csv(tmp_pd_file, index=False)
+# Only parse the annotations which changed since the last run. #
+incremental = True
 
+# Custom function to parse the annotations. #
+def parse_voc_xml(xml_file):
+    """
+    Parses a VOC annotation with the C-backed ElementTree parser
+    and returns one (filename, width, height, xmin, xmax, ymin, 
+    ymax, label) tuple for every object in the image.
+    """
+    tmp_file = ""
+    tmp_size = dict()
+    tmp_objects = []
+    for tmp_event, tmp_elem in iterparse(xml_file):
+        if tmp_elem.tag == "filename":
+            tmp_file = tmp_elem.text.strip()
+        elif tmp_elem.tag == "size":
+            tmp_size = dict([(
+                x.tag, x.text) for x in tmp_elem])
+        elif tmp_elem.tag == "object":
+            tmp_bbox = tmp_elem.find("bndbox")
+            tmp_objects.append((
+                tmp_elem.findtext("name").strip(), 
+                float(tmp_bbox.findtext("xmin")), 
+                float(tmp_bbox.findtext("xmax")), 
+                float(tmp_bbox.findtext("ymin")), 
+                float(tmp_bbox.findtext("ymax"))))
+            tmp_elem.clear()
+    
+    tmp_image  = img_path + tmp_file
+    img_width  = int(float(tmp_size["width"]))
+    img_height = int(float(tmp_size["height"]))
+    return [(tmp_image, img_width, img_height, 
+             x_min, x_max, y_min, y_max, tmp_label) \
+             for tmp_label, x_min, x_max, y_min, y_max in tmp_objects]
 
+if __name__ == "__main__":
+    start_tm = time.time()
+    tmp_xmls = [
+        tmp_path + x for x in sorted(
+            os.listdir(tmp_path)) if x.endswith(".xml")]
+    
+    # Check the annotations against the manifest. #
+    if incremental:
+        manifest = load_manifest(man_file)
+    else:
+        manifest = dict()
+    
+    new_manifest = dict()
+    parse_xmls = []
+    for tmp_xml in tmp_xmls:
+        changed, tmp_entry = check_source(manifest, tmp_xml)
+        if changed or "objects" not in tmp_entry:
+            parse_xmls.append(tmp_xml)
+        new_manifest[tmp_xml] = tmp_entry
+    del manifest
+    
+    n_workers = cpu_count()
+    n_chunk = max(1, int(len(parse_xmls) / (4*n_workers)))
+    print("Parsing", str(len(parse_xmls)), "of", 
+          str(len(tmp_xmls)), "annotations", 
+          "with", str(n_workers), "processes.")
+    
+    if len(parse_xmls) > 0:
+        with Pool(processes=n_workers) as tmp_pool:
+            for tmp_count, xml_objects in enumerate(tmp_pool.imap(
+                parse_voc_xml, parse_xmls, chunksize=n_chunk)):
+                new_manifest[parse_xmls[tmp_count]]["objects"] = xml_objects
+                
+                if (tmp_count+1) % 1000 == 0:
+                    print(str((tmp_count+1)/len(parse_xmls)*100) +\
+                          "% of annotations processed.")
+    
+    tmp_objects = []
+    for tmp_xml in tmp_xmls:
+        tmp_objects.extend(new_manifest[tmp_xml]["objects"])
+    
+    tmp_pd_file = \
+        "C:/Users/admin/Desktop/Data/VOCdevkit/VOC2012/voc_2012_objects.csv"
+    tmp_df_cols = ["filename", "width", "height", 
+                   "xmin", "xmax", "ymin", "ymax", "label"]
+    tmp_objects_df = pd.DataFrame(tmp_objects, columns=tmp_df_cols)
+    tmp_objects_df.to_csv(tmp_pd_file, index=False)
+    save_manifest(man_file, new_manifest)
+    
+    elapsed_tm = (time.time() - start_tm) / 60.0
+    print("Total of", str(len(tmp_objects_df)), "objects.")
+    print("Elapsed Time:", str(round(elapsed_tm, 3)), "mins.")
@@ -0,0 +1,230 @@
+import os
+import sys
+import queue
+import traceback
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+# Offsets of the arrays in a slot are aligned to cache lines. #
+_ALIGN = 64
+
+def _flatten(outputs):
+    # Split the (nested) tuples and lists into arrays and structure. #
+    if isinstance(outputs, (tuple, list)):
+        tmp_leaves = []
+        tmp_struct = []
+        for tmp_output in outputs:
+            x_leaves, x_struct = _flatten(tmp_output)
+            tmp_leaves += x_leaves
+            tmp_struct.append(x_struct)
+        return tmp_leaves, (isinstance(outputs, tuple), tmp_struct)
+    return [np.asarray(outputs, order="C")], None
+
+def _unflatten(struct, leaves):
+    if struct is None:
+        return next(leaves)
+    
+    tmp_outputs = [_unflatten(x, leaves) for x in struct[1]]
+    if struct[0]:
+        return tuple(tmp_outputs)
+    return tmp_outputs
+
+def _worker_loop(
+    encode_fn, init_fn, init_args, 
+    slot_names, slot_bytes, task_q, free_q, result_q):
+    slots = [shared_memory.SharedMemory(name=x) for x in slot_names]
+    if init_fn is not None:
+        encode_state = init_fn(*init_args)
+    
+    while True:
+        tmp_args = task_q.get()
+        if tmp_args is None:
+            break
+        
+        try:
+            if init_fn is None:
+                tmp_outputs = encode_fn(*tmp_args)
+            else:
+                tmp_outputs = encode_fn(encode_state, *tmp_args)
+            
+            leaves, struct = _flatten(tmp_outputs)
+            offsets = []
+            n_bytes = 0
+            for tmp_leaf in leaves:
+                if tmp_leaf.dtype.hasobject:
+                    raise ValueError(
+                        "Outputs must be numeric arrays, not " + \
+                        str(tmp_leaf.dtype) + ".")
+                offsets.append(n_bytes)
+                n_bytes += -(-tmp_leaf.nbytes // _ALIGN) * _ALIGN
+            
+            if n_bytes > slot_bytes:
+                raise ValueError(
+                    "Outputs of " + str(n_bytes) + " bytes exceed " + \
+                    "the slot size of " + str(slot_bytes) + " bytes.")
+        except Exception:
+            result_q.put((None, None, traceback.format_exc()))
+            continue
+        
+        # Wait for a free slot and copy the outputs into it. #
+        n_slot = free_q.get()
+        tmp_buf = slots[n_slot].buf
+        tmp_meta = []
+        for tmp_leaf, tmp_offset in zip(leaves, offsets):
+            np.ndarray(
+                tmp_leaf.shape, dtype=tmp_leaf.dtype, 
+                buffer=tmp_buf, offset=tmp_offset)[...] = tmp_leaf
+            tmp_meta.append(
+                (tmp_offset, tmp_leaf.shape, tmp_leaf.dtype.str))
+        
+        del tmp_buf
+        result_q.put((n_slot, struct, tmp_meta))
+    
+    for tmp_slot in slots:
+        tmp_slot.close()
+    return None
+
+class SharedEncodePool(object):
+    """
+    Pool of worker processes which prepare the training samples, 
+    e.g. decode the image and encode its targets, outside of the
+    training process so that the encoding does not hold its GIL.
+    Each worker writes the (nested tuples of) arrays of a sample
+    into a free slot of a ring of shared memory blocks, and `get`
+    returns numpy views of the slot without copying. The views are
+    valid until `release_all` returns their slots to the ring.
+    The functions are sent to spawned processes, so they have to be
+    importable from a module other than the training script.
+    Arguments:
+      encode_fn: A function which takes the arguments of `submit`
+        and returns the prepared arrays of a sample.
+      n_workers: The number of worker processes. Defaults to one
+        less than the number of cores.
+      n_slots: The number of shared memory slots of the ring. This
+        has to be at least the number of samples held at once.
+      slot_mb: The size of each slot in MB.
+      init_fn: If not None, it is called once in each worker with
+        `init_args`, and its output is passed as the first argument
+        of `encode_fn`, e.g. to build the model which encodes the
+        targets.
+      cpu_only: If True, the workers do not see the GPUs, so that
+        TensorFlow in the workers does not take GPU memory.
+    """
+    def __init__(
+        self, encode_fn, n_workers=None, n_slots=64, slot_mb=32, 
+        init_fn=None, init_args=(), cpu_only=True):
+        if n_workers is None:
+            n_workers = max(1, (os.cpu_count() or 2) - 1)
+        
+        self.n_slots = n_slots
+        self.slot_bytes = int(slot_mb * 1024 * 1024)
+        self.slots = [shared_memory.SharedMemory(
+            create=True, size=self.slot_bytes) for _ in range(n_slots)]
+        
+        tmp_context = mp.get_context("spawn")
+        self.task_q = tmp_context.Queue()
+        self.free_q = tmp_context.Queue()
+        self.result_q = tmp_context.Queue()
+        for n_slot in range(n_slots):
+            self.free_q.put(n_slot)
+        
+        self.n_submit = 0
+        self.n_result = 0
+        self.held_slots = []
+        self.workers = [tmp_context.Process(
+            target=_worker_loop, args=(
+                encode_fn, init_fn, init_args, 
+                [x.name for x in self.slots], self.slot_bytes, 
+                self.task_q, self.free_q, self.result_q), 
+            daemon=True) for _ in range(n_workers)]
+        
+        # The training scripts run at the top level, so the spawned #
+        # workers must not re-run the main script when they start.  #
+        main_module = sys.modules["__main__"]
+        main_file = getattr(main_module, "__file__", None)
+        tmp_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+        try:
+            if main_file is not None:
+                del main_module.__file__
+            if cpu_only:
+                os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+            for tmp_worker in self.workers:
+                tmp_worker.start()
+        finally:
+            if main_file is not None:
+                main_module.__file__ = main_file
+            if cpu_only and tmp_devices is None:
+                del os.environ["CUDA_VISIBLE_DEVICES"]
+            elif cpu_only:
+                os.environ["CUDA_VISIBLE_DEVICES"] = tmp_devices
+    
+    @property
+    def n_pending(self):
+        # Samples submitted but not yet returned by `get`. #
+        return self.n_submit - self.n_result
+    
+    def submit(self, *args):
+        """
+        Queues a sample, given the arguments of `encode_fn`.
+        """
+        self.task_q.put(args)
+        self.n_submit += 1
+        return None
+    
+    def get(self, timeout=1.0):
+        """
+        Returns the prepared arrays of the next finished sample, 
+        in the order that the workers finish them.
+        """
+        while True:
+            try:
+                n_slot, struct, tmp_meta = self.result_q.get(
+                    timeout=timeout)
+                break
+            except queue.Empty:
+                if not all([x.is_alive() for x in self.workers]):
+                    raise RuntimeError("A worker process has exited.")
+        
+        self.n_result += 1
+        if n_slot is None:
+            raise RuntimeError(
+                "Sample encoding failed in a worker:\n" + tmp_meta)
+        
+        self.held_slots.append(n_slot)
+        tmp_buf = self.slots[n_slot].buf
+        leaves = [np.ndarray(
+            shape, dtype=np.dtype(dtype), buffer=tmp_buf, 
+            offset=offset) for offset, shape, dtype in tmp_meta]
+        return _unflatten(struct, iter(leaves))
+    
+    def release_all(self):
+        """
+        Returns the slots of the samples from `get` to the ring, 
+        e.g. at the end of a training step. Their views must no
+        longer be used afterwards.
+        """
+        for n_slot in self.held_slots:
+            self.free_q.put(n_slot)
+        self.held_slots = []
+        return None
+    
+    def close(self):
+        """
+        Stops the workers and frees the shared memory.
+        """
+        self.release_all()
+        for _ in self.workers:
+            self.task_q.put(None)
+        for tmp_worker in self.workers:
+            tmp_worker.join(timeout=5.0)
+            if tmp_worker.is_alive():
+                tmp_worker.terminate()
+        for tmp_slot in self.slots:
+            try:
+                tmp_slot.close()
+            except BufferError:
+                # Views of the slot are still referenced. #
+                pass
+            tmp_slot.unlink()
+        return None
@@ -0,0 +1,209 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import pickle as pkl
+import tensorflow as tf
+from collections import OrderedDict
+
+class TargetCache(object):
+    """
+    Size-bounded LRU cache of the encoded training targets, so that
+    the targets of an image are only encoded once for as long as
+    the image, its boxes and labels, its input size, its flip and
+    the encoder config stay the same. Entries are kept as numpy
+    arrays in RAM and, if a cache directory is given, as compressed
+    `.npz` files on disk which persist across runs. The on-disk
+    entries are cleared when the cache is opened with another config
+    and the least recently used files are removed above `max_disk_mb`.
+    Arguments:
+      config: A hashable tuple of the encoder settings, e.g. the
+        model name, strides, number of classes and b_dim or anchor
+        configuration. It is part of every key.
+      max_mb: The maximum size of the entries in RAM in MB.
+      cache_dir: An optional directory of the on-disk entries, which
+        should not be shared by caches of different configs.
+      max_disk_mb: The maximum size of the on-disk entries in MB.
+    """
+    def __init__(
+        self, config, max_mb=1024, cache_dir=None, max_disk_mb=8192):
+        self.config = config
+        self.max_bytes = int(max_mb * 1048576)
+        self.max_disk_bytes = int(max_disk_mb * 1048576)
+        self.cache_dir = cache_dir
+        
+        self.disk_bytes = 0
+        if cache_dir is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            self._check_config()
+            self.disk_bytes = sum([x[2] for x in self._disk_entries()])
+        
+        self.n_bytes = 0
+        self.n_hits  = 0
+        self.n_miss  = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def make_key(self, sample, img_dim, img_pad, flip_flag):
+        """
+        Returns the key of the targets of a sample. It holds a digest
+        of the boxes and labels of the sample, so that the targets of
+        edited annotations are encoded again.
+        """
+        obj_hash = hashlib.sha1()
+        obj_hash.update(np.ascontiguousarray(
+            sample["objects"]["bbox"], dtype=np.float64).tobytes())
+        obj_hash.update(np.ascontiguousarray(
+            sample["objects"]["label"], dtype=np.int64).tobytes())
+        
+        img_dim = tuple([round(float(x), 3) for x in img_dim])
+        img_pad = tuple([int(x) for x in img_pad])
+        return (sample["image"], obj_hash.hexdigest(), 
+                img_dim, img_pad, bool(flip_flag), self.config)
+    
+    def _key_file(self, key):
+        key_hash = hashlib.sha1(repr(key).encode("utf-8"))
+        return os.path.join(
+            self.cache_dir, key_hash.hexdigest() + ".npz")
+    
+    def _disk_entries(self):
+        # The (mtime, path, size) of the complete on-disk entries. #
+        tmp_entries = []
+        for tmp_entry in os.scandir(self.cache_dir):
+            if tmp_entry.name.endswith(".npz") \
+                and ".tmp." not in tmp_entry.name:
+                tmp_stat = tmp_entry.stat()
+                tmp_entries.append((
+                    tmp_stat.st_mtime, tmp_entry.path, tmp_stat.st_size))
+        return tmp_entries
+    
+    def _check_config(self):
+        # Clear the on-disk entries written with another config. #
+        config_file = os.path.join(self.cache_dir, "config.pkl")
+        old_config = None
+        if os.path.isfile(config_file):
+            with open(config_file, "rb") as tmp_load:
+                old_config = pkl.load(tmp_load)
+        
+        if old_config != self.config:
+            for _, tmp_path, _ in self._disk_entries():
+                os.remove(tmp_path)
+            with open(config_file, "wb") as tmp_save:
+                pkl.dump(self.config, tmp_save)
+        return None
+    
+    def _evict_disk(self):
+        # Remove the least recently used files down to 90% of #
+        # the budget, so that the directory is not scanned on #
+        # every write.                                        #
+        tmp_entries = sorted(self._disk_entries())
+        n_bytes = sum([x[2] for x in tmp_entries])
+        for _, tmp_path, tmp_size in tmp_entries:
+            if n_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            n_bytes -= tmp_size
+        self.disk_bytes = n_bytes
+        return None
+    
+    def _insert(self, key, entry):
+        # Evict the least recently used entries. #
+        entry_bytes = sum([x.nbytes for x in entry[1]])
+        with self.lock:
+            if key in self.entries:
+                return None
+            
+            self.entries[key] = entry
+            self.n_bytes += entry_bytes
+            while self.n_bytes > self.max_bytes \
+                and len(self.entries) > 1:
+                _, old_entry = self.entries.popitem(last=False)
+                self.n_bytes -= sum([x.nbytes for x in old_entry[1]])
+        return None
+    
+    def get(self, key):
+        """
+        Returns the cached targets of the key, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        
+        if entry is None and self.cache_dir is not None:
+            key_file = self._key_file(key)
+            try:
+                with np.load(key_file) as tmp_load:
+                    structure = pkl.loads(
+                        tmp_load["structure"].tobytes())
+                    entry = (structure, [tmp_load[
+                        "arr_%d" % x] for x in range(len(tmp_load.files)-1)])
+                
+                # Mark the file as recently used for the eviction. #
+                os.utime(key_file)
+                self._insert(key, entry)
+            except FileNotFoundError:
+                entry = None
+        
+        with self.lock:
+            if entry is None:
+                self.n_miss += 1
+                return None
+            self.n_hits += 1
+        return tf.nest.pack_sequence_as(entry[0], entry[1])
+    
+    def put(self, key, targets):
+        """
+        Stores the (nested) targets of the key.
+        """
+        structure = tf.nest.map_structure(lambda x: 0, targets)
+        entry = (structure, [
+            np.asarray(x) for x in tf.nest.flatten(targets)])
+        self._insert(key, entry)
+        
+        if self.cache_dir is not None:
+            key_file = self._key_file(key)
+            tmp_arrays = dict([(
+                "arr_%d" % x, entry[1][x]) for x in range(len(entry[1]))])
+            tmp_arrays["structure"] = np.frombuffer(
+                pkl.dumps(structure), dtype=np.uint8)
+            
+            # Write to a temporary file so that readers never #
+            # see a partially written entry.                  #
+            tmp_file = key_file[:-4] + ".%d.tmp.npz" % threading.get_ident()
+            np.savez_compressed(tmp_file, **tmp_arrays)
+            os.replace(tmp_file, key_file)
+            
+            with self.lock:
+                self.disk_bytes += os.path.getsize(key_file)
+                if self.disk_bytes > self.max_disk_bytes:
+                    self._evict_disk()
+        return None
+    
+    def encode(self, key, encode_fn):
+        """
+        Returns the cached targets of the key, calling `encode_fn`
+        to encode and store them on a miss.
+        """
+        targets = self.get(key)
+        if targets is None:
+            targets = encode_fn()
+            self.put(key, targets)
+        return targets
+    
+    def hit_rate(self):
+        n_total = self.n_hits + self.n_miss
+        return self.n_hits / max(1, n_total)
+    
+    def report(self):
+        print("Target Cache:", str(len(self.entries)), "entries,", 
+              str(round(self.n_bytes / 1048576, 1)), "MB,", 
+              str(round(self.disk_bytes / 1048576, 1)), "MB on disk,", 
+              str(self.n_hits), "hits,", str(self.n_miss), "misses.")
@@ -0,0 +1,194 @@
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+
+def _bytes_feature(value):
+    return tf.train.Feature(
+        bytes_list=tf.train.BytesList(value=[value]))
+
+def _int64_feature(value):
+    return tf.train.Feature(
+        int64_list=tf.train.Int64List(value=list(value)))
+
+def _float_feature(value):
+    return tf.train.Feature(
+        float_list=tf.train.FloatList(value=list(value)))
+
+# Features of each serialized example. #
+feature_desc = {
+    "image": tf.io.FixedLenFeature([], tf.string), 
+    "encoded": tf.io.FixedLenFeature([], tf.string), 
+    "min_side": tf.io.FixedLenFeature([], tf.int64), 
+    "max_side": tf.io.FixedLenFeature([], tf.int64), 
+    "l_jitter": tf.io.FixedLenFeature([], tf.int64), 
+    "u_jitter": tf.io.FixedLenFeature([], tf.int64), 
+    "bbox": tf.io.VarLenFeature(tf.float32), 
+    "label": tf.io.VarLenFeature(tf.int64)}
+
+def serialize_record(tmp_record, encoded):
+    tmp_bbox  = np.reshape(tmp_record["objects"]["bbox"], (-1,))
+    tmp_label = np.reshape(tmp_record["objects"]["label"], (-1,))
+    tmp_feature = {
+        "image": _bytes_feature(tmp_record["image"].encode("utf-8")), 
+        "encoded": _bytes_feature(encoded), 
+        "min_side": _int64_feature([tmp_record.get("min_side", 0)]), 
+        "max_side": _int64_feature([tmp_record.get("max_side", 0)]), 
+        "l_jitter": _int64_feature([tmp_record.get("l_jitter", 0)]), 
+        "u_jitter": _int64_feature([tmp_record.get("u_jitter", 0)]), 
+        "bbox": _float_feature(tmp_bbox), 
+        "label": _int64_feature(tmp_label)}
+    tmp_example = tf.train.Example(
+        features=tf.train.Features(feature=tmp_feature))
+    return tmp_example.SerializeToString()
+
+def balance_shards(file_sizes, n_shards):
+    """
+    Assigns each file to a shard so that the total bytes of the
+    shards are balanced. The largest files are placed first, each
+    into the shard with the fewest bytes so far.
+    Returns the shard index of every file.
+    """
+    shard_bytes = np.zeros([n_shards], dtype=np.int64)
+    shard_index = np.zeros([len(file_sizes)], dtype=np.int64)
+    for n_file in np.argsort(file_sizes)[::-1]:
+        n_shard = np.argmin(shard_bytes)
+        shard_index[n_file] = n_shard
+        shard_bytes[n_shard] += file_sizes[n_file]
+    return shard_index
+
+def write_tfrecord_shards(
+    record_dir, records, n_shards=16, prefix="train"):
+    """
+    Packs the encoded images and their normalized boxes and labels
+    into size-balanced TFRecord shards.
+    Arguments:
+      record_dir: The directory to write the shards into.
+      records: A list of records as in voc_data.pkl or an
+        AnnotationStore.
+      n_shards: The number of shards to write.
+      prefix: The prefix of the shard files.
+    Within each shard, the records are kept in their original order.
+    """
+    if not os.path.isdir(record_dir):
+        os.makedirs(record_dir)
+    
+    n_shards  = max(1, min(n_shards, len(records)))
+    img_files = [records[x]["image"] for x in range(len(records))]
+    img_sizes = [os.path.getsize(x) for x in img_files]
+    shard_idx = balance_shards(img_sizes, n_shards)
+    
+    for n_shard in range(n_shards):
+        shard_file = os.path.join(
+            record_dir, "%s-%05d-of-%05d.tfrecord" % (
+                prefix, n_shard, n_shards))
+        with tf.io.TFRecordWriter(shard_file) as tmp_writer:
+            for n_img in np.nonzero(shard_idx == n_shard)[0]:
+                with open(img_files[n_img], "rb") as tmp_file:
+                    encoded = tmp_file.read()
+                tmp_writer.write(serialize_record(
+                    records[n_img], encoded))
+        print("Shard", str(n_shard+1), "of", str(n_shards), "written.")
+    return None
+
+def parse_example(serialized):
+    tmp_example = tf.io.parse_single_example(
+        serialized, feature_desc)
+    tmp_bbox  = tf.reshape(tf.sparse.to_dense(
+        tmp_example["bbox"]), [-1, 4])
+    tmp_label = tf.sparse.to_dense(tmp_example["label"])
+    
+    tmp_sample = {
+        "image": tmp_example["image"], 
+        "encoded": tmp_example["encoded"], 
+        "min_side": tmp_example["min_side"], 
+        "max_side": tmp_example["max_side"], 
+        "l_jitter": tmp_example["l_jitter"], 
+        "u_jitter": tmp_example["u_jitter"], 
+        "objects": {"bbox": tmp_bbox, "label": tmp_label}}
+    return tmp_sample
+
+def load_tfrecord_dataset(
+    record_dir, prefix="train", cycle_length=4, 
+    shuffle_buffer=1024, repeat=True):
+    """
+    Returns a dataset which reads the shards in parallel, so that
+    each shard is read sequentially, and shuffles the examples.
+    """
+    shard_files = tf.data.Dataset.list_files(os.path.join(
+        record_dir, prefix + "-*.tfrecord"), shuffle=True)
+    if repeat:
+        shard_files = shard_files.repeat()
+    
+    # Read each shard in large sequential blocks. #
+    tmp_dataset = shard_files.interleave(
+        lambda x: tf.data.TFRecordDataset(x, buffer_size=8388608), 
+        cycle_length=cycle_length, 
+        num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    tmp_dataset = tmp_dataset.shuffle(shuffle_buffer)
+    tmp_dataset = tmp_dataset.map(
+        parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+    return tmp_dataset.prefetch(tf.data.AUTOTUNE)
+
+class TFRecordReader(object):
+    """
+    Iterates over the shuffled TFRecord shards. `next_batch` returns
+    a list of samples in the same format as the records of the
+    annotation store, with the additional `encoded` JPEG bytes so
+    that `preprocess_data` does not read the image from its path.
+    If `images` is given, only the records of those image files are
+    returned, e.g. the samples of a valid index.
+    """
+    def __init__(
+        self, record_dir, prefix="train", 
+        cycle_length=4, shuffle_buffer=1024, images=None):
+        if images is None:
+            self.images = None
+        else:
+            self.images = set(images)
+        
+        self.dataset = load_tfrecord_dataset(
+            record_dir, prefix=prefix, cycle_length=cycle_length, 
+            shuffle_buffer=shuffle_buffer, repeat=True)
+        self.iterator = iter(self.dataset)
+    
+    def next_sample(self):
+        tmp_sample = next(self.iterator)
+        tmp_image  = tmp_sample["image"].numpy().decode("utf-8")
+        if self.images is not None:
+            while tmp_image not in self.images:
+                tmp_sample = next(self.iterator)
+                tmp_image  = tmp_sample["image"].numpy().decode("utf-8")
+        
+        tmp_record = {
+            "image": tmp_image, "encoded": tmp_sample["encoded"]}
+        for tmp_col in ["min_side", "max_side", "l_jitter", "u_jitter"]:
+            tmp_record[tmp_col] = int(tmp_sample[tmp_col])
+        tmp_record["objects"] = {
+            "bbox": tmp_sample["objects"]["bbox"].numpy(), 
+            "label": tmp_sample["objects"]["label"].numpy()}
+        return tmp_record
+    
+    def next_batch(self, batch_size):
+        return [self.next_sample() for _ in range(batch_size)]
+
+if __name__ == "__main__":
+    # Write the TFRecord shards of an annotation store. #
+    from annotation_store import AnnotationStore
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_dir", type=str)
+    parser.add_argument("record_dir", type=str)
+    parser.add_argument("--n_shards", type=int, default=16)
+    parser.add_argument("--prefix", type=str, default="train")
+    parser.add_argument("--n_images", type=int, default=0)
+    args = parser.parse_args()
+    
+    tmp_store = AnnotationStore(args.store_dir)
+    if args.n_images > 0:
+        tmp_store = tmp_store[:args.n_images]
+    write_tfrecord_shards(
+        args.record_dir, tmp_store, 
+        n_shards=args.n_shards, prefix=args.prefix)
+    print("Total of", str(len(tmp_store)), "images written", 
+          "to", args.record_dir + ".")
@@ -1,13 +1,26 @@
 
+import os
 import time
+import functools
 import numpy as np
 import pandas as pd
-import pickle as pkl
 from matplotlib import pyplot as plt
 
 import tensorflow as tf
-from data_preprocess import preprocess_data
-from fcos import build_model, format_data, model_loss
+from data_preprocess import preprocess_data, random_jitter_image
+from annotation_store import load_annotations
+from image_cache import ImageCache
+from tfrecord_data import TFRecordReader
+from data_pipeline import build_pipeline
+from target_cache import TargetCache
+from epoch_sampler import EpochSampler
+from bucket_sampler import BucketSampler
+from shared_pool import SharedEncodePool
+from buffer_pool import TargetBufferPool
+from echo_buffer import EchoBuffer
+from encode_workers import prepare_sparse_sample
+from fcos import build_model, format_data, expand_targets, model_loss
+from fcos import flip_sparse_targets
 
 # For debugging. #
 def show_heatmap(
@@ -83,6 +96,74 @@ def show_heatmap(
     del fig, ax
     return None
 
+# Function to prepare a single training sample. #
+def prepare_sample(
+    sample, num_classes, img_cache=None, 
+    target_cache=None, buffer_pool=None, normalize=True):
+    """
+    Returns the augmented and padded image of the sample with its
+    sparse FCOS targets and the number of targets at each scale. If a
+    TargetCache is given, the flip is drawn here so that it keys
+    the cached targets. If normalize is False, the image is uint8.
+    """
+    flip_flag = None
+    if target_cache is not None:
+        flip_flag = np.random.uniform() <= 0.5
+    
+    image, bbox, class_id, img_dim = preprocess_data(
+        sample, img_cache=img_cache, 
+        flip_flag=flip_flag, normalize=normalize)
+    class_id = tf.cast(class_id, tf.float32)
+    
+    label = tf.concat([
+        bbox, tf.expand_dims(class_id, 1)], axis=1)
+    img_pad = [int(image.shape[0]), 
+               int(image.shape[1])]
+    
+    def _encode(buffer_pool=None):
+        return format_data(
+            label, img_dim, num_classes, img_pad=img_pad, 
+            sparse=True, buffer_pool=buffer_pool)
+    
+    # Pooled buffers are reused, so they are never cached. #
+    if target_cache is None:
+        tmp_labels, n_labels = _encode(buffer_pool=buffer_pool)
+    else:
+        tmp_key = target_cache.make_key(
+            sample, img_dim, img_pad, flip_flag)
+        tmp_labels, n_labels = target_cache.encode(tmp_key, _encode)
+    
+    if sum(n_labels) == 0:
+        print("No targets in", sample["image"] + ".")
+        print(bbox*np.array(img_dim + img_dim))
+    return image, tmp_labels, n_labels
+
+# Function to draw the records of the next batch. #
+def sample_batch(sampler, train_data):
+    """
+    Returns the records of the next batch of the sampler. Those of
+    a BucketSampler carry the padded shape of their bucket.
+    """
+    batch_sample = sampler.next_batch()
+    if isinstance(sampler, BucketSampler):
+        return sampler.bucket_records(train_data, batch_sample)
+    return [train_data[x] for x in batch_sample]
+
+# Function to augment an echoed training sample. #
+def echo_sample(tmp_sample):
+    """
+    Returns a prepared sample with a fresh random flip of its image
+    and its sparse targets, and a jitter of its image, without
+    decoding or encoding it again.
+    """
+    image, tmp_labels, n_labels = tmp_sample
+    if np.random.uniform() <= 0.5:
+        image = tf.image.flip_left_right(image)
+        tmp_labels = flip_sparse_targets(tmp_labels)
+    
+    image = random_jitter_image(image)
+    return image, tmp_labels, n_labels
+
 # Training function. #
 def train(
     train_data, training_loss, model, 
@@ -90,8 +171,21 @@ def train(
     st_step, max_steps, init_lr=1.0e-3, min_lr=1.0e-5, 
     decay_step=1000, decay_rate=0.99, display_step=50, 
     step_save=100, step_cool=1000, weight_decay=1.0e-4, 
-    gradient_clip=1.0, save_loss_file="train_losses.csv"):
+    gradient_clip=1.0, save_loss_file="train_losses.csv", 
+    img_cache=None, record_reader=None, 
+    data_iter=None, target_cache=None, sampler=None, 
+    encode_pool=None, buffer_pool=None):
+    # Only one source of the training samples can be used. #
+    n_sources = len([x for x in [
+        data_iter, encode_pool, record_reader] if x is not None])
+    if n_sources > 1:
+        raise ValueError(
+            "Only one of data_iter, encode_pool and " + \
+            "record_reader can be given.")
+    
     n_data = len(train_data)
+    if sampler is None:
+        sampler = EpochSampler(n_data, batch_size)
     strides = [8, 16, 32, 64, 128]
     tmp_sizes = [32, 64, 128, 256]
     
@@ -109,8 +203,24 @@ def train(
             decay_rate, int(step / decay_step)), min_lr)
         optimizer.lr.assign(step_lr)
         
-        batch_sample = np.random.choice(
-            n_data, size=batch_size, replace=False)
+        # Return the target buffers of the last step to the pool. #
+        if buffer_pool is not None:
+            buffer_pool.release_all()
+        
+        if record_reader is not None:
+            batch_data = record_reader.next_batch(batch_size)
+        elif data_iter is not None:
+            batch_data = [next(data_iter) for _ in range(batch_size)]
+        elif encode_pool is not None:
+            # Return the slots of the last step to the ring, and  #
+            # keep the next batch encoding while this one trains. #
+            encode_pool.release_all()
+            while encode_pool.n_pending < 2*batch_size:
+                for tmp_sample in sample_batch(sampler, train_data):
+                    encode_pool.submit(tmp_sample)
+            batch_data = [encode_pool.get() for _ in range(batch_size)]
+        else:
+            batch_data = sample_batch(sampler, train_data)
         
         # Zero the gradients at each step. #
         acc_gradients = [
@@ -125,30 +235,24 @@ def train(
         reg_losses = 0.0
         cls_losses = 0.0
         cen_losses = 0.0
-        for tmp_idx in batch_sample:
-#            image, bbox, class_id = \
-#                resize_image(train_data[tmp_idx])
-            image, bbox, class_id, img_dim = \
-                preprocess_data(train_data[tmp_idx])
-            class_id = tf.cast(class_id, tf.float32)
-            
-            label = tf.concat([
-                bbox, tf.expand_dims(class_id, 1)], axis=1)
+        for tmp_sample in batch_data:
+            # Samples from the pipeline or workers are prepared. #
+            if data_iter is None and encode_pool is None:
+                image, tmp_labels, n_labels = prepare_sample(
+                    tmp_sample, num_classes, 
+                    img_cache=img_cache, target_cache=target_cache, 
+                    buffer_pool=buffer_pool, normalize=not uint8_input)
+            else:
+                image, tmp_labels, n_labels = tmp_sample
+                n_labels = list(np.array(n_labels))
             image = tf.expand_dims(image, axis=0)
             
-            img_pad = [int(image.shape[1]), 
-                       int(image.shape[2])]
-            
-            tmp_labels, n_labels = format_data(
-                label, img_dim, num_classes, img_pad=img_pad)
-            
 #            tmp_image = 127.5 * (image[0] + 1.0)
-#            show_heatmap(tmp_image, tmp_labels, 
+#            img_pad = [int(image.shape[1]), int(image.shape[2])]
+#            show_heatmap(tmp_image, [expand_targets(
+#                x, num_classes).numpy() for x in tmp_labels], 
 #                         img_rows=img_pad[0], img_cols=img_pad[1])
             
-            if sum(n_labels) == 0:
-                print("No targets at index", str(tmp_idx) + ".")
-                print(bbox*np.array(img_dim + img_dim))
             with tf.GradientTape() as grad_tape:
                 tmp_output = model(image, training=True)
                 tmp_losses = model_loss(
@@ -219,6 +323,12 @@ def train(
             print("Average Reg Loss:", str(round(avg_reg_loss, 5)))
             print("Average Cls Loss:", str(round(avg_cls_loss, 5)))
             print("Average Cen Loss:", str(round(avg_cen_loss, 5)))
+            if target_cache is not None:
+                target_cache.report()
+            if buffer_pool is not None:
+                buffer_pool.report()
+            if isinstance(data_iter, EchoBuffer):
+                data_iter.report()
             
             if (step+1) % step_save == 0:
                 # Save the training losses. #
@@ -252,10 +362,23 @@ def train(
 
 # Load the data. #
 tmp_path = "C:/Users/admin/Desktop/Data/VOCdevkit/VOC2012/"
-load_pkl_file = tmp_path + "voc_data.pkl"
-with open(load_pkl_file, "rb") as tmp_load:
-    id_2_label  = pkl.load(tmp_load)
-    voc_dataset = pkl.load(tmp_load)
+store_dir = tmp_path + "voc_data_store/"
+id_2_label, voc_dataset = load_annotations(store_dir)
+
+# Use the pre-decoded images if the cache has been built. #
+cache_dir = tmp_path + "voc_image_cache/"
+if os.path.isdir(cache_dir):
+    img_cache = ImageCache(cache_dir)
+else:
+    img_cache = None
+
+# Read the training data from the TFRecord shards if written, #
+# instead of the pipeline or the encode pool.                 #
+record_dir = tmp_path + "voc_tfrecords/"
+if os.path.isdir(record_dir):
+    record_reader = TFRecordReader(record_dir)
+else:
+    record_reader = None
 
 train_data = voc_dataset[:15000]
 test_data  = voc_dataset[15000:]
@@ -279,8 +402,109 @@ decay_step = 1000
 batch_size  = 16
 num_classes = len(id_2_label)
 
+# Cache the encoded targets across epochs. The jittered input #
+# sizes rarely repeat, so the cache is off by default here.   #
+use_target_cache = False
+if use_target_cache:
+    target_cache = TargetCache(
+        ("fcos", (8, 16, 32, 64, 128), num_classes, "sparse"), 
+        max_mb=4096, cache_dir=tmp_path + "voc_target_cache/")
+else:
+    target_cache = None
+
+# Feed uint8 images, which the model normalizes in the graph.  #
+# This changes the layers, so it needs a fresh checkpoint.     #
+uint8_input = False
+
+# Batch the images by aspect ratio and pad each one to the  #
+# shape of its bucket instead of a square, if the store has #
+# the image sizes. The sampler is saved with the checkpoint #
+# to resume mid-epoch.                                      #
+img_sizes = train_data.image_sizes()
+use_buckets = bool(np.all(img_sizes > 0))
+if use_buckets:
+    sampler = BucketSampler(
+        img_sizes, batch_size, 
+        np.array([x["u_jitter"] for x in train_data]), 
+        np.array([x["max_side"] for x in train_data]))
+    sampler.report()
+else:
+    sampler = EpochSampler(len(train_data), batch_size)
+
+# Encode the samples in worker processes, which write them  #
+# into a ring of shared memory slots for the training loop. #
+# The workers decode from disk without the image or target  #
+# caches, and replace the pipeline and echo buffer, so it   #
+# is off by default.                                        #
+use_encode_pool = False
+if use_encode_pool:
+    encode_pool = SharedEncodePool(functools.partial(
+        prepare_sparse_sample, num_classes=num_classes, 
+        normalize=not uint8_input), 
+        n_slots=4*batch_size)
+else:
+    encode_pool = None
+
+# Prepare the samples in a parallel tf.data pipeline, in the #
+# order of the sampler so that the batches keep its buckets.  #
+# The checkpointed position is ahead of the training by the   #
+# prefetched samples, which are skipped when resuming.        #
+use_pipeline = not use_encode_pool and record_reader is None
+if use_pipeline:
+    n_strides = 5
+    img_dtype = tf.uint8 if uint8_input else tf.float32
+    pipe_signature = (
+        tf.TensorSpec([None, None, 3], img_dtype), 
+        tuple([(tf.TensorSpec([None, 2], tf.int32), 
+                tf.TensorSpec([None, 4], tf.float32), 
+                tf.TensorSpec([None, 3], tf.int32), 
+                tf.TensorSpec([None, None], tf.float32)) \
+                    for _ in range(n_strides)]), 
+        tf.TensorSpec([n_strides], tf.int32))
+    
+    def pipe_index():
+        while True:
+            for tmp_idx in sampler.next_batch():
+                yield tmp_idx
+    
+    def pipe_sample(tmp_idx):
+        if use_buckets:
+            tmp_sample = sampler.bucket_records(train_data, [tmp_idx])[0]
+        else:
+            tmp_sample = train_data[tmp_idx]
+        return prepare_sample(
+            tmp_sample, num_classes, 
+            img_cache=img_cache, target_cache=target_cache, 
+            normalize=not uint8_input)
+    
+    data_iter = iter(build_pipeline(
+        len(train_data), pipe_sample, 
+        pipe_signature, index_fn=pipe_index))
+else:
+    data_iter = None
+
+# Reuse each prepared sample up to echo_factor times with a #
+# fresh flip and jitter, so that the training loop does not #
+# wait for the decoding and encoding of the pipeline. It    #
+# mixes the batches, so it is not used with the buckets.    #
+use_echo = use_pipeline and not use_buckets
+echo_factor = 2
+if use_echo:
+    data_iter = EchoBuffer(
+        data_iter, echo_factor=echo_factor, 
+        buffer_size=8*batch_size, augment_fn=echo_sample)
+
+# Reuse the centerness maps of the sequential Python encoder, #
+# which is used when the samples are read from the TFRecords. #
+if data_iter is None and not use_encode_pool \
+    and target_cache is None:
+    buffer_pool = TargetBufferPool()
+else:
+    buffer_pool = None
+
 fcos_model = build_model(
-    num_classes, backbone_model="resnet50")
+    num_classes, backbone_model="resnet50", 
+    uint8_input=uint8_input)
 model_optimizer = tf.optimizers.SGD(
     learning_rate=init_lr, momentum=0.9)
 
@@ -288,6 +512,7 @@ print(fcos_model.summary())
 
 checkpoint = tf.train.Checkpoint(
     step=tf.Variable(0), 
+    sampler=sampler, 
     fcos_model=fcos_model, 
     model_optimizer=model_optimizer)
 ck_manager = tf.train.CheckpointManager(
@@ -321,4 +546,11 @@ train(
     min_lr=min_lr, decay_step=decay_step, 
     weight_decay=0.0, gradient_clip=grad_clip, 
     decay_rate=decay_rate, display_step=disp_step, 
-    step_cool=step_cool, save_loss_file=train_loss)
+    step_cool=step_cool, save_loss_file=train_loss, 
+    img_cache=img_cache, record_reader=record_reader, 
+    data_iter=data_iter, target_cache=target_cache, 
+    sampler=sampler, encode_pool=encode_pool, 
+    buffer_pool=buffer_pool)
+
+if encode_pool is not None:
+    encode_pool.close()
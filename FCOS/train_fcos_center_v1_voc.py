@@ -9,6 +9,8 @@ from data_preprocess import swap_xy, preprocess_data
 import tensorflow as tf
 from fcos_center_v1 import prediction_to_corners
 from fcos_center_v1 import build_model, format_data, model_loss
+from epoch_sampler import EpochSampler
+from buffer_pool import TargetBufferPool
 
 # For debugging. #
 def show_heatmap(
@@ -135,8 +137,11 @@ def train(
     st_step, max_steps, init_lr=1e-3, min_lr=1e-5, 
     decay_step=1000, decay_rate=0.99, img_dims=384, 
     display_step=50, step_save=100, step_cool=1000, 
-    gradient_clip=1.0, save_loss_file="train_losses.csv"):
+    gradient_clip=1.0, save_loss_file="train_losses.csv", 
+    sampler=None, buffer_pool=None):
     n_data = len(train_data)
+    if sampler is None:
+        sampler = EpochSampler(n_data, batch_size)
     #strides = [8, 16, 32, 64, 128]
     tmp_sizes = [32, 64, 128, 256]
     box_scale = tmp_sizes + [img_dims]
@@ -160,8 +165,11 @@ def train(
         step_lr = max(step_lr, min_lr)
         optimizer.lr.assign(step_lr)
         
-        batch_sample = np.random.choice(
-            n_data, size=batch_size, replace=False)
+        # Return the target buffers of the last step to the pool. #
+        if buffer_pool is not None:
+            buffer_pool.release_all()
+        
+        batch_sample = sampler.next_batch()
         
         # Zero the gradients at each step. #
         acc_gradients = [
@@ -186,8 +194,8 @@ def train(
                        int(image.shape[2])]
             tmp_labels, n_labels = format_data(
                 label, img_dim, 
-                num_classes, img_pad=img_pad, 
-                b_dim=tmp_sizes, center_only=True)
+                num_classes, img_pad=img_pad, b_dim=tmp_sizes, 
+                center_only=True, buffer_pool=buffer_pool)
             
             if sum(n_labels) == 0:
                 print("No targets at index", str(tmp_idx) + ".")
@@ -257,6 +265,8 @@ def train(
             print("Average Reg Loss:", str(round(avg_reg_loss, 5)))
             print("Average Cls Loss:", str(round(avg_cls_loss, 5)))
             print("Average Cen Loss:", str(round(avg_cen_loss, 5)))
+            if buffer_pool is not None:
+                buffer_pool.report()
             
             # Show the ground truth for debugging purposes. #
             tmp_image = 127.5 * (image[0] + 1.0)
@@ -330,12 +340,20 @@ fcos_model = build_model(
     num_classes, backbone_model="resnet50")
 model_optimizer = tf.optimizers.SGD(momentum=0.9)
 
+# Reuse the target arrays across the training steps. #
+buffer_pool = TargetBufferPool()
+
 print("-" * 50)
 print("FCOS Network Built.")
 print(fcos_model.summary())
 
+# Draw the batches epoch by epoch, and save the position of #
+# the sampler with the checkpoint to resume mid-epoch.      #
+sampler = EpochSampler(len(train_data), batch_size)
+
 checkpoint = tf.train.Checkpoint(
     step=tf.Variable(0), 
+    sampler=sampler, 
     fcos_model=fcos_model, 
     model_optimizer=model_optimizer)
 ck_manager = tf.train.CheckpointManager(
@@ -369,4 +387,5 @@ train(
     min_lr=min_lr, decay_step=decay_step, 
     img_dims=img_dims, gradient_clip=grad_clip, 
     decay_rate=decay_rate, display_step=disp_step, 
-    step_cool=step_cool, save_loss_file=train_loss)
+    step_cool=step_cool, save_loss_file=train_loss, 
+    sampler=sampler, buffer_pool=buffer_pool)
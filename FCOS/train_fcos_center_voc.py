@@ -5,10 +5,14 @@ import pandas as pd
 import pickle as pkl
 from matplotlib import pyplot as plt
 from data_preprocess import swap_xy, preprocess_data
+from data_pipeline import build_pipeline
+from target_cache import TargetCache
+from buffer_pool import TargetBufferPool
 
 import tensorflow as tf
 from fcos_center import prediction_to_corners
 from fcos_center import build_model, format_data, model_loss
+from epoch_sampler import EpochSampler
 
 # For debugging. #
 def show_heatmap(
@@ -126,6 +130,46 @@ def show_heatmap(
     del fig, ax
     return None
 
+# Function to prepare a single training sample. #
+def prepare_sample(
+    sample, num_classes, b_dim=None, 
+    target_cache=None, buffer_pool=None):
+    """
+    Returns the resized image of the sample with its FCOS targets
+    and the number of targets at each scale. If a TargetCache is
+    given, the flip is drawn here so that it keys the targets.
+    """
+    flip_flag = None
+    if target_cache is not None:
+        flip_flag = np.random.uniform() <= 0.5
+    
+    image, bbox, class_id, img_dim = preprocess_data(
+        sample, pad_flag=False, flip_flag=flip_flag)
+    class_id = tf.cast(class_id, tf.float32)
+    
+    label = tf.concat([
+        bbox, tf.expand_dims(class_id, 1)], axis=1)
+    img_pad = [int(image.shape[0]), 
+               int(image.shape[1])]
+    def _encode(buffer_pool=None):
+        return format_data(
+            label, img_dim, 
+            num_classes, img_pad=img_pad, b_dim=b_dim, 
+            center_only=True, buffer_pool=buffer_pool)
+    
+    # Pooled buffers are reused, so they are never cached. #
+    if target_cache is None:
+        tmp_labels, n_labels = _encode(buffer_pool=buffer_pool)
+    else:
+        tmp_key = target_cache.make_key(
+            sample, img_dim, img_pad, flip_flag)
+        tmp_labels, n_labels = target_cache.encode(tmp_key, _encode)
+    
+    if sum(n_labels) == 0:
+        print("No targets in", sample["image"] + ".")
+        print(bbox*np.array(img_dim + img_dim))
+    return image, tmp_labels, n_labels
+
 # Training function. #
 def train(
     train_data, training_loss, model, 
@@ -133,8 +177,12 @@ def train(
     st_step, max_steps, init_lr=1.0e-3, min_lr=1.0e-5, 
     decay_step=1000, decay_rate=0.99, display_step=50, 
     step_save=100, step_cool=1000, weight_decay=1.0e-4, 
-    gradient_clip=1.0, save_loss_file="train_losses.csv"):
+    gradient_clip=1.0, save_loss_file="train_losses.csv", 
+    data_iter=None, target_cache=None, sampler=None, 
+    buffer_pool=None):
     n_data = len(train_data)
+    if sampler is None:
+        sampler = EpochSampler(n_data, batch_size)
     #strides = [8, 16, 32, 64, 128]
     tmp_sizes = [32, 64, 128, 256]
     
@@ -157,8 +205,15 @@ def train(
         step_lr = max(step_lr, min_lr)
         optimizer.lr.assign(step_lr)
         
-        batch_sample = np.random.choice(
-            n_data, size=batch_size, replace=False)
+        # Return the target buffers of the last step to the pool. #
+        if buffer_pool is not None:
+            buffer_pool.release_all()
+        
+        if data_iter is None:
+            batch_sample = sampler.next_batch()
+            batch_data = [train_data[x] for x in batch_sample]
+        else:
+            batch_data = [next(data_iter) for _ in range(batch_size)]
         
         # Zero the gradients at each step. #
         acc_gradients = [
@@ -170,25 +225,20 @@ def train(
         reg_losses = 0.0
         cls_losses = 0.0
         cen_losses = 0.0
-        for tmp_idx in batch_sample:
-            image, bbox, class_id, img_dim = preprocess_data(
-                train_data[tmp_idx], pad_flag=False)
-            class_id = tf.cast(class_id, tf.float32)
-            
-            label = tf.concat([
-                bbox, tf.expand_dims(class_id, 1)], axis=1)
+        for tmp_sample in batch_data:
+            # Samples from the pipeline are already prepared. #
+            if data_iter is None:
+                image, tmp_labels, n_labels = prepare_sample(
+                    tmp_sample, num_classes, 
+                    b_dim=tmp_sizes, target_cache=target_cache, 
+                    buffer_pool=buffer_pool)
+            else:
+                image, tmp_labels, n_labels = tmp_sample
+                n_labels = list(n_labels.numpy())
             image = tf.expand_dims(image, axis=0)
             
             img_pad = [int(image.shape[1]), 
                        int(image.shape[2])]
-            tmp_labels, n_labels = format_data(
-                label, img_dim, 
-                num_classes, img_pad=img_pad, 
-                b_dim=tmp_sizes, center_only=True)
-            
-            if sum(n_labels) == 0:
-                print("No targets at index", str(tmp_idx) + ".")
-                print(bbox*np.array(img_dim + img_dim))
             with tf.GradientTape() as grad_tape:
                 tmp_output = model(image, training=True)
                 tmp_losses = model_loss(
@@ -255,6 +305,10 @@ def train(
             print("Average Reg Loss:", str(round(avg_reg_loss, 5)))
             print("Average Cls Loss:", str(round(avg_cls_loss, 5)))
             print("Average Cen Loss:", str(round(avg_cen_loss, 5)))
+            if target_cache is not None:
+                target_cache.report()
+            if buffer_pool is not None:
+                buffer_pool.report()
             
             # Show the ground truth for debugging purposes. #
             tmp_image = 127.5 * (image[0] + 1.0)
@@ -322,13 +376,55 @@ decay_step = 1000
 batch_size  = 16
 num_classes = len(id_2_label)
 
+# Cache the encoded targets of the fixed-size inputs, so #
+# that repeated epochs skip the target encoding.         #
+use_target_cache = True
+if use_target_cache:
+    target_cache = TargetCache(
+        ("fcos_center", (8, 16, 32, 64, 128), 
+         num_classes, (32, 64, 128, 256)), 
+        max_mb=4096, cache_dir=tmp_path + "voc_center_target_cache/")
+else:
+    target_cache = None
+
+# Prepare the samples in a parallel tf.data pipeline. #
+use_pipeline = True
+if use_pipeline:
+    n_strides = 5
+    pipe_signature = (
+        tf.TensorSpec([None, None, 3], tf.float32), 
+        tuple([tf.TensorSpec([None, None, num_classes+5], 
+            tf.float32) for _ in range(n_strides)]), 
+        tf.TensorSpec([n_strides], tf.int32))
+    
+    def pipe_sample(tmp_idx):
+        return prepare_sample(
+            train_data[tmp_idx], num_classes, 
+            b_dim=[32, 64, 128, 256], target_cache=target_cache)
+    
+    data_iter = iter(build_pipeline(
+        len(train_data), pipe_sample, pipe_signature))
+else:
+    data_iter = None
+
+# Reuse the target arrays of the sequential Python encoder. #
+if not use_pipeline and target_cache is None:
+    buffer_pool = TargetBufferPool()
+else:
+    buffer_pool = None
+
 fcos_model = build_model(
     num_classes, backbone_model="resnet50")
 model_optimizer = tf.optimizers.Adam()
 print(fcos_model.summary())
 
+# Draw the batches epoch by epoch, and save the position of #
+# the sampler with the checkpoint to resume mid-epoch.      #
+sampler = EpochSampler(len(train_data), batch_size)
+
 checkpoint = tf.train.Checkpoint(
     step=tf.Variable(0), 
+    sampler=sampler, 
     fcos_model=fcos_model, 
     model_optimizer=model_optimizer)
 ck_manager = tf.train.CheckpointManager(
@@ -362,4 +458,6 @@ train(
     min_lr=min_lr, decay_step=decay_step, 
     weight_decay=0.0, gradient_clip=grad_clip, 
     decay_rate=decay_rate, display_step=disp_step, 
-    step_cool=step_cool, save_loss_file=train_loss)
+    step_cool=step_cool, save_loss_file=train_loss, 
+    data_iter=data_iter, target_cache=target_cache, 
+    sampler=sampler, buffer_pool=buffer_pool)
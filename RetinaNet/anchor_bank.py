@@ -0,0 +1,80 @@
+import threading
+import numpy as np
+import tensorflow as tf
+from collections import OrderedDict
+
+class AnchorBank(object):
+    """
+    Bounded LRU cache of the anchor grids of a RetinaNet model, so
+    that the anchors of a feature map shape and level are generated
+    once and then shared by the target encoding and the decoding of
+    the detections. Each entry is a dict of the anchor centers of the
+    grid cells and the anchor sizes of the level, as numpy arrays
+    (`centers`, `sizes`) and as TF constants (`centers_tf`, 
+    `sizes_tf`). The centers are the (y, x) pixel positions of the
+    cells and the sizes the (height, width) of each anchor.
+    Arguments:
+      anchor_boxes: The (height, width) of every anchor of each level.
+      strides: The stride of each level.
+      max_entries: The maximum number of cached (shape, level) grids.
+    """
+    def __init__(self, anchor_boxes, strides, max_entries=64):
+        self.strides = list(strides)
+        self.max_entries = max_entries
+        self.anchor_sizes = [np.array(
+            x, dtype=np.float32) for x in anchor_boxes]
+        
+        self.n_hits  = 0
+        self.n_miss  = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def _build(self, feat_shape, level):
+        stride = self.strides[level]
+        ry = np.arange(feat_shape[0], dtype=np.float64) * stride
+        rx = np.arange(feat_shape[1], dtype=np.float64) * stride
+        [grid_x, grid_y] = np.meshgrid(rx, ry)
+        
+        centers = np.stack([grid_y, grid_x], axis=2)
+        sizes = self.anchor_sizes[level]
+        return {
+            "centers": centers, "sizes": sizes, 
+            "centers_tf": tf.constant(centers, dtype=tf.float32), 
+            "sizes_tf": tf.constant(sizes, dtype=tf.float32)}
+    
+    def get(self, feat_shape, level):
+        """
+        Returns the anchors of the level for a feature map of shape
+        `feat_shape` (height, width), building them on a miss.
+        """
+        if level >= len(self.strides) or level < 0:
+            raise ValueError(
+                "level has to be between 0 and " + \
+                str(len(self.strides)-1) + ".")
+        
+        key = (int(feat_shape[0]), int(feat_shape[1]), level)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.n_hits += 1
+                self.entries.move_to_end(key)
+                return entry
+            self.n_miss += 1
+        
+        entry = self._build(key[:2], level)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+    
+    def get_levels(self, feat_shapes):
+        """
+        Returns the anchors of every level, given the feature map
+        shape of each level.
+        """
+        return [self.get(feat_shapes[x], x) \
+            for x in range(len(feat_shapes))]
@@ -0,0 +1,324 @@
+import os
+import hashlib
+import argparse
+import numpy as np
+import pickle as pkl
+
+# Columns of the image table. #
+param_cols = [
+    "min_side", "max_side", "l_jitter", "u_jitter", "width", "height"]
+
+def write_store(store_dir, id_2_label, records):
+    """
+    Writes the list of per-image records into a columnar store.
+    Arguments:
+      store_dir: The directory to write the store into.
+      id_2_label: The dictionary mapping the class id to its label.
+      records: A list of dicts with the keys `image`, `min_side`, 
+        `max_side`, `l_jitter`, `u_jitter` and `objects`, as in
+        voc_data.pkl and coco_data_fcos.pkl. The optional `width`
+        and `height` of the image are stored as 0 if missing.
+    The store consists of an image table (`image_files.npy` and
+    `image_params.npy`), an offset array `offsets.npy` into the
+    contiguous `bboxes.npy` and `labels.npy` arrays and the label
+    map `label_map.pkl`.
+    """
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    
+    n_objects = [len(x["objects"]["label"]) for x in records]
+    img_offsets = np.zeros([len(records)+1], dtype=np.int64)
+    img_offsets[1:] = np.cumsum(n_objects)
+    
+    image_files = np.array([
+        x["image"].encode("utf-8") for x in records])
+    image_params = np.array([[
+        x.get(y, 0) for y in param_cols] \
+        for x in records], dtype=np.int32).reshape(-1, len(param_cols))
+    
+    if len(records) > 0:
+        all_bboxes = np.concatenate([np.reshape(
+            x["objects"]["bbox"], (-1, 4)) for x in records], axis=0)
+        all_labels = np.concatenate([np.reshape(
+            x["objects"]["label"], (-1,)) for x in records], axis=0)
+    else:
+        all_bboxes = np.zeros([0, 4], dtype=np.float64)
+        all_labels = np.zeros([0], dtype=np.int64)
+    
+    np.save(os.path.join(store_dir, "image_files.npy"), image_files)
+    np.save(os.path.join(store_dir, "image_params.npy"), image_params)
+    np.save(os.path.join(store_dir, "offsets.npy"), img_offsets)
+    np.save(os.path.join(store_dir, "bboxes.npy"), all_bboxes)
+    np.save(os.path.join(store_dir, "labels.npy"), all_labels)
+    with open(os.path.join(store_dir, "label_map.pkl"), "wb") as tmp_save:
+        pkl.dump(id_2_label, tmp_save)
+    return None
+
+def compare_record(tmp_store, img_idx, tmp_record):
+    """
+    Returns whether the record has the same number of objects as
+    the image in the store, and whether it is exactly the same.
+    """
+    tmp_bbox, tmp_label = tmp_store.get_objects(img_idx)
+    new_bbox  = np.reshape(tmp_record["objects"]["bbox"], (-1, 4))
+    new_label = np.reshape(tmp_record["objects"]["label"], (-1,))
+    new_params = [tmp_record.get(y, 0) for y in param_cols]
+    
+    same_size = len(new_label) == len(tmp_label)
+    same_record = same_size \
+        and np.array_equal(new_bbox, tmp_bbox) \
+        and np.array_equal(new_label, tmp_label) \
+        and np.array_equal(new_params, tmp_store.image_params[img_idx])
+    return same_size, same_record
+
+def update_store(store_dir, id_2_label, records, prune=False):
+    """
+    Patches the store with the given records and returns the number
+    of images which were changed.
+    Arguments:
+      store_dir: The directory of the store to patch. The store is
+        written from the records if it does not exist yet.
+      id_2_label: The dictionary mapping the class id to its label.
+      records: A list of records in the same format as `write_store`.
+        Records of new images are appended and records which are the
+        same as those in the store are skipped.
+      prune: If True, images which are not in records are removed.
+    Records with the same number of objects as before are written in
+    place into the memory-mapped arrays. Only when images are added, 
+    removed or change their number of objects are the arrays spliced
+    and written again.
+    """
+    if not os.path.isfile(os.path.join(store_dir, "offsets.npy")):
+        write_store(store_dir, id_2_label, records)
+        return len(records)
+    
+    tmp_store = AnnotationStore(store_dir)
+    img_index = dict([(
+        tmp_store.get_image(x), x) for x in range(len(tmp_store))])
+    
+    new_images = set([x["image"] for x in records])
+    if prune:
+        rm_images = set(img_index.keys()) - new_images
+    else:
+        rm_images = set()
+    
+    # Stores written before a column was added are rewritten. #
+    in_place = []
+    splice_flag = len(rm_images) > 0 or \
+        tmp_store.image_params.shape[1] != len(param_cols)
+    for tmp_record in records:
+        img_idx = img_index.get(tmp_record["image"])
+        if img_idx is None:
+            splice_flag = True
+            in_place.append((img_idx, tmp_record))
+            continue
+        
+        same_size, same_record = compare_record(
+            tmp_store, img_idx, tmp_record)
+        if same_record:
+            continue
+        elif not same_size:
+            splice_flag = True
+        in_place.append((img_idx, tmp_record))
+    
+    if splice_flag:
+        # Copy the records out of the memory-mapped arrays #
+        # before the files are written again.              #
+        changed = dict([(x["image"], x) for idx, x in in_place])
+        tmp_records = []
+        for n_img in range(len(tmp_store)):
+            tmp_image = tmp_store.get_image(n_img)
+            if tmp_image in rm_images:
+                continue
+            if tmp_image in changed:
+                tmp_records.append(changed.pop(tmp_image))
+            else:
+                tmp_record = tmp_store[n_img]
+                tmp_record["objects"] = dict([(
+                    x, np.array(y)) for x, y in tmp_record["objects"].items()])
+                tmp_records.append(tmp_record)
+        tmp_records.extend([x for x in records if x["image"] in changed])
+        del tmp_store
+        
+        write_store(store_dir, id_2_label, tmp_records)
+        return len(in_place) + len(rm_images)
+    del tmp_store
+    
+    # Same number of objects, so overwrite the arrays in place. #
+    if len(in_place) > 0:
+        all_bboxes = np.load(os.path.join(
+            store_dir, "bboxes.npy"), mmap_mode="r+")
+        all_labels = np.load(os.path.join(
+            store_dir, "labels.npy"), mmap_mode="r+")
+        img_params = np.load(os.path.join(
+            store_dir, "image_params.npy"), mmap_mode="r+")
+        img_offsets = np.load(os.path.join(store_dir, "offsets.npy"))
+        
+        for img_idx, tmp_record in in_place:
+            id_st = img_offsets[img_idx]
+            id_en = img_offsets[img_idx+1]
+            all_bboxes[id_st:id_en] = np.reshape(
+                tmp_record["objects"]["bbox"], (-1, 4))
+            all_labels[id_st:id_en] = np.reshape(
+                tmp_record["objects"]["label"], (-1,))
+            img_params[img_idx] = [
+                tmp_record.get(y, 0) for y in param_cols]
+        
+        all_bboxes.flush()
+        all_labels.flush()
+        img_params.flush()
+        del all_bboxes, all_labels, img_params
+    
+    with open(os.path.join(store_dir, "label_map.pkl"), "wb") as tmp_save:
+        pkl.dump(id_2_label, tmp_save)
+    return len(in_place)
+
+def hash_file(file_path, block_size=1048576):
+    tmp_hash = hashlib.sha1()
+    with open(file_path, "rb") as tmp_file:
+        tmp_block = tmp_file.read(block_size)
+        while len(tmp_block) > 0:
+            tmp_hash.update(tmp_block)
+            tmp_block = tmp_file.read(block_size)
+    return tmp_hash.hexdigest()
+
+def check_source(manifest, file_path):
+    """
+    Checks a source file against the conversion manifest.
+    Returns whether its content changed and its new manifest entry.
+    The file is only hashed when its mtime or size differ from the
+    manifest, and the other fields of the entry (e.g. the cached
+    parsed objects) are kept when the content is the same.
+    """
+    tmp_stat  = os.stat(file_path)
+    tmp_entry = manifest.get(file_path)
+    if tmp_entry is not None \
+        and tmp_entry["mtime"] == tmp_stat.st_mtime \
+        and tmp_entry["size"] == tmp_stat.st_size:
+        return False, tmp_entry
+    
+    tmp_sha1 = hash_file(file_path)
+    if tmp_entry is not None and tmp_entry["sha1"] == tmp_sha1:
+        new_entry = dict(tmp_entry)
+        changed = False
+    else:
+        new_entry = dict()
+        changed = True
+    
+    new_entry["mtime"] = tmp_stat.st_mtime
+    new_entry["size"] = tmp_stat.st_size
+    new_entry["sha1"] = tmp_sha1
+    return changed, new_entry
+
+def load_manifest(manifest_file):
+    if not os.path.isfile(manifest_file):
+        return dict()
+    with open(manifest_file, "rb") as tmp_load:
+        manifest = pkl.load(tmp_load)
+    return manifest
+
+def save_manifest(manifest_file, manifest):
+    with open(manifest_file + ".tmp", "wb") as tmp_save:
+        pkl.dump(manifest, tmp_save)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    return None
+
+def load_label_map(store_dir):
+    with open(os.path.join(store_dir, "label_map.pkl"), "rb") as tmp_load:
+        id_2_label = pkl.load(tmp_load)
+    return id_2_label
+
+def load_annotations(store_dir):
+    """
+    Returns the label map and an AnnotationStore of the images.
+    """
+    return load_label_map(store_dir), AnnotationStore(store_dir)
+
+class AnnotationStore(object):
+    """
+    Read-only view of a columnar annotation store. The arrays are
+    memory-mapped, so opening the store is near-instant and worker
+    processes share the same pages. Indexing with an integer returns
+    the same dict as a record of the pickled list, with the `bbox`
+    and `label` arrays being zero-copy slices of the store. Indexing
+    with a slice or an index array returns a view of those images.
+    """
+    def __init__(self, store_dir, index=None):
+        self.store_dir = store_dir
+        self.image_files = np.load(os.path.join(
+            store_dir, "image_files.npy"), mmap_mode="r")
+        self.image_params = np.load(os.path.join(
+            store_dir, "image_params.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(
+            store_dir, "offsets.npy"), mmap_mode="r")
+        self.bboxes = np.load(os.path.join(
+            store_dir, "bboxes.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(
+            store_dir, "labels.npy"), mmap_mode="r")
+        
+        if index is None:
+            self.index = np.arange(len(self.image_files))
+        else:
+            self.index = np.asarray(index, dtype=np.int64)
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def __iter__(self):
+        for n_img in range(len(self.index)):
+            yield self[n_img]
+    
+    def __getitem__(self, idx):
+        if isinstance(idx, (slice, list, np.ndarray)):
+            return AnnotationStore(
+                self.store_dir, index=self.index[idx])
+        
+        img_idx = self.index[idx]
+        tmp_bbox, tmp_label = self.get_objects(idx)
+        tmp_params = self.image_params[img_idx]
+        
+        tmp_record = {"image": self.get_image(idx)}
+        for n_col in range(len(tmp_params)):
+            tmp_record[param_cols[n_col]] = int(tmp_params[n_col])
+        tmp_record["objects"] = {"bbox": tmp_bbox, "label": tmp_label}
+        return tmp_record
+    
+    def get_image(self, idx):
+        return self.image_files[self.index[idx]].decode("utf-8")
+    
+    def image_sizes(self):
+        """
+        Returns the (height, width) of every image of the view, 
+        which are 0 if they were not stored at conversion.
+        """
+        n_cols = self.image_params.shape[1]
+        if n_cols < len(param_cols):
+            return np.zeros([len(self.index), 2], dtype=np.int64)
+        
+        tmp_cols = [param_cols.index(x) for x in ["height", "width"]]
+        tmp_params = self.image_params[self.index]
+        return tmp_params[:, tmp_cols].astype(np.int64)
+    
+    def get_objects(self, idx):
+        """
+        Returns the zero-copy (bbox, label) arrays of an image.
+        """
+        img_idx = self.index[idx]
+        id_st = self.offsets[img_idx]
+        id_en = self.offsets[img_idx+1]
+        return self.bboxes[id_st:id_en], self.labels[id_st:id_en]
+
+if __name__ == "__main__":
+    # Convert a pickled dataset into an annotation store. #
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pkl_file", type=str)
+    parser.add_argument("store_dir", type=str)
+    args = parser.parse_args()
+    
+    with open(args.pkl_file, "rb") as tmp_load:
+        id_2_label = pkl.load(tmp_load)
+        tmp_records = pkl.load(tmp_load)
+    
+    write_store(args.store_dir, id_2_label, tmp_records)
+    print("Total of", str(len(tmp_records)), "images written", 
+          "to", args.store_dir + ".")
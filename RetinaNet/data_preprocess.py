@@ -1,15 +1,21 @@
-import numpy as np
 import tensorflow as tf
-from utils import swap_xy, convert_to_xywh
+from utils import swap_xy, convert_to_xywh, decode_jpeg_scaled
+from utils import quantize_image
 
-def _parse_image(filename):
-    image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    return tf.cast(image_decoded, tf.float32)
+def _parse_image(
+    filename, img_cache=None, image_string=None, min_side=None):
+    # Read the pre-decoded image if it is in the cache. #
+    if img_cache is not None and filename in img_cache:
+        return tf.convert_to_tensor(img_cache.get_image(filename))
+    
+    # Use the encoded bytes if they were read from a TFRecord. #
+    if image_string is None:
+        image_string = tf.io.read_file(filename)
+    return decode_jpeg_scaled(image_string, min_side=min_side)
 
 def resize_image(sample):
-    image = _parse_image(sample["image"])
+    image = _parse_image(
+        sample["image"], min_side=sample["min_side"])
     image = tf.image.resize(
         image, [sample["min_side"], sample["min_side"]])
     image = image / 127.5 - 1.0
@@ -21,7 +27,7 @@ def resize_image(sample):
         sample["objects"]["label"], dtype=tf.int32)
     return image, bbox, class_id
 
-def random_flip_horizontal(image, boxes, p_flip=0.5):
+def random_flip_horizontal(image, boxes, p_flip=0.5, flip_flag=None):
     """
     Flips image and boxes horizontally with 50% chance
     Arguments:
@@ -29,20 +35,87 @@ def random_flip_horizontal(image, boxes, p_flip=0.5):
         image.
       boxes: A tensor with shape `(num_boxes, 4)` representing bounding boxes,
         having normalized coordinates.
+      flip_flag: If not None, whether to flip instead of a random draw.
     Returns:
       Randomly flipped image and boxes
     """
-    if tf.random.uniform(()) <= p_flip:
-        tmp_box = boxes
-        image = tf.image.flip_left_right(image)
-        boxes = tf.stack(
-            [1.0-tmp_box[:, 2], tmp_box[:, 1], 
-             1.0-tmp_box[:, 0], tmp_box[:, 3]], axis=-1)
+    # Select with a tensor so that the op stays in the graph. #
+    if flip_flag is None:
+        flip_flag = tf.random.uniform(()) <= p_flip
+    tmp_box = boxes
+    image = tf.where(
+        flip_flag, tf.image.flip_left_right(image), image)
+    boxes = tf.where(flip_flag, tf.stack(
+        [1.0-tmp_box[:, 2], tmp_box[:, 1], 
+         1.0-tmp_box[:, 0], tmp_box[:, 3]], axis=-1), tmp_box)
     return image, boxes
 
+def random_flip_horizontal_batch(
+    images, boxes, p_flip=0.5, flip_flag=None):
+    """
+    Flips each image of a batch and its boxes horizontally with
+    probability `p_flip`, using tensor selects instead of branches.
+    Arguments:
+      images: A 4-D tensor of shape `(batch, height, width, channels)`.
+      boxes: A ragged tensor of shape `(batch, None, 4)` holding the
+        normalized bounding boxes of each image.
+      flip_flag: If not None, a boolean tensor of shape `(batch,)`
+        of whether to flip each image instead of a random draw.
+    Returns:
+      Randomly flipped images and boxes
+    """
+    if flip_flag is None:
+        flip_flag = tf.random.uniform([tf.shape(images)[0]]) <= p_flip
+    images = tf.where(
+        flip_flag[:, None, None, None], 
+        tf.image.flip_left_right(images), images)
+    
+    box_flag = tf.repeat(flip_flag, boxes.row_lengths())
+    tmp_box  = boxes.flat_values
+    flat_box = tf.where(box_flag[:, None], tf.stack(
+        [1.0-tmp_box[:, 2], tmp_box[:, 1], 
+         1.0-tmp_box[:, 0], tmp_box[:, 3]], axis=-1), tmp_box)
+    return images, boxes.with_flat_values(flat_box)
+
+def random_jitter_image(
+    image, max_delta=0.1, contrast=[0.9, 1.1], value_range=[-1.0, 1.0]):
+    """
+    Randomly jitters the brightness and contrast of a normalized image, 
+    or of each image of a batch, e.g. to augment an echoed sample
+    whose targets are already encoded.
+    Arguments:
+      image: A tensor of shape `(height, width, channels)` or of shape
+        `(batch, height, width, channels)`.
+      max_delta: The maximum brightness shift.
+      contrast: The range of the contrast factor about the mean.
+      value_range: The range that the image is clipped to. A uint8
+        image is jittered on its [0, 255] pixel values instead.
+    Returns:
+      Randomly jittered image
+    """
+    if image.dtype == tf.uint8:
+        # Jitter the pixel values and quantize them again. #
+        pixel_scale = 255.0 / (value_range[1] - value_range[0])
+        image = random_jitter_image(
+            tf.cast(image, tf.float32), 
+            max_delta=pixel_scale*max_delta, 
+            contrast=contrast, value_range=[0.0, 255.0])
+        return quantize_image(image)
+    
+    rand_shape = tf.concat([
+        tf.shape(image)[:-3], [1, 1, 1]], axis=0)
+    tmp_delta  = tf.random.uniform(
+        rand_shape, minval=-max_delta, maxval=max_delta)
+    tmp_factor = tf.random.uniform(
+        rand_shape, minval=contrast[0], maxval=contrast[1])
+    
+    img_mean = tf.reduce_mean(image, axis=[-3, -2, -1], keepdims=True)
+    image = (image - img_mean) * tmp_factor + img_mean + tmp_delta
+    return tf.clip_by_value(image, value_range[0], value_range[1])
+
 def resize_and_pad_image(
-    image, jitter=[640, 1024], min_side=800.0, 
-    max_side=1333.0, stride=128.0, equal_dims=True):
+    image, jitter=[640, 1024], min_side=800.0, max_side=1333.0, 
+    stride=128.0, equal_dims=True, normalize=True, pad_dims=None):
     """
     Resizes and pads image while preserving aspect ratio.
     1. Resizes images so that the shorter side is equal to `min_side`
@@ -63,6 +136,11 @@ def resize_and_pad_image(
         resized to a random value in this range.
       stride: The stride of the smallest feature map in the feature pyramid.
         Can be calculated using `image_size / feature_map_size`.
+      normalize: If False, the image is returned as uint8 for a model
+        built with `uint8_input`, and padded with the mid grey instead.
+      pad_dims: If not None, the (height, width) that the image is
+        padded to instead, e.g. the shape of its aspect ratio bucket.
+        The image is scaled down further if it does not fit.
     Returns:
       image: Resized and padded image.
       image_shape: Shape of the image before padding.
@@ -74,30 +152,86 @@ def resize_and_pad_image(
         min_side = tf.random.uniform(
             (), jitter[0], jitter[1], dtype=tf.float32)
     
-    ratio = min_side / tf.reduce_min(image_shape)
-    if ratio * tf.reduce_max(image_shape) > max_side:
-        ratio = max_side / tf.reduce_max(image_shape)
+    ratio = tf.minimum(
+        min_side / tf.reduce_min(image_shape), 
+        max_side / tf.reduce_max(image_shape))
+    if pad_dims is not None:
+        ratio = tf.minimum(ratio, tf.reduce_min(
+            tf.cast(pad_dims, tf.float32) / image_shape))
     
     new_shape = ratio * image_shape
     img_resized = tf.image.resize(
         image, tf.cast(new_shape, tf.int32))
-    img_resized = img_resized / 127.5 - 1.0
+    if normalize:
+        img_resized = img_resized / 127.5 - 1.0
+    else:
+        # Pad with the grey that normalizes to about zero. #
+        img_resized = img_resized - 128.0
     
     padded_dims = tf.cast(tf.math.ceil(
         new_shape/stride) * stride, dtype=tf.int32)
-    if equal_dims:
-        max_dims = np.max(padded_dims.numpy())
-        padded_dims = [max_dims, max_dims]
+    if pad_dims is not None:
+        padded_dims = tf.cast(pad_dims, tf.int32)
+    elif equal_dims:
+        max_dims = tf.reduce_max(padded_dims)
+        padded_dims = tf.stack([max_dims, max_dims])
     
     image_padded = tf.image.pad_to_bounding_box(
         img_resized, 0, 0, padded_dims[0], padded_dims[1])
+    if not normalize:
+        image_padded = quantize_image(image_padded + 128.0)
     return image_padded, new_shape, ratio
 
-def preprocess_data(sample, img_dims=384, pad_flag=True):
+def resize_and_pad_batch(
+    images, jitter=[640, 1024], min_side=800.0, 
+    max_side=1333.0, stride=128.0, equal_dims=True):
+    """
+    Resizes and pads a batch of images of the same size in a single
+    op, drawing one jitter scale for the whole batch. The arguments
+    and outputs are the same as `resize_and_pad_image`, except that
+    `images` is a 4-D tensor of shape `(batch, height, width, channels)`.
+    """
+    image_shape = tf.cast(
+        tf.shape(images)[1:3], dtype=tf.float32)
+    if jitter is not None:
+        min_side = tf.random.uniform(
+            (), jitter[0], jitter[1], dtype=tf.float32)
+    
+    ratio = tf.minimum(
+        min_side / tf.reduce_min(image_shape), 
+        max_side / tf.reduce_max(image_shape))
+    
+    new_shape = ratio * image_shape
+    img_resized = tf.image.resize(
+        images, tf.cast(new_shape, tf.int32))
+    img_resized = img_resized / 127.5 - 1.0
+    
+    padded_dims = tf.cast(tf.math.ceil(
+        new_shape/stride) * stride, dtype=tf.int32)
+    if equal_dims:
+        max_dims = tf.reduce_max(padded_dims)
+        padded_dims = tf.stack([max_dims, max_dims])
+    
+    images_padded = tf.image.pad_to_bounding_box(
+        img_resized, 0, 0, padded_dims[0], padded_dims[1])
+    return images_padded, new_shape, ratio
+
+def preprocess_data(
+    sample, img_dims=384, pad_flag=True, 
+    img_cache=None, flip_flag=None, normalize=True):
     """
     Applies preprocessing step to a single sample.
     Arguments:
       sample: A dict representing a single training sample.
+      img_cache: An optional ImageCache of the pre-decoded images.
+      flip_flag: If not None, whether to flip the sample instead of
+        a random draw, e.g. to key its cached targets.
+      normalize: If False, the image is returned as uint8 for a model
+        built with `uint8_input`.
+    If the sample has the `encoded` JPEG bytes from a TFRecord shard, 
+    the image is decoded from them instead of being read from disk.
+    If it has the `pad_dims` of its bucket from a BucketSampler, the
+    image is padded to them instead of a square.
     Returns:
       image: Resized and padded image with random horizontal flipping applied.
       bbox: Bounding boxes with the shape `(num_objects, 4)` where each box is
@@ -107,28 +241,66 @@ def preprocess_data(sample, img_dims=384, pad_flag=True):
     """
     jitter = [sample["l_jitter"], sample["u_jitter"]]
     
-    image = _parse_image(sample["image"])
+    # The shorter side is resized to at most the upper jitter. #
+    if pad_flag:
+        dec_side = jitter[1]
+    else:
+        dec_side = img_dims
+    
+    image = _parse_image(
+        sample["image"], img_cache=img_cache, 
+        image_string=sample.get("encoded"), min_side=dec_side)
     if not pad_flag:
         image = tf.image.resize(
             image, [img_dims, img_dims])
     
-    bbox = tf.cast(
-        sample["objects"]["bbox"], tf.float32)
+    # Keep the boxes as a tensor so that this stays in the graph #
+    # of a tf.function or a parallel tf.data map.                #
+    bbox = tf.reshape(tf.cast(
+        sample["objects"]["bbox"], tf.float32), [-1, 4])
     class_id = tf.cast(
         sample["objects"]["label"], dtype=tf.int32)
     
-    image, bbox = random_flip_horizontal(image, bbox)
+    image, bbox = random_flip_horizontal(
+        image, bbox, flip_flag=flip_flag)
     if pad_flag:
         image, img_shp, ratio = \
             resize_and_pad_image(
                 image, min_side=sample["min_side"], 
-                max_side=sample["max_side"], jitter=jitter)
+                max_side=sample["max_side"], 
+                jitter=jitter, normalize=normalize, 
+                pad_dims=sample.get("pad_dims"))
     else:
-        image = image / 127.5 - 1.0
+        if normalize:
+            image = image / 127.5 - 1.0
+        else:
+            image = quantize_image(image)
         img_shp = tf.cast([img_dims, img_dims], tf.float32)
     
     bbox = swap_xy(bbox)
     bbox = convert_to_xywh(bbox)
-    bbox = bbox.numpy()
-    return image, tf.constant(bbox), class_id, img_shp
+    return image, bbox, class_id, img_shp
 
+def load_sample(sample, img_dims=384, img_cache=None, normalize=True):
+    """
+    Decodes and resizes the image of a sample to `img_dims` without
+    any augmentation, so that it can be augmented in a batch with
+    `random_flip_horizontal_batch`.
+    Returns the normalized image, or the uint8 image if normalize is
+    False, the normalized boxes in the same format as the sample and
+    the class ids of the objects.
+    """
+    image = _parse_image(
+        sample["image"], img_cache=img_cache, 
+        image_string=sample.get("encoded"), min_side=img_dims)
+    image = tf.image.resize(image, [img_dims, img_dims])
+    if normalize:
+        image = image / 127.5 - 1.0
+    else:
+        image = quantize_image(image)
+    
+    bbox = tf.cast(
+        sample["objects"]["bbox"], tf.float32)
+    class_id = tf.cast(
+        sample["objects"]["label"], dtype=tf.int32)
+    return image, bbox, class_id
@@ -0,0 +1,78 @@
+import os
+import sys
+import multiprocessing as mp
+import tensorflow as tf
+
+def _run_worker(dispatcher_address):
+    tmp_config = tf.data.experimental.service.WorkerConfig(
+        dispatcher_address=dispatcher_address)
+    tmp_worker = tf.data.experimental.service.WorkerServer(tmp_config)
+    tmp_worker.join()
+    return None
+
+class LocalDataService(object):
+    """
+    A tf.data service on this machine, with the dispatcher in the
+    training process and its workers in separate processes, so that
+    the preprocessing of the samples is not limited by the thread
+    pool and the GIL of the trainer, which only reads the finished
+    elements. Only pipelines of graph ops can be distributed, since
+    the workers cannot call the Python functions of `py_function`.
+    Arguments:
+      n_workers: The number of worker processes. Defaults to one
+        less than the number of cores.
+      port: The port of the dispatcher, or 0 to pick a free one.
+      cpu_only: If True, the workers do not see the GPUs, so that
+        they do not take GPU memory from the trainer.
+    """
+    def __init__(self, n_workers=None, port=0, cpu_only=True):
+        if n_workers is None:
+            n_workers = max(1, (os.cpu_count() or 2) - 1)
+        
+        self.dispatcher = tf.data.experimental.service.DispatchServer(
+            tf.data.experimental.service.DispatcherConfig(port=port))
+        self.target = self.dispatcher.target
+        dispatcher_address = self.target.split("://")[1]
+        
+        tmp_context = mp.get_context("spawn")
+        self.workers = [tmp_context.Process(
+            target=_run_worker, args=(dispatcher_address,), 
+            daemon=True) for _ in range(n_workers)]
+        
+        # The training scripts run at the top level, so the spawned #
+        # workers must not re-run the main script when they start.  #
+        main_module = sys.modules["__main__"]
+        main_file = getattr(main_module, "__file__", None)
+        tmp_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+        try:
+            if main_file is not None:
+                del main_module.__file__
+            if cpu_only:
+                os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+            for tmp_worker in self.workers:
+                tmp_worker.start()
+        finally:
+            if main_file is not None:
+                main_module.__file__ = main_file
+            if cpu_only and tmp_devices is None:
+                del os.environ["CUDA_VISIBLE_DEVICES"]
+            elif cpu_only:
+                os.environ["CUDA_VISIBLE_DEVICES"] = tmp_devices
+    
+    def distribute(self, dataset, job_name=None):
+        """
+        Returns the dataset read from the service, whose workers
+        split the samples of each epoch between them.
+        """
+        return dataset.apply(tf.data.experimental.service.distribute(
+            processing_mode="distributed_epoch", 
+            service=self.target, job_name=job_name))
+    
+    def close(self):
+        """
+        Stops the worker processes.
+        """
+        for tmp_worker in self.workers:
+            tmp_worker.terminate()
+            tmp_worker.join(timeout=5.0)
+        return None
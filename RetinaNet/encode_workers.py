@@ -0,0 +1,38 @@
+import numpy as np
+import tensorflow as tf
+import retinanet_module
+from data_preprocess import preprocess_data
+
+# Sample encoders for the workers of SharedEncodePool. They are #
+# kept out of the training scripts so that the spawned workers  #
+# can import them.                                              #
+def build_encoder(n_classes, id_2_label, anchor_sizes=None):
+    """
+    Builds the RetinaNet of a worker, whose anchors encode the
+    targets. The anchor sizes have to match those of the trained
+    model, while its backbone does not change the anchors.
+    """
+    return retinanet_module.RetinaNet(
+        n_classes, id_2_label, anchor_sizes=anchor_sizes)
+
+def prepare_sparse_sample(model, sample, img_dims=512, normalize=True):
+    """
+    Returns the resized and flipped image of the sample with its
+    sparse anchor targets and the number of assigned targets, as
+    in the `prepare_sample` of the training script.
+    """
+    image, bbox, class_id, _ = preprocess_data(
+        sample, img_dims=img_dims, 
+        pad_flag=False, normalize=normalize)
+    img_dim = tf.cast([
+        image.shape[0], image.shape[1]], tf.float32)
+    
+    label = tf.concat([bbox, tf.expand_dims(
+        tf.cast(class_id, tf.float32), axis=1)], axis=1)
+    img_pad = [int(image.shape[0]), 
+               int(image.shape[1])]
+    
+    tmp_labels, n_labels = model.format_data(
+        label, img_dim, img_pad=img_pad, 
+        iou_thresh=0.50, sparse=True)
+    return image.numpy(), tmp_labels, np.array(n_labels)
@@ -0,0 +1,137 @@
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+
+# Columns of the image index. #
+index_cols = ["shard", "offset", "height", "width"]
+
+def decode_and_resize(filename, max_side):
+    """
+    Decodes a JPEG and downsizes it, preserving its aspect ratio, 
+    so that its longer side is at most `max_side`.
+    Returns the uint8 image as a numpy array.
+    """
+    image_string  = tf.io.read_file(filename)
+    image_decoded = \
+        tf.image.decode_jpeg(image_string, channels=3)
+    
+    img_height = int(image_decoded.shape[0])
+    img_width  = int(image_decoded.shape[1])
+    if max(img_height, img_width) > max_side:
+        ratio = max_side / max(img_height, img_width)
+        new_shape = [
+            max(1, int(round(ratio * img_height))), 
+            max(1, int(round(ratio * img_width)))]
+        image_decoded = tf.image.resize(image_decoded, new_shape)
+        image_decoded = tf.cast(tf.clip_by_value(
+            tf.round(image_decoded), 0.0, 255.0), tf.uint8)
+    return image_decoded.numpy()
+
+def write_image_cache(
+    cache_dir, image_files, max_side=640, shard_mb=1024):
+    """
+    Decodes every image once and writes it as raw uint8 pixels
+    into shard files.
+    Arguments:
+      cache_dir: The directory to write the cache into.
+      image_files: The list of image paths to cache.
+      max_side: The longer side of the cached images.
+      shard_mb: The approximate size of each shard in MB.
+    The cache consists of the shards `shard_xxxxx.bin`, the image
+    table `image_files.npy` and the index `image_index.npy` of the
+    (shard, offset, height, width) of every image.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    
+    shard_bytes = shard_mb * 1048576
+    image_files = sorted(set(image_files))
+    image_index = np.zeros(
+        [len(image_files), len(index_cols)], dtype=np.int64)
+    
+    n_shard = 0
+    n_bytes = 0
+    tmp_shard = open(os.path.join(
+        cache_dir, "shard_%05d.bin" % n_shard), "wb")
+    for n_img in range(len(image_files)):
+        tmp_image = decode_and_resize(image_files[n_img], max_side)
+        if n_bytes > 0 and n_bytes + tmp_image.nbytes > shard_bytes:
+            tmp_shard.close()
+            n_shard += 1
+            n_bytes  = 0
+            tmp_shard = open(os.path.join(
+                cache_dir, "shard_%05d.bin" % n_shard), "wb")
+        
+        tmp_shard.write(tmp_image.tobytes())
+        image_index[n_img] = [
+            n_shard, n_bytes, tmp_image.shape[0], tmp_image.shape[1]]
+        n_bytes += tmp_image.nbytes
+        
+        if (n_img+1) % 1000 == 0:
+            print(str(n_img+1), "images cached.")
+    tmp_shard.close()
+    
+    np.save(os.path.join(cache_dir, "image_files.npy"), np.array([
+        x.encode("utf-8") for x in image_files]))
+    np.save(os.path.join(cache_dir, "image_index.npy"), image_index)
+    return None
+
+class ImageCache(object):
+    """
+    Read-only view of the decoded image shards. The shards are
+    memory-mapped, so `get_image` returns a zero-copy uint8 array
+    of shape (height, width, 3) without any JPEG decode.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.image_index = np.load(os.path.join(
+            cache_dir, "image_index.npy"))
+        
+        image_files = np.load(os.path.join(
+            cache_dir, "image_files.npy"))
+        self.file_index = dict([(
+            image_files[x].decode("utf-8"), x) \
+            for x in range(len(image_files))])
+        self.shards = dict()
+    
+    def __len__(self):
+        return len(self.file_index)
+    
+    def __contains__(self, filename):
+        return filename in self.file_index
+    
+    def get_shard(self, n_shard):
+        if n_shard not in self.shards:
+            self.shards[n_shard] = np.memmap(os.path.join(
+                self.cache_dir, "shard_%05d.bin" % n_shard), 
+                dtype=np.uint8, mode="r")
+        return self.shards[n_shard]
+    
+    def get_image(self, filename):
+        n_shard, offset, height, width = \
+            self.image_index[self.file_index[filename]]
+        tmp_shard = self.get_shard(n_shard)
+        return tmp_shard[offset:(offset + height*width*3)].reshape(
+            height, width, 3)
+
+if __name__ == "__main__":
+    # Build the image cache of an annotation store. #
+    from annotation_store import AnnotationStore
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_dir", type=str)
+    parser.add_argument("cache_dir", type=str)
+    parser.add_argument("--max_side", type=int, default=640)
+    parser.add_argument("--shard_mb", type=int, default=1024)
+    args = parser.parse_args()
+    
+    tmp_store = AnnotationStore(args.store_dir)
+    image_files = [
+        tmp_store.get_image(x) for x in range(len(tmp_store))]
+    
+    write_image_cache(
+        args.cache_dir, image_files, 
+        max_side=args.max_side, shard_mb=args.shard_mb)
+    print("Total of", str(len(set(image_files))), "images cached", 
+          "to", args.cache_dir + ".")
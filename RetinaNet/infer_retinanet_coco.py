@@ -1,19 +1,17 @@
 import argparse
 import numpy as np
 import pandas as pd
-import pickle as pkl
 from matplotlib import pyplot as plt
 
 import retinanet_module
 import tensorflow as tf
-from utils import visualize_detections
+from utils import visualize_detections, decode_jpeg_scaled, model_input
+from annotation_store import load_label_map
 
 # Custom function to parse the data. #
-def _parse_image(filename):
-    image_string  = tf.io.read_file(filename)
-    image_decoded = \
-        tf.image.decode_jpeg(image_string, channels=3)
-    return tf.cast(image_decoded, tf.float32)
+def _parse_image(filename, min_side=None):
+    image_string = tf.io.read_file(filename)
+    return decode_jpeg_scaled(image_string, min_side=min_side)
 
 def detect_heatmap(
     image, model, img_rows=384, img_cols=384):
@@ -22,7 +20,7 @@ def detect_heatmap(
     img_display = tf.image.resize(
         image, [img_rows, img_cols])
     img_resized = tf.expand_dims(img_display, axis=0)
-    img_resized = img_resized / 127.5 - 1.0
+    img_resized = model_input(img_resized, model.model)
     tmp_predict = model(img_resized, training=False)
     
     tmp_heatmap = []
@@ -81,23 +79,22 @@ args = parser.parse_args()
 
 # Build model. #
 #tmp_path  = "C:/Users/admin/Desktop/Data/COCO/"
-data_file = "../../Data/COCO/coco_data_fcos.pkl"
-with open(data_file, "rb") as tmp_load:
-    id_2_label = pkl.load(tmp_load)
-    train_data = pkl.load(tmp_load)
+store_dir  = "../../Data/COCO/coco_data_fcos_store/"
+id_2_label = load_label_map(store_dir)
 
 label_2_id = dict(
     [(y, x) for x, y in id_2_label.items()])
-del train_data
 
 img_dims = 512
 anchor_sizes = [20.0, 40.0, 80.0, 160.0, 320.0]
 
 model_path  = "../../TF_Models/coco_model/"
 num_classes = len(id_2_label)
+# Match the input type of the trained model. #
+uint8_input = False
 retinanet_model = retinanet_module.RetinaNet(
-    num_classes, label_2_id, 
-    anchor_sizes=anchor_sizes, backbone_model="resnet101")
+    num_classes, label_2_id, anchor_sizes=anchor_sizes, 
+    backbone_model="resnet101", uint8_input=uint8_input)
 model_optimizer = tf.optimizers.SGD(momentum=0.9)
 
 # Loading weights. #
@@ -124,6 +121,7 @@ print("Total of", str(len(label_2_id)), "classes.")
 cls_thresh = args.cls_thresh
 iou_thresh = args.iou_thresh
 image_file = args.img_file
+# The detections are shown on the full resolution image. #
 raw_image  = _parse_image(image_file)
 
 if args.show_text.lower().strip() == "true":
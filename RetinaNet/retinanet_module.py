@@ -1,14 +1,19 @@
 import numpy as np
-from utils import swap_xy, compute_iou
+from utils import swap_xy, compute_pair_iou, decode_jpeg_scaled
+from utils import uint8_image_input, model_input
+from anchor_bank import AnchorBank
 
 import tensorflow as tf
 from tensorflow.keras import layers
 from classification_models.tfkeras import Classifiers
 
 def build_model(
-    num_classes, n_anchors=9, backbone_model="resnet50"):
+    num_classes, n_anchors=9, 
+    backbone_model="resnet50", uint8_input=False):
     """
     Builds Backbone Model with pre-trained imagenet weights.
+    If uint8_input is True, the model takes uint8 images and
+    normalizes them in its graph, the same as the loaders.
     """
     # Define the focal loss bias. #
     b_focal = tf.constant_initializer(
@@ -28,24 +33,33 @@ def build_model(
             activation=None, use_bias=False, 
             name="reg_layer_" + str(n_layer+1)))
     
+    # Normalize the uint8 images in the graph. #
+    if uint8_input:
+        _, x_image = uint8_image_input()
+    else:
+        x_image = None
+    
     # Backbone Network. #
     if backbone_model.lower() == "resnet50":
         backbone = tf.keras.applications.ResNet50(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", 
             "conv4_block6_out", "conv5_block3_out"]
     elif backbone_model.lower() == "resnet101":
         backbone = tf.keras.applications.ResNet101(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block4_out", 
             "conv4_block23_out", "conv5_block3_out"]
     elif backbone_model.lower() == "resnet152":
         backbone = tf.keras.applications.ResNet152(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "conv3_block8_out", 
@@ -54,19 +68,22 @@ def build_model(
         tmp_model, preprocess_input = Classifiers.get("resnext50")
         
         backbone = tmp_model(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         c3_c5_layer_names = [
             "add_88", "add_94", "add_97"]
     elif backbone_model.lower() == "resnext101":
         tmp_model, preprocess_input = Classifiers.get("resnext101")
         
         backbone = tmp_model(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         c3_c5_layer_names = [
             "add_39", "add_62", "add_65"]
     else:
         backbone = tf.keras.applications.MobileNetV2(
-            include_top=False, input_shape=[None, None, 3])
+            include_top=False, input_shape=[None, None, 3], 
+            input_tensor=x_image)
         
         c3_c5_layer_names = [
             "block_6_expand", "block_13_expand", "Conv_1"]
@@ -163,7 +180,8 @@ class RetinaNet(tf.keras.Model):
     def __init__(
         self, n_classes, id_2_label, 
         aspect_ratios=None, anchor_scales=None, 
-        anchor_sizes=None, backbone_model="resnet50", **kwargs):
+        anchor_sizes=None, backbone_model="resnet50", 
+        uint8_input=False, **kwargs):
         super(RetinaNet, self).__init__(name="RetinaNet", **kwargs)
         if anchor_sizes is None:
             self.anchor_sizes = [32.0, 64.0, 128.0, 256.0, 512.0]
@@ -193,11 +211,12 @@ class RetinaNet(tf.keras.Model):
         n_anchors  = n_aspects * n_scales
         self.model = build_model(
             n_classes, n_anchors=n_anchors, 
-            backbone_model=backbone_model)
+            backbone_model=backbone_model, uint8_input=uint8_input)
         
         self.n_class = n_classes
         self.strides = [8, 16, 32, 64, 128]
         self.n_anchors = n_anchors
+        self.uint8_input = uint8_input
         self.box_areas = list(
             sorted([x**2 for x in self.anchor_sizes]))
         self.id_2_label = id_2_label
@@ -217,32 +236,26 @@ class RetinaNet(tf.keras.Model):
         
         # Assign the anchor boxes to model class. #
         self.anchor_boxes = anchor_boxes
+        
+        # The anchor grids are shared by the encoding and decoding. #
+        self.anchor_bank = AnchorBank(anchor_boxes, self.strides)
     
     def get_anchors(self, cnn_shape, level):
         if level >= 5 or level < 0:
             raise ValueError("level has to be between 0 and 4.")
         
-        ry = np.arange(
-            0, cnn_shape[0], dtype=np.float32)
-        rx = np.arange(
-            0, cnn_shape[1], dtype=np.float32)
-        [grid_x, grid_y] = np.meshgrid(rx, ry)
-        
-        grid_shape  = grid_x.shape
-        tmp_anchors = [(
-            grid_x[nx, ny], 
-            grid_y[nx, ny], 1, 1) for nx in range(
-                grid_shape[0]) for ny in range(grid_shape[1])]
-        tmp_anchors = np.reshape(
-            tmp_anchors, (grid_shape[0], grid_shape[1], 4))
+        # The grid is in units of cells with (x, y) ordering. #
+        level_anchors = self.anchor_bank.get(cnn_shape, level)
+        tmp_anchors = \
+            level_anchors["centers"][..., ::-1] / self.strides[level]
         
         # This should output n_anchors (=9 by default). #
         anchors_out = []
-        for anchor_dim in self.anchor_boxes[level]:
-            tmp_anchor_dim = np.array(
-                [1, 1, anchor_dim[0], anchor_dim[1]])
-            tmp_anchor_dim = np.reshape(tmp_anchor_dim, (1, 1, 4))
-            anchors_out.append(tmp_anchors * tmp_anchor_dim)
+        for anchor_dim in level_anchors["sizes"]:
+            tmp_anchor_dim = np.broadcast_to(
+                anchor_dim.astype(np.float64), tmp_anchors.shape)
+            anchors_out.append(np.concatenate(
+                [tmp_anchors, tmp_anchor_dim], axis=2))
         return anchors_out
     
     def call(self, x, training=None):
@@ -250,119 +263,292 @@ class RetinaNet(tf.keras.Model):
     
     def format_data(
         self, gt_labels, img_dim, 
-        iou_thresh=0.50, img_pad=None):
+        iou_thresh=0.50, img_pad=None, sparse=False):
         """
         gt_labels: Normalised Gound Truth Bounding Boxes (y, x, h, w).
         num_targets is for debugging purposes.
+        If sparse is True, the targets of each level are returned as
+        a tuple of (reg_idx, reg_val, cls_idx) instead of the dense
+        float64 array of every anchor. reg_idx holds the (y, x, anchor)
+        positions of the assigned anchors and reg_val their regression
+        values, while cls_idx holds the (y, x, anchor, class) indices
+        of the positive class labels.
+        The anchors of all levels are assigned at once. Each box is
+        only tested against the anchors whose centers lie close enough
+        to it to exceed iou_thresh. As before, the last box assigned to
+        an anchor keeps its regression values while the class labels
+        of all its boxes are kept.
         """
         if img_pad is None:
             img_pad = img_dim
         
-        gt_height = gt_labels[:, 2]*img_dim[0]
-        gt_width  = gt_labels[:, 3]*img_dim[1]
-        gt_height = gt_height.numpy()
-        gt_width  = gt_width.numpy()
+        n_levels = len(self.box_areas)
+        n_anchor = self.n_anchors
+        h_max = [int(img_pad[0] / x) for x in self.strides[:n_levels]]
+        w_max = [int(img_pad[1] / x) for x in self.strides[:n_levels]]
+        
+        # Scale the normalised bounding boxes accordingly. #
+        gt_boxes = np.array(gt_labels, dtype=np.float32).reshape(-1, 5)
+        gt_scale = np.array([
+            img_dim[0], img_dim[1], 
+            img_dim[0], img_dim[1]], dtype=np.float32)
+        gt_boxes[:, :4] = gt_boxes[:, :4] * gt_scale
+        
+        # Get the anchors of every level from the anchor bank. #
+        level_anchors = self.anchor_bank.get_levels(
+            [[h_max[x], w_max[x]] for x in range(n_levels)])
+        anchor_dims = np.stack([
+            x["sizes"] for x in level_anchors]).astype(np.float64)
+        anchor_ctrs = np.concatenate([
+            x["centers"].reshape(-1, 2) for x in level_anchors], axis=0)
+        ctr_offset = np.cumsum([0] + [
+            h_max[x]*w_max[x] for x in range(n_levels-1)])
+        
+        # Enumerate every (box, level, anchor) combination. #
+        box_idx, lvl_idx, anc_idx = [x.ravel() for x in np.meshgrid(
+            np.arange(len(gt_boxes)), np.arange(n_levels), 
+            np.arange(n_anchor), indexing="ij")]
+        
+        tmp_stride = np.array(
+            self.strides[:n_levels], dtype=np.float64)[lvl_idx]
+        anchor_h = anchor_dims[lvl_idx, anc_idx, 0]
+        anchor_w = anchor_dims[lvl_idx, anc_idx, 1]
+        
+        box_y = gt_boxes[box_idx, 0].astype(np.float64)
+        box_x = gt_boxes[box_idx, 1].astype(np.float64)
+        box_h = gt_boxes[box_idx, 2].astype(np.float64)
+        box_w = gt_boxes[box_idx, 3].astype(np.float64)
+        
+        # The IoU can only exceed the threshold if the overlap along  #
+        # each axis exceeds iou_thresh times the larger area divided  #
+        # by the smaller side of the other axis, which bounds the     #
+        # distance between the anchor and box centers. A margin of a  #
+        # pixel is kept so that the IoU test alone decides the edges. #
+        min_thresh = max(iou_thresh, 0.0)
+        max_area = np.maximum(box_h*box_w, anchor_h*anchor_w)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            reach_y = 0.5*(box_h + anchor_h) - \
+                min_thresh * max_area / np.minimum(box_w, anchor_w)
+            reach_x = 0.5*(box_w + anchor_w) - \
+                min_thresh * max_area / np.minimum(box_h, anchor_h)
+        reach_y = np.nan_to_num(reach_y, nan=-1.0, neginf=-1.0) + 1.0
+        reach_x = np.nan_to_num(reach_x, nan=-1.0, neginf=-1.0) + 1.0
+        if iou_thresh < 0.0:
+            reach_y[:] = np.inf
+            reach_x[:] = np.inf
+        
+        row_st = np.maximum(np.ceil((box_y - reach_y) / tmp_stride), 0)
+        col_st = np.maximum(np.ceil((box_x - reach_x) / tmp_stride), 0)
+        row_en = np.minimum(np.floor(
+            (box_y + reach_y) / tmp_stride) + 1, np.array(h_max)[lvl_idx])
+        col_en = np.minimum(np.floor(
+            (box_x + reach_x) / tmp_stride) + 1, np.array(w_max)[lvl_idx])
+        
+        row_st = row_st.astype(np.int64)
+        col_st = col_st.astype(np.int64)
+        n_rows = np.maximum(row_en.astype(np.int64) - row_st, 0)
+        n_cols = np.maximum(col_en.astype(np.int64) - col_st, 0)
+        
+        # Expand each combination into its candidate anchors. #
+        n_cells  = n_rows * n_cols
+        pair_idx = np.repeat(np.arange(len(n_cells)), n_cells)
+        cell_idx = np.arange(len(pair_idx)) - np.repeat(
+            np.cumsum(n_cells) - n_cells, n_cells)
+        pos_y = row_st[pair_idx] + cell_idx // n_cols[pair_idx]
+        pos_x = col_st[pair_idx] + cell_idx % n_cols[pair_idx]
+        
+        pair_ctr_idx = ctr_offset[lvl_idx[pair_idx]] + \
+            pos_y*np.array(w_max)[lvl_idx[pair_idx]] + pos_x
+        pair_anchors = np.concatenate([
+            anchor_ctrs[pair_ctr_idx], np.stack([
+                anchor_h[pair_idx], anchor_w[pair_idx]], axis=1)], axis=1)
+        pair_boxes = gt_boxes[box_idx[pair_idx], :]
+        pair_ious  = compute_pair_iou(pair_boxes[:, :4], pair_anchors)
+        
+        is_valid = pair_ious > iou_thresh
+        num_targets = int(np.sum(is_valid))
+        
+        pos_y = pos_y[is_valid]
+        pos_x = pos_x[is_valid]
+        pos_lvl = lvl_idx[pair_idx[is_valid]]
+        pos_anc = anc_idx[pair_idx[is_valid]]
+        pos_box = pair_boxes[is_valid]
+        pos_anchors = pair_anchors[is_valid]
+        pos_cls = pos_box[:, 4].astype(np.int64)
+        
+        # Bounding Box Regression Outputs. #
+        box_reg = np.stack([
+            (pos_anchors[:, 0] - pos_box[:, 0]) / pos_anchors[:, 2], 
+            (pos_anchors[:, 1] - pos_box[:, 1]) / pos_anchors[:, 3], 
+            pos_box[:, 2] / pos_anchors[:, 2], 
+            pos_box[:, 3] / pos_anchors[:, 3]], axis=1)
+        
+        # Scatter the targets of each level into its outputs. #
+        all_outputs = []
+        for n_level in range(n_levels):
+            is_level = pos_lvl == n_level
+            lvl_y = pos_y[is_level]
+            lvl_x = pos_x[is_level]
+            lvl_anc = pos_anc[is_level]
+            lvl_cls = pos_cls[is_level]
+            lvl_reg = box_reg[is_level]
+            
+            # Keep the last box assigned to every anchor. #
+            tmp_key = (lvl_y*w_max[n_level] + lvl_x)*n_anchor + lvl_anc
+            _, last_idx = np.unique(tmp_key[::-1], return_index=True)
+            last_idx = len(tmp_key) - 1 - last_idx
+            
+            if sparse:
+                reg_idx = np.stack([
+                    lvl_y, lvl_x, lvl_anc], axis=1)[last_idx]
+                cls_idx = np.unique(np.stack([
+                    lvl_y, lvl_x, lvl_anc, lvl_cls], axis=1), axis=0)
+                all_outputs.append((
+                    reg_idx.reshape(-1, 3).astype(np.int32), 
+                    lvl_reg[last_idx].astype(np.float32), 
+                    cls_idx.reshape(-1, 4).astype(np.int32)))
+            else:
+                tmp_outputs = np.zeros([
+                    n_anchor, h_max[n_level], 
+                    w_max[n_level], self.n_class+4])
+                tmp_outputs[
+                    lvl_anc[last_idx], lvl_y[last_idx], 
+                    lvl_x[last_idx], :4] = lvl_reg[last_idx]
+                tmp_outputs[lvl_anc, lvl_y, lvl_x, 4+lvl_cls] = 1.0
+                all_outputs.append(list(tmp_outputs))
+        return all_outputs, num_targets
+    
+    def format_data_tf(
+        self, gt_labels, img_dim, iou_thresh=0.50, img_pad=None):
+        """
+        Graph version of `format_data` with sparse=True, which uses
+        only TF ops so that it can run in a tf.data pipeline, e.g. on
+        the workers of a tf.data service. The entries of img_pad (or
+        img_dim if it is None) have to be Python ints, since they set
+        the feature map shapes. Every anchor is tested against every
+        box, and the outputs are the same as those of `format_data`.
+        """
+        if img_pad is None:
+            img_pad = img_dim
+        
+        n_levels = len(self.box_areas)
+        n_anchor = self.n_anchors
+        h_max = [int(img_pad[0] / x) for x in self.strides[:n_levels]]
+        w_max = [int(img_pad[1] / x) for x in self.strides[:n_levels]]
+        
+        # Scale the normalised bounding boxes accordingly. #
+        gt_boxes = tf.reshape(tf.cast(gt_labels, tf.float32), [-1, 5])
+        gt_scale = tf.cast([
+            img_dim[0], img_dim[1], 
+            img_dim[0], img_dim[1]], tf.float32)
+        box_dims = gt_boxes[:, :4] * gt_scale
+        box_cls  = tf.cast(gt_boxes[:, 4], tf.int64)
+        n_boxes  = tf.shape(gt_boxes, out_type=tf.int64)[0]
+        
+        box_corners = tf.concat([
+            box_dims[:, :2] - box_dims[:, 2:] / 2.0, 
+            box_dims[:, :2] + box_dims[:, 2:] / 2.0], axis=1)
+        box_areas = box_dims[:, 2] * box_dims[:, 3]
+        
+        level_anchors = self.anchor_bank.get_levels(
+            [[h_max[x], w_max[x]] for x in range(n_levels)])
         
-        num_targets = 0
         all_outputs = []
-        for n_level in range(len(self.box_areas)):
-            stride = self.strides[n_level]
-            h_max = int(img_pad[0] / stride)
-            w_max = int(img_pad[1] / stride)
+        num_targets = tf.constant(0, tf.int32)
+        for n_level in range(n_levels):
+            # The anchors are in (y, x, anchor) order. #
+            n_cells = h_max[n_level] * w_max[n_level]
+            anc_ctrs = tf.repeat(tf.constant(
+                level_anchors[n_level]["centers"].reshape(-1, 2), 
+                dtype=tf.float64), n_anchor, axis=0)
+            anc_dims = tf.tile(tf.cast(
+                level_anchors[n_level]["sizes_tf"], tf.float64), 
+                [n_cells, 1])
             
-            # Scale the normalised bounding boxes accordingly. #
-            gt_scale = np.array(
-                [img_dim[0], img_dim[1], img_dim[0], img_dim[1]])
-            gt_scale = np.reshape(gt_scale, (1, 4))
-            gt_boxes = gt_labels.numpy()
-            gt_boxes[:, :4] = gt_boxes[:, :4] * gt_scale
+            # IoU of every anchor and box, as in compute_pair_iou. #
+            anc_ctrs_f32 = tf.cast(anc_ctrs, tf.float32)
+            anc_dims_f32 = tf.cast(anc_dims, tf.float32)
+            anc_corners  = tf.concat([
+                anc_ctrs_f32 - anc_dims_f32 / 2.0, 
+                anc_ctrs_f32 + anc_dims_f32 / 2.0], axis=1)
             
-            # Get the anchors. #
-            level_anchors = self.get_anchors(
-                [h_max, w_max], n_level)
+            lu = tf.maximum(
+                box_corners[None, :, :2], anc_corners[:, None, :2])
+            rd = tf.minimum(
+                box_corners[None, :, 2:], anc_corners[:, None, 2:])
+            box_intersect  = tf.maximum(rd - lu, 0.0)
+            area_intersect = box_intersect[..., 0] * box_intersect[..., 1]
             
-            # Get the ground truth labels. #
-            tmp_outputs = []
-            for n_anchor in range(self.n_anchors):
-                tmp_output  = np.zeros(
-                    [h_max, w_max, self.n_class+4])
-                tmp_anchors = level_anchors[n_anchor]
-                tmp_anchors = np.reshape(tmp_anchors, (-1, 4))
-                
-                # Scale the anchor centroids. #
-                centroid_sc = np.array([stride, stride, 1.0, 1.0])
-                new_anchors = tmp_anchors * centroid_sc
-                
-                # Compute the Intersection over Union. #
-                gt_ious = compute_iou(gt_boxes[:, :4], new_anchors)
-                
-                bbox_valid_list = []
-                anchor_valid_list = []
-                for n_box in range(len(gt_boxes)):
-                    tmp_thresh = gt_ious[n_box, :] > iou_thresh
-                    num_target = np.sum(tmp_thresh.astype(np.int))
-                    
-                    # Assign the ground truth. #
-                    if num_target > 0:
-                        bbox_valid = np.zeros(
-                            [num_target, 5], dtype=np.float32)
-                        bbox_valid[:, :] = gt_boxes[n_box, :]
-                        bbox_valid_list.append(bbox_valid)
-                        
-                        anchor_valid = tmp_anchors[tmp_thresh, :]
-                        anchor_valid_list.append(anchor_valid)
-                        del bbox_valid, anchor_valid
-                    
-                    # Accumulate the number of targets. #
-                    num_targets += num_target
-                
-                if len(anchor_valid_list) > 0:
-                    if len(anchor_valid_list) == 1:
-                        bbox_valid = bbox_valid_list[0]
-                        anchor_valid = anchor_valid_list[0]
-                    else:
-                        bbox_valid = np.concatenate(
-                            tuple(bbox_valid_list), axis=0)
-                        anchor_valid = np.concatenate(
-                            tuple(anchor_valid_list), axis=0)
-                    del bbox_valid_list, anchor_valid_list
-                    
-                    y_pos = [
-                        int(z) for z in anchor_valid[:, 0]]
-                    x_pos = [
-                        int(z) for z in anchor_valid[:, 1]]
-                    
-                    tmp_label = [
-                        int(4+z) for z in bbox_valid[:, 4]]
-                    tmp_y_off = \
-                        anchor_valid[:, 0] * stride - bbox_valid[:, 0]
-                    tmp_y_off = tmp_y_off / anchor_valid[:, 2]
-                    tmp_x_off = \
-                        anchor_valid[:, 1] * stride - bbox_valid[:, 1]
-                    tmp_x_off = tmp_x_off / anchor_valid[:, 3]
-                    
-                    tmp_h_scale = \
-                        bbox_valid[:, 2] / anchor_valid[:, 2]
-                    tmp_w_scale = \
-                        bbox_valid[:, 3] / anchor_valid[:, 3]
-                    
-                    # Bounding Box Regression Outputs. #
-                    box_reg = [[
-                        tmp_y_off[z], tmp_x_off[z], 
-                        tmp_h_scale[z], tmp_w_scale[z]] \
-                            for z in range(len(anchor_valid))]
-                    
-                    # Assign the ground truth labels to #
-                    # the output array for training.    #
-                    tmp_output[y_pos, x_pos, :4] = box_reg
-                    tmp_output[y_pos, x_pos, tmp_label] = 1.0
-                
-                # Append the ground truth output for each anchor. #
-                tmp_outputs.append(tmp_output)
+            anc_areas  = anc_dims_f32[:, 0] * anc_dims_f32[:, 1]
+            pair_union = \
+                box_areas[None, :] + anc_areas[:, None] - area_intersect
+            pair_ious  = tf.clip_by_value(
+                area_intersect / tf.maximum(pair_union, 1e-8), 0.0, 1.0)
             
-            # Append to the overall outputs. #
-            all_outputs.append(tmp_outputs)
-        return all_outputs, num_targets
+            is_valid = pair_ious > iou_thresh
+            num_targets += tf.reduce_sum(tf.cast(is_valid, tf.int32))
+            
+            # Keep the last box assigned to every anchor. A column  #
+            # is prepended so that argmax works without any boxes. #
+            tmp_valid = tf.concat([tf.zeros(
+                [n_cells*n_anchor, 1], tf.bool), is_valid], axis=1)
+            last_box = n_boxes - 1 - tf.argmax(tf.reverse(tf.cast(
+                tmp_valid, tf.int32), axis=[1]), axis=1)
+            
+            pos_anchor = tf.where(tf.reduce_any(is_valid, axis=1))[:, 0]
+            pos_box = tf.gather(last_box, pos_anchor)
+            pos_ctr = tf.gather(anc_ctrs, pos_anchor)
+            pos_dim = tf.gather(anc_dims, pos_anchor)
+            pos_reg = tf.cast(tf.gather(box_dims, pos_box), tf.float64)
+            
+            # Bounding Box Regression Outputs. #
+            box_reg = tf.stack([
+                (pos_ctr[:, 0] - pos_reg[:, 0]) / pos_dim[:, 0], 
+                (pos_ctr[:, 1] - pos_reg[:, 1]) / pos_dim[:, 1], 
+                pos_reg[:, 2] / pos_dim[:, 0], 
+                pos_reg[:, 3] / pos_dim[:, 1]], axis=1)
+            reg_idx = tf.stack([
+                pos_anchor // (w_max[n_level]*n_anchor), 
+                (pos_anchor // n_anchor) % w_max[n_level], 
+                pos_anchor % n_anchor], axis=1)
+            
+            # The class labels of all the boxes of an anchor. #
+            pos_pairs = tf.where(is_valid)
+            cls_key = pos_pairs[:, 0]*self.n_class + \
+                tf.gather(box_cls, pos_pairs[:, 1])
+            cls_key = tf.sort(tf.unique(cls_key)[0])
+            cls_anchor = cls_key // self.n_class
+            cls_idx = tf.stack([
+                cls_anchor // (w_max[n_level]*n_anchor), 
+                (cls_anchor // n_anchor) % w_max[n_level], 
+                cls_anchor % n_anchor, 
+                cls_key % self.n_class], axis=1)
+            
+            all_outputs.append((
+                tf.cast(reg_idx, tf.int32), 
+                tf.cast(box_reg, tf.float32), 
+                tf.cast(cls_idx, tf.int32)))
+        return tuple(all_outputs), num_targets
+    
+    def expand_targets(self, x_label, feat_dims):
+        """
+        Expands the sparse targets of a level from `format_data` into
+        the dense [H, W, n_class+4] targets of each anchor inside the
+        graph.
+        """
+        reg_idx, reg_val, cls_idx = x_label
+        n_cls = tf.shape(cls_idx)[0]
+        
+        reg_map = tf.scatter_nd(
+            tf.cast(reg_idx, tf.int32), tf.cast(reg_val, tf.float32), 
+            [feat_dims[0], feat_dims[1], self.n_anchors, 4])
+        cls_map = tf.scatter_nd(
+            tf.cast(cls_idx, tf.int32), tf.ones([n_cls], tf.float32), 
+            [feat_dims[0], feat_dims[1], self.n_anchors, self.n_class])
+        
+        tmp_labels = tf.concat([reg_map, cls_map], axis=3)
+        return [tmp_labels[:, :, n_anchor, :] \
+            for n_anchor in range(self.n_anchors)]
     
     def focal_loss(
         self, labels, logits, alpha=0.25, gamma=2.0):
@@ -403,15 +589,23 @@ class RetinaNet(tf.keras.Model):
     def train_loss(self, x_image, x_label):
         """
         x_label: Normalised Gound Truth Bounding Boxes (x, y, w, h).
+        Sparse targets from format_data(..., sparse=True) are expanded
+        into the dense targets inside the graph.
         """
         x_pred = self.model(x_image, training=True)
         
         cls_loss = 0.0
         reg_loss = 0.0
         for n_level in range(len(x_pred)):
+            level_label = x_label[n_level]
+            if len(level_label[0].shape) == 2:
+                feat_dims = tf.shape(x_pred[n_level][0])[1:3]
+                level_label = self.expand_targets(
+                    level_label, feat_dims)
+            
             for n_anchor in range(self.n_anchors):
                 pred_label = x_pred[n_level][n_anchor]
-                true_label = x_label[n_level][n_anchor]
+                true_label = level_label[n_anchor]
                 
                 tmp_obj  = tf.reduce_max(
                     true_label[..., 4:], axis=-1)
@@ -427,20 +621,16 @@ class RetinaNet(tf.keras.Model):
     
     def prediction_to_corners(
         self, xy_pred, anchor_dim, stride):
-        feat_dims  = [tf.shape(xy_pred)[0], 
-                      tf.shape(xy_pred)[1]]
         bbox_shape = [int(xy_pred.shape[0]), 
                       int(xy_pred.shape[1]), 4]
         bbox_coord = np.zeros(bbox_shape)
         
-        ch = tf.range(0., tf.cast(
-            feat_dims[0], tf.float32), dtype=tf.float32)
-        cw = tf.range(0., tf.cast(
-            feat_dims[1], tf.float32), dtype=tf.float32)
-        [grid_x, grid_y] = tf.meshgrid(cw, ch)
+        # The anchor centers come from the anchor bank. #
+        anchor_ctr = self.anchor_bank.get(
+            bbox_shape[:2], self.strides.index(stride))["centers_tf"]
         
-        pred_x_cen = grid_x*stride - xy_pred[..., 1]*anchor_dim[1]
-        pred_y_cen = grid_y*stride - xy_pred[..., 0]*anchor_dim[0]
+        pred_x_cen = anchor_ctr[..., 1] - xy_pred[..., 1]*anchor_dim[1]
+        pred_y_cen = anchor_ctr[..., 0] - xy_pred[..., 0]*anchor_dim[0]
         pred_box_w = xy_pred[..., 3]*anchor_dim[1]
         pred_box_h = xy_pred[..., 2]*anchor_dim[0]
         
@@ -488,7 +678,9 @@ class RetinaNet(tf.keras.Model):
         for n_level in range(len(tmp_predict)):
             stride = self.strides[n_level]
             tmp_output = tmp_predict[n_level]
-            anchor_dim = self.anchor_boxes[n_level]
+            anchor_dim = self.anchor_bank.get([
+                int(tmp_output[0].shape[1]), 
+                int(tmp_output[0].shape[2])], n_level)["sizes"]
             
             for n_anchor in range(len(anchor_dim)):
                 tmp_dims = anchor_dim[n_anchor]
@@ -503,9 +695,8 @@ class RetinaNet(tf.keras.Model):
                     tf.nn.sigmoid(processed_logits).numpy()
                 
                 out_dims = processed_output.shape
-                tmp_outputs.append(np.array([
-                    processed_output[x, y, :] for x in range(
-                        out_dims[0]) for y in range(out_dims[1])]))
+                tmp_outputs.append(
+                    processed_output.reshape(-1, out_dims[2]))
         
         tmp_outputs = np.concatenate(tmp_outputs, axis=0)
         tmp_scores  = tf.reduce_max(tmp_outputs[:, 4:], axis=1)
@@ -532,15 +723,17 @@ class RetinaNet(tf.keras.Model):
     def detect_bboxes(
         self, image_file, img_dims, 
         iou_thresh=0.5, cls_thresh=0.05):
-        def _parse_image(filename):
+        def _parse_image(filename, min_side=None):
             image_string  = tf.io.read_file(filename)
             if filename.lower().strip().endswith(".png"):
                 image_decoded = \
                     tf.image.decode_png(image_string, channels=3)
+                raw_dims = tf.shape(image_decoded)[:2]
             else:
-                image_decoded = \
-                    tf.image.decode_jpeg(image_string, channels=3)
-            return tf.cast(image_decoded, tf.float32)
+                image_decoded = decode_jpeg_scaled(
+                    image_string, min_side=min_side)
+                raw_dims = tf.image.extract_jpeg_shape(image_string)[:2]
+            return image_decoded, raw_dims
         
         def prepare_image(image, img_w=384, img_h=384):
             img_dims = [int(image.shape[0]), 
@@ -549,13 +742,18 @@ class RetinaNet(tf.keras.Model):
             h_ratio  = img_dims[1] / img_h
             
             img_resized = tf.image.resize(image, [img_w, img_h])
-            img_resized = img_resized / 127.5 - 1.0
+            img_resized = model_input(img_resized, self.model)
             return tf.expand_dims(img_resized, axis=0), w_ratio, h_ratio
         
-        raw_image  = _parse_image(image_file)
+        raw_image, raw_dims = _parse_image(
+            image_file, min_side=img_dims)
         input_image, w_ratio, h_ratio = prepare_image(
             raw_image, img_w=img_dims, img_h=img_dims)
         
+        # Return the boxes in the full resolution image. #
+        w_ratio *= int(raw_dims[0]) / int(raw_image.shape[0])
+        h_ratio *= int(raw_dims[1]) / int(raw_image.shape[1])
+        
         tmp_detect = self.image_detections(
             input_image, cls_thresh=cls_thresh, iou_thresh=iou_thresh)
         bbox_ratio = np.array(
@@ -1,13 +1,27 @@
 
+import os
 import time
+import functools
 import numpy as np
 import pandas as pd
-import pickle as pkl
 from matplotlib import pyplot as plt
 
 import retinanet_module
 import tensorflow as tf
-from data_preprocess import swap_xy, preprocess_data
+from data_preprocess import swap_xy, convert_to_xywh, preprocess_data
+from data_preprocess import load_sample, random_flip_horizontal_batch
+from data_preprocess import random_flip_horizontal, random_jitter_image
+from annotation_store import load_annotations
+from image_cache import ImageCache
+from tfrecord_data import TFRecordReader
+from data_pipeline import build_augment_pipeline, build_service_pipeline
+from data_service import LocalDataService
+from target_cache import TargetCache
+from epoch_sampler import EpochSampler
+from valid_index import build_valid_index
+from shared_pool import SharedEncodePool
+from echo_buffer import EchoBuffer
+from encode_workers import build_encoder, prepare_sparse_sample
 
 # For debugging. #
 def show_heatmap(
@@ -141,6 +155,90 @@ def show_heatmap(
     del fig, ax
     return None
 
+# Functions to prepare a single training sample. #
+def encode_sample(
+    model, image, bbox, class_id, target_cache=None, tmp_key=None):
+    """
+    Returns the image with its sparse anchor targets and the number
+    of assigned targets, given its (x, y, w, h) boxes. If a TargetCache
+    is given, the targets are looked up by `tmp_key` first.
+    """
+    img_dim = tf.cast([
+        image.shape[0], image.shape[1]], tf.float32)
+    
+    # Format the input image and ground truth labels. #
+    label = tf.concat([bbox, tf.expand_dims(
+        tf.cast(class_id, tf.float32), axis=1)], axis=1)
+    img_pad = [int(image.shape[0]), 
+               int(image.shape[1])]
+    def _encode():
+        return model.format_data(
+            label, img_dim, img_pad=img_pad, 
+            iou_thresh=0.50, sparse=True)
+    
+    if target_cache is None:
+        tmp_labels, n_labels = _encode()
+    else:
+        tmp_labels, n_labels = target_cache.encode(tmp_key, _encode)
+    return image, tmp_labels, n_labels
+
+def prepare_sample(
+    model, sample, img_dims=512, 
+    img_cache=None, target_cache=None, normalize=True):
+    """
+    Returns the resized image of the sample with its anchor
+    targets and the number of assigned targets. If normalize is
+    False, the image is uint8.
+    """
+    flip_flag = None
+    if target_cache is not None:
+        flip_flag = np.random.uniform() <= 0.5
+    
+    image, bbox, class_id, img_dim = preprocess_data(
+        sample, img_dims=img_dims, pad_flag=False, 
+        img_cache=img_cache, flip_flag=flip_flag, normalize=normalize)
+    
+    tmp_key = None
+    if target_cache is not None:
+        tmp_key = target_cache.make_key(
+            sample, img_dim, img_dim, flip_flag)
+    
+    image, tmp_labels, n_labels = encode_sample(
+        model, image, bbox, class_id, 
+        target_cache=target_cache, tmp_key=tmp_key)
+    if n_labels == 0:
+        print("No targets in", sample["image"] + ".")
+    return image, tmp_labels, n_labels
+
+def prepare_sample_tf(
+    model, filename, bbox, class_id, img_dims=512, normalize=True):
+    """
+    Graph version of prepare_sample, which decodes, resizes and
+    flips the image and encodes its sparse anchor targets using
+    only TF ops, so that it can run on a tf.data service.
+    """
+    tmp_sample = {
+        "image": filename, 
+        "objects": {"bbox": bbox, "label": class_id}}
+    image, bbox, class_id = load_sample(
+        tmp_sample, img_dims=img_dims, normalize=normalize)
+    image, bbox = random_flip_horizontal(image, bbox)
+    bbox = convert_to_xywh(swap_xy(bbox))
+    
+    label = tf.concat([bbox, tf.expand_dims(
+        tf.cast(class_id, tf.float32), axis=1)], axis=1)
+    tmp_labels, n_labels = model.format_data_tf(
+        label, [img_dims, img_dims], iou_thresh=0.50)
+    return image, tmp_labels, n_labels
+
+def echo_sample(tmp_sample):
+    """
+    Returns a prepared sample with a fresh jitter of its image. The
+    anchor grid is not symmetric, so the targets cannot be flipped.
+    """
+    image, tmp_labels, n_labels = tmp_sample
+    return random_jitter_image(image), tmp_labels, n_labels
+
 # Training function. #
 def train(
     train_data, training_loss, model, 
@@ -148,9 +246,31 @@ def train(
     st_step, max_steps, init_lr=1e-3, min_lr=1e-5, 
     decay_step=1000, decay_rate=0.99, img_dims=512, 
     display_step=50, step_save=100, step_cool=1000, 
-    gradient_clip=1.0, save_loss_file="train_losses.csv"):
+    gradient_clip=1.0, save_loss_file="train_losses.csv", 
+    img_cache=None, record_reader=None, 
+    data_iter=None, target_cache=None, 
+    sampler=None, valid_index=None, encode_pool=None):
+    # Only one source of the training samples can be used. #
+    n_sources = len([x for x in [
+        data_iter, encode_pool, record_reader] if x is not None])
+    if n_sources > 1:
+        raise ValueError(
+            "Only one of data_iter, encode_pool and " + \
+            "record_reader can be given.")
+    
     n_data = len(train_data)
     
+    # Without the valid index, extra samples are drawn in case #
+    # some of them have no targets.                            #
+    if valid_index is None:
+        n_draw = 3*batch_size
+        valid_index = np.arange(n_data)
+    else:
+        n_draw = batch_size
+    
+    if sampler is None:
+        sampler = EpochSampler(len(valid_index), batch_size)
+    
     start_time = time.time()
     batch_objs = 0
     total_loss = 0.0
@@ -170,8 +290,24 @@ def train(
         step_lr = max(step_lr, min_lr)
         optimizer.lr.assign(step_lr)
         
-        batch_sample = np.random.choice(
-            n_data, size=3*batch_size, replace=False)
+        # Samples are drawn lazily until the batch is filled. #
+        if record_reader is not None:
+            batch_data = record_reader.next_batch(n_draw)
+        elif data_iter is not None:
+            batch_data = (
+                next(data_iter) for _ in range(n_draw))
+        elif encode_pool is not None:
+            # Return the slots of the last step to the ring, and  #
+            # keep the next draws encoding while this one trains. #
+            encode_pool.release_all()
+            while encode_pool.n_pending < 2*n_draw:
+                for tmp_idx in valid_index[sampler.next_batch(n_draw)]:
+                    encode_pool.submit(train_data[tmp_idx])
+            batch_data = (
+                encode_pool.get() for _ in range(n_draw))
+        else:
+            batch_sample = valid_index[sampler.next_batch(n_draw)]
+            batch_data = [train_data[x] for x in batch_sample]
         
         # Zero the gradients at each step. #
         with tf.device("cpu"):
@@ -184,22 +320,21 @@ def train(
         acc_losses = 0.0
         reg_losses = 0.0
         cls_losses = 0.0
-        for tmp_idx in batch_sample:
-            image, bbox, class_id, img_dim = preprocess_data(
-                train_data[tmp_idx], img_dims=img_dims, pad_flag=False)
-            
-            # Format the input image and ground truth labels. #
-            label = tf.concat([bbox, tf.expand_dims(
-                tf.cast(class_id, tf.float32), axis=1)], axis=1)
+        for tmp_sample in batch_data:
+            # Samples from the pipeline or workers are prepared. #
+            if data_iter is None and encode_pool is None:
+                image, tmp_labels, n_labels = prepare_sample(
+                    model, tmp_sample, img_dims=img_dims, 
+                    img_cache=img_cache, target_cache=target_cache, 
+                    normalize=not model.uint8_input)
+            else:
+                image, tmp_labels, n_labels = tmp_sample
+                n_labels = int(n_labels)
             image = tf.expand_dims(image, axis=0)
-            
             img_pad = [int(image.shape[1]), 
                        int(image.shape[2])]
-            tmp_labels, n_labels = model.format_data(
-                label, img_dim, img_pad=img_pad, iou_thresh=0.50)
             
             if n_labels == 0:
-                print("No targets at index", str(tmp_idx) + ".")
                 continue
             else:
                 n_updates += 1
@@ -270,11 +405,22 @@ def train(
             print("Average Loss:", str(round(avg_loss.numpy(), 5)))
             print("Average Reg Loss:", str(round(avg_reg_loss, 5)))
             print("Average Cls Loss:", str(round(avg_cls_loss, 5)))
+            if target_cache is not None:
+                target_cache.report()
+            if isinstance(data_iter, EchoBuffer):
+                data_iter.report()
             
             # Show the ground truth for debugging purposes. #
-            tmp_image = 127.5 * (image[0] + 1.0)
+            if image.dtype == tf.uint8:
+                tmp_image = tf.cast(image[0], tf.float32)
+            else:
+                tmp_image = 127.5 * (image[0] + 1.0)
+            tmp_dense = [[x.numpy() for x in model.expand_targets(
+                tmp_labels[n_level], [int(img_pad[0] / stride), 
+                int(img_pad[1] / stride)])] for n_level, stride in \
+                    enumerate(model.strides)]
             show_heatmap(
-                tmp_image, tmp_labels, 
+                tmp_image, tmp_dense, 
                 num_classes, anchor_dims, 
                 img_rows=img_pad[0], img_cols=img_pad[1])
             
@@ -310,10 +456,16 @@ def train(
 # Load the data. #
 tmp_path  = \
     "C:/Users/admin/Desktop/Data/COCO/"
-data_file = tmp_path + "coco_data_fcos.pkl"
-with open(data_file, "rb") as tmp_load:
-    id_2_label = pkl.load(tmp_load)
-    train_data = pkl.load(tmp_load)
+store_dir = tmp_path + "coco_data_fcos_store/"
+id_2_label, train_data = load_annotations(store_dir)
+
+# Use the pre-decoded images if the cache has been built. #
+cache_dir = tmp_path + "coco_image_cache/"
+if os.path.isdir(cache_dir):
+    img_cache = ImageCache(cache_dir)
+else:
+    img_cache = None
+
 label_2_id = dict(
     [(y, x) for x, y in id_2_label.items()])
 
@@ -342,17 +494,185 @@ batch_size = 16
 num_classes  = len(id_2_label)
 anchor_sizes = [20.0, 40.0, 80.0, 160.0, 320.0]
 
+# Feed uint8 images, which the model normalizes in the graph. #
+# This changes the layers, so it needs a fresh checkpoint.     #
+uint8_input = False
+img_dtype = tf.uint8 if uint8_input else tf.float32
+
 retinanet_model = retinanet_module.RetinaNet(
-    num_classes, label_2_id, 
-    anchor_sizes=anchor_sizes, backbone_model="resnet101")
+    num_classes, label_2_id, anchor_sizes=anchor_sizes, 
+    backbone_model="resnet101", uint8_input=uint8_input)
+
+# Cache the encoded anchor targets of the fixed-size inputs, #
+# so that repeated epochs skip the anchor assignment.        #
+use_target_cache = True
+if use_target_cache:
+    target_cache = TargetCache((
+        "retinanet", tuple(retinanet_model.strides), 
+        tuple(retinanet_model.anchor_sizes), 
+        tuple(retinanet_model.aspect_ratios), 
+        tuple(retinanet_model.anchor_scales), 
+        num_classes, 0.50, "sparse"), 
+        max_mb=8192, cache_dir=tmp_path + "coco_target_cache/")
+else:
+    target_cache = None
+
+# Record once which samples have positive anchors at the #
+# training resolution, so that each step only decodes the #
+# samples that it trains on.                              #
+use_valid_index = True
+if use_valid_index:
+    valid_index = build_valid_index(
+        retinanet_model, train_data, img_dims, iou_thresh=0.50, 
+        index_file=tmp_path + "coco_valid_index_" + str(img_dims) + ".npz")
+    n_valid = len(valid_index)
+else:
+    valid_index = None
+    n_valid = len(train_data)
+
+# Read the training data from the TFRecord shards if written, #
+# instead of the pipeline or the encode pool. Only the shards #
+# of the samples in the valid index are used.                 #
+record_dir = tmp_path + "coco_tfrecords/"
+if os.path.isdir(record_dir):
+    if valid_index is None:
+        record_images = None
+    else:
+        record_images = [train_data.get_image(x) for x in valid_index]
+    record_reader = TFRecordReader(record_dir, images=record_images)
+else:
+    record_reader = None
+
+# Decode and encode the samples with graph ops on a local #
+# tf.data service, whose worker processes scale past the  #
+# thread pool of the trainer. It does not use the cache.  #
+use_data_service = False
+
+# Encode the samples in worker processes, which write them  #
+# into a ring of shared memory slots for the training loop. #
+# Each worker builds its own RetinaNet for the anchors, and #
+# the workers decode from disk without the image or target  #
+# caches, so the pool is off by default.                    #
+use_encode_pool = False
+if use_encode_pool and (use_target_cache or use_data_service):
+    raise ValueError(
+        "The encode pool does not use the target cache " + \
+        "or the data service.")
+elif use_encode_pool:
+    encode_pool = SharedEncodePool(
+        functools.partial(
+            prepare_sparse_sample, img_dims=img_dims, 
+            normalize=not uint8_input), 
+        n_workers=4, n_slots=8*batch_size, init_fn=build_encoder, 
+        init_args=(num_classes, label_2_id, anchor_sizes))
+else:
+    encode_pool = None
+
+# Prepare the samples in a parallel tf.data pipeline, with #
+# the random flips applied a batch at a time in the graph.  #
+use_pipeline = not use_encode_pool and \
+    not use_data_service and record_reader is None
+if use_pipeline:
+    n_levels = len(retinanet_model.strides)
+    pipe_signature = (
+        tf.TensorSpec([img_dims, img_dims, 3], img_dtype), 
+        tuple([(tf.TensorSpec([None, 3], tf.int32), 
+                tf.TensorSpec([None, 4], tf.float32), 
+                tf.TensorSpec([None, 4], tf.int32)) \
+                    for _ in range(n_levels)]), 
+        tf.TensorSpec([], tf.int32))
+    
+    load_signature = (
+        tf.TensorSpec([img_dims, img_dims, 3], img_dtype), 
+        tf.TensorSpec([None, 4], tf.float32), 
+        tf.TensorSpec([None], tf.int32), 
+        tf.TensorSpec([], tf.int64))
+    
+    def pipe_load(tmp_idx):
+        if valid_index is not None:
+            tmp_idx = int(valid_index[tmp_idx])
+        image, bbox, class_id = load_sample(
+            train_data[tmp_idx], img_dims=img_dims, 
+            img_cache=img_cache, normalize=not uint8_input)
+        return image, bbox, class_id, tmp_idx
+    
+    # The flips are returned to key the cached targets. #
+    def pipe_augment(images, bboxes, class_ids, img_idx):
+        flip_flag = tf.random.uniform([tf.shape(images)[0]]) <= 0.5
+        images, bboxes = random_flip_horizontal_batch(
+            images, bboxes, flip_flag=flip_flag)
+        return images, bboxes, class_ids, img_idx, flip_flag
+    
+    def pipe_encode(image, bbox, class_id, img_idx, flip_flag):
+        tmp_key = None
+        if target_cache is not None:
+            tmp_key = target_cache.make_key(
+                train_data[int(img_idx)], 
+                [img_dims, img_dims], [img_dims, img_dims], flip_flag)
+        
+        bbox = convert_to_xywh(swap_xy(bbox))
+        return encode_sample(
+            retinanet_model, image, bbox, class_id, 
+            target_cache=target_cache, tmp_key=tmp_key)
+    
+    data_iter = iter(build_augment_pipeline(
+        n_valid, pipe_load, load_signature, 
+        pipe_augment, pipe_encode, pipe_signature, aug_batch=batch_size))
+else:
+    data_iter = None
+
+if use_data_service:
+    data_service = LocalDataService(n_workers=8)
+    if valid_index is None:
+        svc_data = train_data
+    else:
+        svc_data = [train_data[x] for x in valid_index]
+    
+    svc_bbox = [np.reshape(np.array(
+        x["objects"]["bbox"], dtype=np.float32), [-1, 4]) for x in svc_data]
+    svc_label = [np.array(
+        x["objects"]["label"], dtype=np.int32) for x in svc_data]
+    svc_records = (
+        tf.constant([x["image"] for x in svc_data]), 
+        tf.RaggedTensor.from_row_lengths(
+            np.concatenate(svc_bbox), [len(x) for x in svc_bbox]), 
+        tf.RaggedTensor.from_row_lengths(
+            np.concatenate(svc_label), [len(x) for x in svc_label]))
+    del svc_data, svc_bbox, svc_label
+    
+    def service_encode(filename, bbox, class_id):
+        return prepare_sample_tf(
+            retinanet_model, filename, bbox, class_id, 
+            img_dims=img_dims, normalize=not uint8_input)
+    
+    data_iter = iter(build_service_pipeline(
+        svc_records, service_encode, service=data_service))
+else:
+    data_service = None
+
+# Reuse each prepared sample up to echo_factor times with a #
+# fresh jitter, so that the training loop does not wait for #
+# the decoding and encoding of the pipeline or service.     #
+use_echo = use_pipeline or use_data_service
+echo_factor = 2
+if use_echo:
+    data_iter = EchoBuffer(
+        data_iter, echo_factor=echo_factor, 
+        buffer_size=8*batch_size, augment_fn=echo_sample)
+
 model_optimizer = tf.optimizers.SGD(momentum=0.9)
 
 print("-" * 50)
 print("RetinaNet Model Built.")
 #print(fcos_model.summary())
 
+# Draw the batches epoch by epoch, and save the position of #
+# the sampler with the checkpoint to resume mid-epoch.      #
+sampler = EpochSampler(n_valid, batch_size)
+
 checkpoint = tf.train.Checkpoint(
     step=tf.Variable(0), 
+    sampler=sampler, 
     retinanet_model=retinanet_model, 
     model_optimizer=model_optimizer)
 ck_manager = tf.train.CheckpointManager(
@@ -378,7 +698,8 @@ st_step = checkpoint.step.numpy().astype(np.int32)
 print("-" * 50)
 print("Training RetinaNet with", str(num_classes), 
       "classes (" + str(st_step) + " iterations).")
-print(str(len(train_data)), "training images.")
+print(str(len(train_data)), "training images", 
+      "(" + str(n_valid) + " with targets).")
 
 train(
     train_data, training_loss, 
@@ -389,4 +710,13 @@ train(
     init_lr=init_lr, decay_step=decay_step, 
     img_dims=img_dims, gradient_clip=grad_clip, 
     decay_rate=decay_rate, display_step=disp_step, 
-    step_cool=step_cool, save_loss_file=train_loss)
+    step_cool=step_cool, save_loss_file=train_loss, 
+    img_cache=img_cache, record_reader=record_reader, 
+    data_iter=data_iter, target_cache=target_cache, 
+    sampler=sampler, valid_index=valid_index, 
+    encode_pool=encode_pool)
+
+if encode_pool is not None:
+    encode_pool.close()
+if data_service is not None:
+    data_service.close()
@@ -1,4 +1,5 @@
 
+import functools
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
@@ -39,6 +40,76 @@ def convert_to_corners(boxes):
         [boxes[..., :2] - boxes[..., 2:] / 2.0, 
          boxes[..., :2] + boxes[..., 2:] / 2.0], axis=-1)
 
+def decode_jpeg_scaled(image_string, min_side=None):
+    """Decodes a JPEG at the largest DCT scaling ratio of 1, 2, 4 or 8
+    which keeps its shorter side at least `min_side`, using the size in
+    the JPEG header, so that an image which is resized down afterwards
+    is not decoded at full resolution.
+    Arguments:
+      image_string: A string tensor of the encoded JPEG bytes.
+      min_side: The smallest shorter side of the decoded image, e.g. the
+        largest shorter side it is resized to. If None, the image is
+        decoded at full resolution.
+    Returns:
+      the decoded uint8 image with shape `(height, width, 3)`.
+    """
+    if min_side is None:
+        return tf.io.decode_jpeg(image_string, channels=3)
+    
+    # The decoder rounds the scaled sides up, so flooring is safe. #
+    jpeg_shape = tf.image.extract_jpeg_shape(image_string)
+    short_side = tf.reduce_min(jpeg_shape[:2])
+    min_side = tf.cast(tf.math.ceil(
+        tf.cast(min_side, tf.float32)), tf.int32)
+    n_ratio = tf.reduce_sum(tf.cast(
+        short_side // [2, 4, 8] >= min_side, tf.int32))
+    
+    # The ratio is an attribute of the op, so it takes a branch each. #
+    return tf.switch_case(n_ratio, [functools.partial(
+        tf.io.decode_jpeg, image_string, channels=3, ratio=x) \
+            for x in [1, 2, 4, 8]])
+
+def quantize_image(image):
+    """Rounds an image with pixel values in [0, 255] to uint8.
+    Arguments:
+      image: A float tensor of the image or images.
+    Returns:
+      the uint8 image.
+    """
+    return tf.cast(tf.clip_by_value(
+        tf.round(image), 0.0, 255.0), tf.uint8)
+
+def uint8_image_input(scale=1.0/127.5, offset=-1.0):
+    """Returns a uint8 image input of a model and the float32 image it
+    normalizes to in the graph, as `image * scale + offset`, so that the
+    images can be moved and cached as uint8 up to the model.
+    Arguments:
+      scale: The scale of the pixel values, matching the loaders.
+      offset: The offset added to the scaled pixel values.
+    Returns:
+      the uint8 input and the normalized float32 image.
+    """
+    x_input = tf.keras.Input(
+        shape=(None, None, 3), dtype=tf.uint8, name="x_uint8")
+    x_image = tf.keras.layers.Rescaling(
+        scale, offset=offset, name="x_normalize")(x_input)
+    return x_input, x_image
+
+def model_input(image, model, scale=1.0/127.5, offset=-1.0):
+    """Prepares the resized image, with pixel values in [0, 255], for
+    the model. If the model takes uint8 images, they are rounded to
+    uint8 and normalized in its graph, otherwise they are normalized
+    here as `image * scale + offset`.
+    Arguments:
+      image: A tensor of the resized image or images.
+      model: The Keras model which the image is passed to.
+    Returns:
+      the uint8 or the normalized float32 image.
+    """
+    if tf.as_dtype(model.inputs[0].dtype) == tf.uint8:
+        return quantize_image(image)
+    return tf.cast(image, tf.float32) * scale + offset
+
 def compute_iou(boxes1, boxes2):
     """
     Computes pairwise IOU matrix for given two sets of boxes
@@ -82,6 +153,44 @@ def compute_iou(boxes1, boxes2):
     inter_union = np.clip(area_intersect / union_area, 0.0, 1.0)
     return inter_union
 
+def compute_pair_iou(boxes1, boxes2):
+    """
+    Computes the IOU of matched pairs of boxes, with the same float32
+    operations as `compute_iou`.
+    Arguments:
+      boxes1: A tensor with shape `(N, 4)` representing bounding boxes
+        where each box is of the format `[x, y, width, height]`.
+      boxes2: A tensor with shape `(N, 4)` representing bounding boxes
+        where each box is of the format `[x, y, width, height]`.
+    Returns:
+      IOU vector with shape `(N,)`, where the ith value holds the IOU
+      between the ith box of boxes1 and the ith box of boxes2.
+    """
+    # Convert the boxes to their coordinates. #
+    boxes1 = boxes1.astype(np.float32)
+    boxes2 = boxes2.astype(np.float32)
+    
+    boxes1_corners = np.concatenate((
+        boxes1[:, :2] - boxes1[:, 2:] / 2.0, 
+        boxes1[:, :2] + boxes1[:, 2:] / 2.0), axis=1)
+    boxes2_corners = np.concatenate((
+        boxes2[:, :2] - boxes2[:, 2:] / 2.0, 
+        boxes2[:, :2] + boxes2[:, 2:] / 2.0), axis=1)
+    
+    lu = np.maximum(boxes1_corners[:, :2], boxes2_corners[:, :2])
+    rd = np.minimum(boxes1_corners[:, 2:], boxes2_corners[:, 2:])
+    
+    box_intersect  = np.maximum(0.0, rd - lu)
+    area_intersect = box_intersect[:, 0] * box_intersect[:, 1]
+    
+    boxes1_area = boxes1[:, 2] * boxes1[:, 3]
+    boxes2_area = boxes2[:, 2] * boxes2[:, 3]
+    
+    pair_union  = boxes1_area + boxes2_area - area_intersect
+    union_area  = np.maximum(pair_union, 1e-8)
+    inter_union = np.clip(area_intersect / union_area, 0.0, 1.0)
+    return inter_union
+
 def visualize_detections(
     image, boxes, classes, scores, show_text=True, 
     figsize=(7, 7), linewidth=1, color=[0, 0, 1]):
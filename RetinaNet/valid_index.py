@@ -0,0 +1,88 @@
+import os
+import hashlib
+import numpy as np
+import tensorflow as tf
+from data_preprocess import swap_xy, convert_to_xywh
+from data_preprocess import random_flip_horizontal
+
+def count_targets(
+    model, sample, img_dims, iou_thresh=0.50, flip_flag=False):
+    """
+    Returns the number of anchors assigned to the boxes of a sample
+    resized to `img_dims`. Only the boxes are needed, so the image
+    is not decoded.
+    """
+    if len(sample["objects"]["label"]) == 0:
+        return 0
+    
+    bbox = tf.cast(sample["objects"]["bbox"], tf.float32)
+    class_id = tf.cast(sample["objects"]["label"], tf.float32)
+    _, bbox = random_flip_horizontal(
+        tf.zeros([1, 1, 3]), bbox, flip_flag=flip_flag)
+    bbox = convert_to_xywh(swap_xy(bbox))
+    
+    label = tf.concat([
+        bbox, tf.expand_dims(class_id, axis=1)], axis=1)
+    img_dim = tf.cast([img_dims, img_dims], tf.float32)
+    _, n_labels = model.format_data(
+        label, img_dim, img_pad=[img_dims, img_dims], 
+        iou_thresh=iou_thresh, sparse=True)
+    return int(n_labels)
+
+def build_valid_index(
+    model, train_data, img_dims, iou_thresh=0.50, index_file=None):
+    """
+    Records once which samples have any positive anchors at the
+    training resolution, both unflipped and flipped, so that the
+    training loop only draws samples which yield targets. As the
+    anchor grid is not symmetric, a sample has to have targets in
+    both orientations to be valid.
+    Arguments:
+      model: The RetinaNet whose anchors assign the targets.
+      train_data: The list of training samples.
+      img_dims: The training resolution.
+      iou_thresh: The IoU threshold of the positive anchors.
+      index_file: An optional `.npz` file. If it exists and matches
+        the samples and the anchor configuration, the index is
+        loaded from it, otherwise it is written to it.
+    Returns:
+      The sorted indices into `train_data` of the valid samples.
+    """
+    n_data = len(train_data)
+    config = repr((
+        tuple(model.strides), tuple(model.anchor_sizes), 
+        tuple(model.aspect_ratios), tuple(model.anchor_scales), 
+        int(img_dims), float(iou_thresh)))
+    
+    data_hash = hashlib.sha1()
+    for tmp_sample in train_data:
+        data_hash.update(tmp_sample["image"].encode("utf-8"))
+        data_hash.update(np.asarray(
+            tmp_sample["objects"]["bbox"], dtype=np.float32).tobytes())
+    data_hash = data_hash.hexdigest()
+    
+    if index_file is not None and os.path.isfile(index_file):
+        tmp_load = np.load(index_file)
+        if str(tmp_load["config"]) == config \
+            and str(tmp_load["data_hash"]) == data_hash:
+            return tmp_load["valid_idx"]
+    
+    n_targets = np.zeros([n_data, 2], dtype=np.int32)
+    for n_sample in range(n_data):
+        for n_flip in range(2):
+            n_targets[n_sample, n_flip] = count_targets(
+                model, train_data[n_sample], img_dims, 
+                iou_thresh=iou_thresh, flip_flag=(n_flip == 1))
+        
+        if (n_sample+1) % 5000 == 0:
+            print(str(n_sample+1), "samples analysed.")
+    
+    valid_idx = np.nonzero(np.all(n_targets > 0, axis=1))[0]
+    print(str(len(valid_idx)), "of", str(n_data), 
+          "samples have targets at", str(img_dims), "pixels.")
+    
+    if index_file is not None:
+        np.savez(
+            index_file, valid_idx=valid_idx, n_targets=n_targets, 
+            config=config, data_hash=data_hash)
+    return valid_idx
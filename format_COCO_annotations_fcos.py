@@ -1,23 +1,170 @@
+import os
 import time
 import numpy as np
 import pandas as pd
 import pickle as pkl
 import tensorflow as tf
 
-# Custom function. #
+# Custom functions. #
 def compute_centerness(l, r, b, t):
     return np.multiply(
-        np.sqrt(min(l, r) / max(l, r)), 
-        np.sqrt(min(b, t) / max(b, t)))
+        np.sqrt(np.minimum(l, r) / np.maximum(l, r)), 
+        np.sqrt(np.minimum(b, t) / np.maximum(b, t)))
+
+# Channels 0 to 5 hold (b, t, l, r, centerness, 1). #
+n_fixed = 6
+
+def grid_boxes(obj_boxes, stride=8):
+    """
+    Returns the (x_low, y_low, x_upp, y_upp) range of the cells of
+    the feature map at `stride` whose centers lie inside each box.
+    """
+    tmp_grid = np.ceil((obj_boxes - stride/2) / stride)
+    return np.maximum(tmp_grid, 0).astype(np.int64)
+
+def build_sparse_targets(
+    obj_boxes, obj_labels, obj_scale, owner_map, stride=8):
+    """
+    Builds the sparse multi-scale targets of all objects in an image.
+    obj_boxes: Integer pixel boxes (x_low, y_low, x_upp, y_upp).
+    obj_labels: The class index of each object.
+    obj_scale: The scale index assigned to each object.
+    owner_map: An int32 array of shape (down_height, down_width, 
+      num_scale) of the feature map at `stride`, which is overwritten
+      to record the object which owns each cell. The first object
+      whose box holds the center of a cell at a scale keeps it, so
+      later objects only fill the free cells.
+    Returns the (n_nnz, 4) int32 indices of (y, x, scale, channel)
+    and their float32 values, with channels 0 to 5 holding
+    (b, t, l, r, centerness, 1) in pixels and channel label+6
+    holding 1. Objects which hold no cell center have no targets.
+    """
+    tmp_grid = grid_boxes(obj_boxes, stride=stride)
+    owner_map[:] = -1
+    for n_obj in range(len(obj_boxes)-1, -1, -1):
+        x_low, y_low, x_upp, y_upp = tmp_grid[n_obj]
+        owner_map[y_low:y_upp, x_low:x_upp, obj_scale[n_obj]] = n_obj
+    
+    tmp_y, tmp_x, tmp_sc = np.nonzero(owner_map >= 0)
+    tmp_owner = owner_map[tmp_y, tmp_x, tmp_sc]
+    tmp_boxes = obj_boxes[tmp_owner]
+    
+    # Regress from the pixel center of each cell. #
+    pix_x = tmp_x*stride + stride/2
+    pix_y = tmp_y*stride + stride/2
+    tmp_l = pix_x - tmp_boxes[:, 0]
+    tmp_r = tmp_boxes[:, 2] - pix_x
+    tmp_b = pix_y - tmp_boxes[:, 1]
+    tmp_t = tmp_boxes[:, 3] - pix_y
+    tmp_c = compute_centerness(tmp_l, tmp_r, tmp_b, tmp_t)
+    
+    # Each cell has 6 regression values and 1 class value. #
+    n_pixel = len(tmp_owner)
+    tmp_values = np.stack([
+        tmp_b, tmp_t, tmp_l, tmp_r, tmp_c, 
+        np.ones(n_pixel), np.ones(n_pixel)], axis=1)
+    
+    tmp_chans = np.tile(np.arange(n_fixed+1), [n_pixel, 1])
+    tmp_chans[:, n_fixed] = obj_labels[tmp_owner] + n_fixed
+    tmp_indices = np.stack([
+        np.repeat(tmp_y, n_fixed+1), np.repeat(tmp_x, n_fixed+1), 
+        np.repeat(tmp_sc, n_fixed+1), tmp_chans.ravel()], axis=1)
+    tmp_values  = tmp_values.ravel()
+    return tmp_indices.astype(np.int32), tmp_values.astype(np.float32)
+
+def build_dense_targets(
+    obj_boxes, obj_labels, obj_scale, dense_shape, stride=8):
+    """
+    Reference encoder of `build_sparse_targets`, which fills the
+    dense targets cell by cell in the order of the objects.
+    """
+    tmp_dense = np.zeros(dense_shape, dtype=np.float32)
+    for n_obj in range(len(obj_boxes)):
+        x_low, y_low, x_upp, y_upp = obj_boxes[n_obj]
+        id_sc = obj_scale[n_obj]
+        for tmp_y in range(dense_shape[0]):
+            for tmp_x in range(dense_shape[1]):
+                pix_x = tmp_x*stride + stride/2
+                pix_y = tmp_y*stride + stride/2
+                if pix_x < x_low or pix_x >= x_upp \
+                    or pix_y < y_low or pix_y >= y_upp:
+                    continue
+                elif tmp_dense[tmp_y, tmp_x, id_sc, 5] > 0:
+                    continue
+                
+                tmp_l = pix_x - x_low
+                tmp_r = x_upp - pix_x
+                tmp_b = pix_y - y_low
+                tmp_t = y_upp - pix_y
+                tmp_c = compute_centerness(tmp_l, tmp_r, tmp_b, tmp_t)
+                
+                tmp_dense[tmp_y, tmp_x, id_sc, :n_fixed] = \
+                    [tmp_b, tmp_t, tmp_l, tmp_r, tmp_c, 1]
+                tmp_dense[tmp_y, tmp_x, id_sc, 
+                          obj_labels[n_obj]+n_fixed] = 1
+    return tmp_dense
+
+def check_sparse_targets(
+    obj_boxes, obj_labels, obj_scale, 
+    tmp_indices, tmp_values, dense_shape, stride=8):
+    """
+    Checks that the sparse targets rebuild into the dense targets
+    of the reference encoder. `tf.sparse.to_dense` also fails on
+    duplicate or out of range indices.
+    """
+    tmp_sparse = tf.sparse.reorder(tf.sparse.SparseTensor(
+        tmp_indices.astype(np.int64), tmp_values, dense_shape))
+    tmp_dense  = tf.sparse.to_dense(tmp_sparse).numpy()
+    ref_dense  = build_dense_targets(
+        obj_boxes, obj_labels, obj_scale, dense_shape, stride=stride)
+    return np.allclose(tmp_dense, ref_dense, rtol=0.0, atol=1.0e-6)
+
+def load_changed_objects(
+    pkl_file, chg_file, img_scale, n_channels):
+    """
+    Returns the objects of the previous formatting and the set of
+    images in the change list of process_COCO_annotations_fcos.py, 
+    or (None, None) if either file is missing or the previous file
+    was formatted with other scales, classes or an older layout of
+    (img_file, dims, indices, values, dense_shape).
+    """
+    if not os.path.isfile(pkl_file) or not os.path.isfile(chg_file):
+        return None, None
+    
+    with open(pkl_file, "rb") as tmp_load:
+        old_scale = pkl.load(tmp_load)
+        old_objects = pkl.load(tmp_load)
+    if old_scale != img_scale or not isinstance(old_objects, list) \
+        or len(old_objects) != len(img_scale):
+        return None, None
+    
+    for tmp_objects in old_objects:
+        if not isinstance(tmp_objects, list):
+            return None, None
+        for tmp_object in tmp_objects:
+            if not isinstance(tmp_object, tuple) or len(tmp_object) != 5:
+                return None, None
+            elif not isinstance(tmp_object[4], list) \
+                or len(tmp_object[4]) != 4 \
+                or tmp_object[4][-1] != n_channels:
+                return None, None
+    
+    chg_files = set(pd.read_csv(chg_file)["filename"].values)
+    return old_objects, chg_files
 
 # Load the COCO dataset. #
-tmp_pd_file = \
-    "C:/Users/admin/Desktop/Data/COCO/object_boxes.csv"
+tmp_path = "C:/Users/admin/Desktop/Data/COCO/"
+tmp_pd_file  = tmp_path + "object_boxes.csv"
+tmp_chg_file = tmp_path + "object_boxes_changed.csv"
+save_pkl_file = tmp_path + "coco_annotations_fcos.pkl"
 raw_coco_df = pd.read_csv(tmp_pd_file)
 
+# Only format the images which were added or changed since #
+# the last run, and drop those which were removed.         #
+incremental = True
+
 # Remember to add 1 more class for background. #
-coco_label = pd.read_csv(
-    "C:/Users/admin/Desktop/Data/COCO/labels.csv")
+coco_label = pd.read_csv(tmp_path + "labels.csv")
 list_label = sorted([
     coco_label.iloc[x]["name"] \
     for x in range(len(coco_label))])
@@ -26,21 +173,28 @@ label_dict = dict([(
     x, list_label[x]) for x in range(len(list_label))])
 index_dict = dict([(
     list_label[x], x) for x in range(len(list_label))])
+coco_id_dict = dict([(
+    coco_label.iloc[x]["id"], 
+    index_dict[coco_label.iloc[x]["name"]]) \
+    for x in range(len(coco_label))])
 
-tmp_col_df  = ["filename", "img_width", "img_height", "id", 
-              "x_lower", "y_lower", "box_width", "box_height"]
-image_files = sorted(list(pd.unique(raw_coco_df["filename"])))
-image_files = pd.DataFrame(image_files, columns=["filename"])
+# Sort once and split the objects by image. #
+raw_coco_df = raw_coco_df.sort_values(
+    "filename", kind="stable").reset_index(drop=True)
+raw_coco_df["label"] = raw_coco_df["id"].map(coco_id_dict)
+
+image_files, img_start = np.unique(
+    raw_coco_df["filename"].values, return_index=True)
+img_end = np.append(img_start[1:], len(raw_coco_df))
 print("Total of", str(len(image_files)), "images in COCO dataset.")
 
-raw_coco_df["x_centroid"] = \
-    raw_coco_df["x_lower"] + raw_coco_df["box_width"]/2
-raw_coco_df["y_centroid"] = \
-    raw_coco_df["y_lower"] + raw_coco_df["box_height"]/2
+obj_columns = ["img_width", "img_height", "label", 
+               "x_lower", "y_lower", "box_width", "box_height"]
+obj_array = raw_coco_df[obj_columns].values.astype(np.float64)
 
 # Define the Neural Network. #
-#img_dims  = [(128, 128), (192, 192), (256, 256), 
-#             (320, 320), (384, 384), (448, 448), 
+#img_dims  = [(128, 128), (192, 192), (256, 256),
+#             (320, 320), (384, 384), (448, 448),
 #             (512, 512), (576, 576), (640, 640)]
 
 img_dims  = [(448, 448)]
@@ -55,147 +209,111 @@ for n_scale in range(len(img_dims)):
     img_scale.append(tmp_scale[::-1])
 del tmp_scale
 
-# Find a way to remove duplicate indices from the data. #
-# Total output classes is n_classes + centerness (1) + regression (4). #
+if incremental:
+    old_objects, chg_files = load_changed_objects(
+        save_pkl_file, tmp_chg_file, img_scale, n_classes+n_fixed)
+else:
+    old_objects, chg_files = None, None
+
+if old_objects is None:
+    update_idx = np.arange(len(image_files))
+else:
+    update_idx = np.where(np.isin(image_files, list(chg_files)))[0]
+    print("Formatting", str(len(update_idx)), "changed images.")
+
+# Overlapping cells are assigned to the first object. Total  #
+# output channels is n_classes + regression (4) + centerness #
+# (1) + positive (1).                                        #
 print("Formatting the object detection bounding boxes.")
 start_time = time.time()
 
+n_check = 100
 train_objects = []
 for n_scale in range(len(img_dims)):
     tmp_objects = []
-    for n_img in range(len(image_files)):
-        print(n_img)
-        tot_obj  = 0
-        img_file = image_files.iloc[n_img]["filename"]
-        
-        img_width   = img_dims[n_scale][0]
-        img_height  = img_dims[n_scale][1]
-        max_scale   = max(img_width, img_height)
-        tmp_scale   = img_scale[n_scale]
-        down_width  = int(img_width/8)
-        down_height = int(img_height/8)
-        dense_shape = [
-            down_height, down_width, num_scale, n_classes+4]
+    
+    img_width   = img_dims[n_scale][0]
+    img_height  = img_dims[n_scale][1]
+    tmp_scale   = np.array(img_scale[n_scale])
+    down_width  = int(img_width/8)
+    down_height = int(img_height/8)
+    dense_shape = [
+        down_height, down_width, num_scale, n_classes+n_fixed]
+    owner_map   = np.zeros(
+        [down_height, down_width, num_scale], dtype=np.int32)
+    
+    for n_count in range(len(update_idx)):
+        n_img = update_idx[n_count]
+        img_file = image_files[n_img]
+        tmp_filter = obj_array[img_start[n_img]:img_end[n_img]]
         
-        tmp_filter = raw_coco_df[
-            raw_coco_df["filename"] == img_file]
-        tmp_filter = tmp_filter[[
-            "img_width", "img_height", "id", "x_lower", "y_lower", 
-            "box_width", "box_height", "x_centroid", "y_centroid"]]
+        tmp_w_ratio = tmp_filter[0, 0] / img_width
+        tmp_h_ratio = tmp_filter[0, 1] / img_height
+        tmp_width  = tmp_filter[:, 5] / tmp_w_ratio
+        tmp_height = tmp_filter[:, 6] / tmp_h_ratio
         
-        tmp_w_ratio = tmp_filter.iloc[0]["img_width"] / img_width
-        tmp_h_ratio = tmp_filter.iloc[0]["img_height"] / img_height
+        tmp_valid  = np.logical_and(tmp_width >= 0, tmp_height >= 0)
+        tmp_filter = tmp_filter[tmp_valid]
+        tmp_width  = tmp_width[tmp_valid]
+        tmp_height = tmp_height[tmp_valid]
         if len(tmp_filter) > 0:
-            tmp_mask = np.zeros(
-                [img_width, img_height, num_scale], dtype=np.int32)
+            # Assign each object to the first scale #
+            # which is larger than its longer side. #
+            tmp_max_side = np.maximum(tmp_width, tmp_height)
+            obj_scale = np.searchsorted(
+                tmp_scale[:-1], tmp_max_side, side="right")
             
-            tmp_indices = []
-            tmp_values  = []
-            for n_obj in range(len(tmp_filter)):
-                tmp_object = tmp_filter.iloc[n_obj]
-                tmp_label  = int(index_dict[coco_label[
-                    coco_label["id"] == tmp_object["id"]].iloc[0]["name"]])
-                
-                tmp_width  = tmp_object["box_width"] / tmp_w_ratio
-                tmp_height = tmp_object["box_height"] / tmp_h_ratio
-                
-                if tmp_width < 0 or tmp_height < 0:
-                    continue
-                elif tmp_width < tmp_scale[0] \
-                    and tmp_height < tmp_scale[0]:
-                    id_sc = 0
-                    box_scale = tmp_scale[0]
-                elif tmp_width < tmp_scale[1] \
-                    and tmp_height < tmp_scale[1]:
-                    id_sc = 1
-                    box_scale = tmp_scale[1]
-                elif tmp_width < tmp_scale[2] \
-                    and tmp_height < tmp_scale[2]:
-                    id_sc = 2
-                    box_scale = tmp_scale[2]
-                elif tmp_width < tmp_scale[3] \
-                    and tmp_height < tmp_scale[3]:
-                    id_sc = 3
-                    box_scale = tmp_scale[3]
-                else:
-                    id_sc = 4
-                    box_scale = tmp_scale[4]
-                
-                # Feature map is at stride 8. #
-                tmp_x_low = int(
-                    tmp_object["x_lower"] / tmp_w_ratio)
-                tmp_x_upp = int(tmp_x_low + tmp_width)
-                tmp_y_low = int(
-                    tmp_object["y_lower"] / tmp_h_ratio)
-                tmp_y_upp = int(tmp_y_low + tmp_height)
-                
-                tmp_x_idx = [z for z in range(tmp_x_low, tmp_x_upp)]
-                tmp_y_idx = [z for z in range(tmp_y_low, tmp_y_upp)]
-                tmp_index = [(
-                    z0, z1) for z0 in tmp_x_idx for z1 in tmp_y_idx]
-                
-                tmp_l = [(x-tmp_x_low) for x, y in tmp_index]
-                tmp_r = [(tmp_x_upp-x) for x, y in tmp_index]
-                tmp_b = [(y-tmp_y_low) for x, y in tmp_index]
-                tmp_t = [(tmp_y_upp-y) for x, y in tmp_index]
-                tmp_c = [compute_centerness(
-                    tmp_l[z], tmp_r[z], 
-                    tmp_b[z], tmp_t[z]) for z in range(len(tmp_l))]
-                
-                # Get the non-overlapping indices. #
-                tmp_arr = np.zeros(
-                    [img_width, img_height, num_scale], dtype=np.int32)
-                tmp_arr[tmp_x_low:tmp_x_upp, 
-                        tmp_y_low:tmp_y_upp, id_sc] = 1
-                
-                tmp_nnz = np.nonzero(tmp_arr - tmp_arr*tmp_mask)
-                tmp_x_nnz  = tmp_nnz[0]
-                tmp_y_nnz  = tmp_nnz[1]
-                tmp_sc_nnz = tmp_nnz[2]
-                for n_idx in range(len(tmp_x_nnz)):
-                    tmp_x  = tmp_x_nnz[n_idx]
-                    tmp_y  = tmp_y_nnz[n_idx]
-                    tmp_sc = tmp_sc_nnz[n_idx]
-                    
-                    tmp_l = tmp_x - tmp_x_low
-                    tmp_r = tmp_x_upp - tmp_x
-                    tmp_b = tmp_y - tmp_y_low
-                    tmp_t = tmp_y_upp - tmp_y
-                    tmp_c = compute_centerness(tmp_l, tmp_r, tmp_b, tmp_t)
-                    
-                    tmp_reg = [tmp_b, tmp_t, tmp_l, tmp_r, tmp_c, 1]
-                    for dim_arr in range(6):
-                        tmp_index_list = [tmp_y, tmp_x, id_sc, dim_arr]
-                        tmp_values.append(tmp_reg[dim_arr])
-                        tmp_indices.append(tmp_index_list)
-                    
-                    id_obj = tmp_label + 4
-                    tmp_index_list = [tmp_y, tmp_x, id_sc, id_sc, id_obj]
-                    tmp_values.append(1)
-                    tmp_indices.append(tmp_index_list)
-                del tmp_index, tmp_arr
+            # Feature map is at stride 8. #
+            tmp_x_low = (tmp_filter[:, 3] / tmp_w_ratio).astype(np.int64)
+            tmp_y_low = (tmp_filter[:, 4] / tmp_h_ratio).astype(np.int64)
+            tmp_x_upp = (tmp_x_low + tmp_width).astype(np.int64)
+            tmp_y_upp = (tmp_y_low + tmp_height).astype(np.int64)
+            obj_boxes = np.stack([
+                tmp_x_low, tmp_y_low, tmp_x_upp, tmp_y_upp], axis=1)
+            obj_labels = tmp_filter[:, 2].astype(np.int64)
+            
+            tmp_indices, tmp_values = build_sparse_targets(
+                obj_boxes, obj_labels, obj_scale, owner_map, stride=8)
+            
+            # Check the first images against the dense encoder. #
+            if n_count < n_check and not check_sparse_targets(
+                obj_boxes, obj_labels, obj_scale, 
+                tmp_indices, tmp_values, dense_shape, stride=8):
+                raise ValueError(
+                    "Sparse targets of " + img_file + " do not " + \
+                    "match the dense targets.")
             
             if len(tmp_indices) > 0:
                 tmp_dims = (img_width, img_height)
-                tmp_sparse_tensor = tf.sparse.SparseTensor(
-                    tmp_indices, tmp_values, dense_shape)
                 tmp_objects.append((
-                    img_file, tmp_dims, tmp_sparse_tensor))
+                    img_file, tmp_dims, 
+                    tmp_indices, tmp_values, dense_shape))
         
-        if (n_img+1) % 2500 == 0:
-            print(str(n_img+1), "annotations processed", 
+        if (n_count+1) % 2500 == 0:
+            print(str(n_count+1), "annotations processed", 
                   "at the", str(n_scale+1), "scale.")
     
+    # Keep the previous objects of the unchanged images. #
+    if old_objects is not None:
+        tmp_dict = dict([(
+            x[0], x) for x in old_objects[n_scale] \
+            if x[0] not in chg_files])
+        tmp_dict.update([(x[0], x) for x in tmp_objects])
+        tmp_objects = [tmp_dict[x] for x in sorted(tmp_dict.keys())]
+        del tmp_dict
+    
     # Append to the annotated files. #
     train_objects.append(tmp_objects)
 
 elapsed_tm = (time.time() - start_time) / 60
 print("Elapsed Time:", str(round(elapsed_tm, 3)), "mins.")
-print("Total of", str(train_objects[1]), "images.")
+print("Total of", str(len(train_objects[-1])), "images.")
 
 print("Saving the file.")
-save_pkl_file = "C:/Users/admin/Desktop/Data/COCO/"
-save_pkl_file += "coco_annotations_fcos.pkl"
 with open(save_pkl_file, "wb") as tmp_save:
     pkl.dump(img_scale, tmp_save)
     pkl.dump(train_objects, tmp_save)
+
+# The change list is used up once the objects are saved. #
+if os.path.isfile(tmp_chg_file):
+    os.remove(tmp_chg_file)
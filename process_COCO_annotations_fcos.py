@@ -1,72 +1,198 @@
 
+import os
 import json
 import time
+import hashlib
 import pandas as pd
+from annotation_store import check_source, load_manifest, save_manifest
 
-# Load COCO training data. #
-print("Loading training dataset.")
-start_tm = time.time()
+# Custom functions. #
+def load_coco_array(json_file, array_name, stream_flag=True):
+    """
+    Yields the elements of a top-level array in a COCO json file.
+    When stream_flag is True, the array is parsed incrementally
+    with the optional ijson package so the whole file is never
+    held in memory.
+    """
+    if stream_flag:
+        import ijson
+        with open(json_file, "rb") as tmp_file:
+            for tmp_item in ijson.items(
+                tmp_file, array_name + ".item", use_float=True):
+                yield tmp_item
+    else:
+        with open(json_file, "r") as tmp_file:
+            tmp_json = json.load(tmp_file)
+        for tmp_item in tmp_json[array_name]:
+            yield tmp_item
+        del tmp_json
+
+def build_image_index(json_file, img_folder, stream_flag=True):
+    """
+    Builds a hash index of image id to (filename, width, height)
+    in one pass over the images array.
+    """
+    img_index = dict()
+    for tmp_img in load_coco_array(
+        json_file, "images", stream_flag=stream_flag):
+        img_index[tmp_img["id"]] = (
+            img_folder + tmp_img["file_name"], 
+            tmp_img["width"], tmp_img["height"])
+    return img_index
+
+def diff_image_digests(old_digests, new_digests):
+    """
+    Compares the per-image digests of two conversions and returns
+    the list of (filename, status) of the images which were added, 
+    changed or removed.
+    """
+    tmp_diff = []
+    for tmp_file, tmp_digest in new_digests.items():
+        old_digest = old_digests.get(tmp_file)
+        if old_digest is None:
+            tmp_diff.append((tmp_file, "added"))
+        elif old_digest != tmp_digest:
+            tmp_diff.append((tmp_file, "changed"))
+    for tmp_file in old_digests.keys():
+        if tmp_file not in new_digests:
+            tmp_diff.append((tmp_file, "removed"))
+    return tmp_diff
+
+def write_object_chunk(tmp_list, csv_file, columns, header=False):
+    tmp_obj_df = pd.DataFrame(tmp_list, columns=columns)
+    tmp_obj_df.to_csv(
+        csv_file, mode="w" if header else "a", 
+        header=header, index=False)
+    return len(tmp_obj_df)
+
+# Parameters. #
+stream_flag = True
+chunk_size  = 100000
+
+# Streaming needs the optional ijson package, so load the #
+# json files in full if it is not installed.              #
+if stream_flag:
+    try:
+        import ijson
+    except ImportError:
+        print("ijson is not installed, loading the json files in full.")
+        stream_flag = False
+
+# Only convert the json files which changed since the last run. #
+incremental = True
 
 tmp_path = "C:/Users/admin/Desktop/Data/COCO/"
-tmp_json = json.loads(open(
-    tmp_path + "annotations/instances_train2014.json").read())
+tmp_csv_file = tmp_path + "object_boxes.csv"
+tmp_man_file = tmp_path + "object_boxes_manifest.pkl"
+tmp_chg_file = tmp_path + "object_boxes_changed.csv"
+tmp_col_df = ["filename", "img_width", "img_height", "id", 
+              "x_lower", "y_lower", "box_width", "box_height"]
+tmp_splits = [("train", "annotations/instances_train2014.json"), 
+              ("val", "annotations/instances_val2014.json")]
+
+start_tm = time.time()
+if incremental:
+    manifest = load_manifest(tmp_man_file)
+else:
+    manifest = dict()
 
-tmp_bbox  = tmp_json["annotations"]
-tmp_imgs  = pd.DataFrame(tmp_json["images"])
-tmp_label = pd.DataFrame(tmp_json["categories"])
+# Save the COCO labels. #
+tmp_label = pd.DataFrame(list(load_coco_array(
+    tmp_path + tmp_splits[0][1], 
+    "categories", stream_flag=stream_flag)))
 tmp_label.to_csv(tmp_path + "labels.csv", index=False)
 
 n_object = 0
-tmp_list = []
-for tmp_obj in tmp_bbox:
-    tmp_img  = tmp_imgs[tmp_imgs["id"] == tmp_obj["image_id"]]
-    tmp_box  = tmp_obj["bbox"]
-    tmp_file = tmp_path + "train2014/" + tmp_img["file_name"].iloc[0]
+n_write  = 0
+tmp_diff = []
+for tmp_split, tmp_json_file in tmp_splits:
+    tmp_part_file = tmp_path + "object_boxes_" + tmp_split + ".csv"
+    changed, tmp_entry = check_source(
+        manifest, tmp_path + tmp_json_file)
+    if not changed and "images" in tmp_entry \
+        and os.path.isfile(tmp_part_file):
+        print("Skipping", tmp_split, "dataset as it is unchanged.")
+        manifest[tmp_path + tmp_json_file] = tmp_entry
+        continue
     
-    tmp_width  = tmp_img.iloc[0]["width"]
-    tmp_height = tmp_img.iloc[0]["height"]
-    tmp_obj_id = tmp_obj["category_id"]
-    tmp_object = tmp_label[
-        tmp_label["id"] == tmp_obj["category_id"]]["name"]
-    tmp_list.append((tmp_file, tmp_width, tmp_height, tmp_obj_id, 
-                     tmp_box[0], tmp_box[1], tmp_box[2], tmp_box[3]))
+    # Load COCO data. #
+    print("Loading", tmp_split, "dataset.")
     
-    n_object += 1
-    if n_object % 10000 == 0:
-        print(str(n_object), "objects processed.")
-del tmp_json, tmp_bbox, tmp_imgs
-
-# Load COCO validation data. #
-print("Loading validation dataset.")
-
-tmp_json = json.loads(open(
-    tmp_path + "annotations/instances_val2014.json").read())
-
-tmp_bbox  = tmp_json["annotations"]
-tmp_imgs  = pd.DataFrame(tmp_json["images"])
-for tmp_obj in tmp_bbox:
-    tmp_img  = tmp_imgs[tmp_imgs["id"] == tmp_obj["image_id"]]
-    tmp_box  = tmp_obj["bbox"]
-    tmp_file = tmp_path + "val2014/" + tmp_img["file_name"].iloc[0]
+    img_folder = tmp_path + tmp_split + "2014/"
+    img_index  = build_image_index(
+        tmp_path + tmp_json_file, 
+        img_folder, stream_flag=stream_flag)
+    
+    # Digest of each image entry and its annotations. #
+    img_digest = dict()
+    for tmp_file, tmp_width, tmp_height in img_index.values():
+        img_digest[tmp_file] = hashlib.sha1(
+            repr((tmp_width, tmp_height)).encode("utf-8"))
     
-    tmp_width  = tmp_img.iloc[0]["width"]
-    tmp_height = tmp_img.iloc[0]["height"]
-    tmp_obj_id = tmp_obj["category_id"]
-    tmp_object = tmp_label[
-        tmp_label["id"] == tmp_obj["category_id"]]["name"]
-    tmp_list.append((tmp_file, tmp_width, tmp_height, tmp_obj_id, 
-                     tmp_box[0], tmp_box[1], tmp_box[2], tmp_box[3]))
+    n_part   = 0
+    tmp_list = []
+    for tmp_obj in load_coco_array(
+        tmp_path + tmp_json_file, 
+        "annotations", stream_flag=stream_flag):
+        tmp_file, tmp_width, tmp_height = \
+            img_index[tmp_obj["image_id"]]
+        tmp_box = tmp_obj["bbox"]
+        tmp_obj_id = tmp_obj["category_id"]
+        tmp_row = (tmp_file, tmp_width, tmp_height, tmp_obj_id, 
+                   tmp_box[0], tmp_box[1], tmp_box[2], tmp_box[3])
+        tmp_list.append(tmp_row)
+        img_digest[tmp_file].update(repr(tmp_row).encode("utf-8"))
+        
+        # Write the objects in bulk chunks. #
+        if len(tmp_list) >= chunk_size:
+            n_part += write_object_chunk(
+                tmp_list, tmp_part_file, tmp_col_df, header=(n_part == 0))
+            tmp_list = []
+        
+        n_object += 1
+        if n_object % 10000 == 0:
+            print(str(n_object), "objects processed.")
     
-    n_object += 1
-    if n_object % 10000 == 0:
-        print(str(n_object), "objects processed.")
-del tmp_json, tmp_bbox, tmp_imgs
+    if len(tmp_list) > 0 or n_part == 0:
+        n_part += write_object_chunk(
+            tmp_list, tmp_part_file, tmp_col_df, header=(n_part == 0))
+    del tmp_list, img_index
+    
+    img_digest = dict([(
+        x, y.hexdigest()) for x, y in img_digest.items()])
+    old_entry  = manifest.get(tmp_path + tmp_json_file, dict())
+    tmp_diff.extend(diff_image_digests(
+        old_entry.get("images", dict()), img_digest))
+    
+    tmp_entry["images"] = img_digest
+    manifest[tmp_path + tmp_json_file] = tmp_entry
+    del img_digest
 
-tmp_col_df = ["filename", "img_width", "img_height", "id", 
-              "x_lower", "y_lower", "box_width", "box_height"]
-tmp_obj_df = pd.DataFrame(tmp_list, columns=tmp_col_df)
-tmp_obj_df.to_csv(tmp_path + "object_boxes.csv", index=False)
+# Concatenate the objects of the splits. #
+with open(tmp_csv_file, "w") as tmp_csv:
+    for n_split in range(len(tmp_splits)):
+        tmp_part_file = \
+            tmp_path + "object_boxes_" + tmp_splits[n_split][0] + ".csv"
+        with open(tmp_part_file, "r") as tmp_part:
+            tmp_header = tmp_part.readline()
+            if n_split == 0:
+                tmp_csv.write(tmp_header)
+            for tmp_line in tmp_part:
+                tmp_csv.write(tmp_line)
+                n_write += 1
+
+# Add the images which changed to the list of the previous  #
+# runs, which is kept until format_COCO_annotations_fcos.py #
+# has used it. The last status of an image is kept.         #
+tmp_diff_df = pd.DataFrame(tmp_diff, columns=["filename", "status"])
+if os.path.isfile(tmp_chg_file):
+    tmp_diff_df = pd.concat([pd.read_csv(tmp_chg_file), tmp_diff_df])
+    tmp_diff_df = tmp_diff_df.drop_duplicates(
+        "filename", keep="last").reset_index(drop=True)
+tmp_diff_df.to_csv(tmp_chg_file, index=False)
+save_manifest(tmp_man_file, manifest)
 
 elapsed_tm = (time.time() - start_tm) / 60
-print("Total of", str(len(tmp_obj_df)), "images processed.")
+print("Total of", str(n_write), "objects and", 
+      str(len(tmp_diff_df)), "changed images.")
 print("Elapsed Time:", str(elapsed_tm), "mins.")